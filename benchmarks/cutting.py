@@ -0,0 +1,125 @@
+# SPDX-FileCopyrightText: 2024 Alexander Sosedkin <monk@unboiled.info>
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+# Compares CPU time and accuracy of the SponsorBlock cutting modes
+# on a synthetic video with long GOPs
+# that has the frame number painted into its corner.
+# Exits with 1 if a frame-accurate mode gets any frame wrong,
+# or any mode repeats or loses frames or has bad timestamps.
+# Usage: python benchmarks/cutting.py [duration] [gop_seconds] [codec]
+
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import yt_dlp
+
+from yousable.back.smartcut import SmartCutPP, ENCODERS, check
+
+
+FPS = 25
+ACCURATE = ('smart', 'exact')
+# frame number is painted in base 16 digits, luma + chroma,
+# 13 levels apart per digit to survive lossy encoding
+BASE, STEP = 16, 13
+PATCH = 'color=size=64x64:rate={fps},format=yuv420p,' \
+        f"geq=lum='16+{STEP}*mod(N,{BASE})'" \
+        f":cb='16+{STEP}*mod(floor(N/{BASE}),{BASE})'" \
+        f":cr='16+{STEP}*floor(N/{BASE ** 2})'"
+
+
+def _children_cpu():
+    r = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return r.ru_utime + r.ru_stime
+
+
+def _duration(filename):
+    r = subprocess.run(['ffprobe', '-v', 'error',
+                        '-show_entries', 'format=duration',
+                        '-of', 'csv=p=0', filename],
+                       capture_output=True, text=True, check=True)
+    return float(r.stdout)
+
+
+def _frame_numbers(filename):
+    r = subprocess.run(['ffprobe', '-v', 'error', '-f', 'lavfi',
+                        f'movie={filename},crop=32:32:16:16,signalstats',
+                        '-show_entries',
+                        'frame_tags=lavfi.signalstats.YAVG,'
+                        'lavfi.signalstats.UAVG,lavfi.signalstats.VAVG',
+                        '-of', 'csv=p=0'],
+                       capture_output=True, text=True, check=True)
+    return [sum(round((float(x) - 16) / STEP) * BASE ** i
+                for i, x in enumerate(line.split(',')[:3]))
+            for line in r.stdout.split()]
+
+
+def generate(filename, duration, gop_seconds, codec):
+    subprocess.run(['ffmpeg', '-v', 'error', '-y',
+                    '-f', 'lavfi', '-i', f'testsrc2=rate={FPS}:size=640x360',
+                    '-f', 'lavfi', '-i', PATCH.format(fps=FPS),
+                    '-f', 'lavfi', '-i', 'sine=frequency=440',
+                    '-filter_complex', '[0][1]overlay=shortest=1',
+                    '-t', str(duration), *ENCODERS[codec],
+                    '-g', str(int(gop_seconds * FPS)),
+                    '-c:a', 'libopus', filename], check=True)
+
+
+def cut(mode, source, workdir, ranges_to_cut):
+    filename = os.path.join(workdir, f'{mode}.mkv')
+    shutil.copy(source, filename)
+    pp = SmartCutPP(yt_dlp.YoutubeDL({'quiet': True}),
+                    force_keyframes=(mode == 'exact'),
+                    smart=(mode == 'smart'))
+    chapters = [{'start_time': a, 'end_time': b, 'remove': True}
+                for a, b in ranges_to_cut]
+    concat_opts = pp._make_concat_opts(chapters, _duration(filename))
+    cpu, wall = _children_cpu(), time.time()
+    out_file = pp.remove_chapters(filename, chapters, concat_opts,
+                                  mode == 'exact')
+    return (_children_cpu() - cpu, time.time() - wall,
+            out_file, os.path.getsize(out_file))
+
+
+def main():
+    duration = float(sys.argv[1]) if len(sys.argv) > 1 else 120
+    gop_seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 5
+    codec = sys.argv[3] if len(sys.argv) > 3 else 'h264'
+    assert duration * FPS <= BASE ** 3, 'too long to number the frames'
+    # cuts deliberately placed away from the keyframes
+    ranges_to_cut = [(duration * .1 + 1.3, duration * .2 + 2.7),
+                     (duration * .6 + .9, duration * .7 + 3.1)]
+    expected = [n for n in range(int(duration * FPS))
+                if not any(a * FPS <= n < b * FPS for a, b in ranges_to_cut)]
+    with tempfile.TemporaryDirectory() as workdir:
+        source = os.path.join(workdir, 'source.mkv')
+        generate(source, duration, gop_seconds, codec)
+        print(f'{duration}s {codec}, {gop_seconds}s GOPs, '
+              f'{len(expected) / FPS:.2f}s expected after cutting')
+        print(f'{"mode":6} {"cpu":>8} {"wall":>8} {"duration":>9} '
+              f'{"wrong frames":>13} {"missing":>8} {"repeated":>9} '
+              f'{"size":>10}  timestamps')
+        failed = False
+        for mode in ('fast', 'smart', 'exact'):
+            cpu, wall, out_file, size = cut(mode, source, workdir,
+                                            ranges_to_cut)
+            frames = _frame_numbers(out_file)
+            wrong = len(set(frames) - set(expected))
+            missing = len(set(expected) - set(frames))
+            repeated = len(frames) - len(set(frames))
+            problem = check('ffprobe', out_file)
+            print(f'{mode:6} {cpu:7.2f}s {wall:7.2f}s '
+                  f'{_duration(out_file):8.2f}s '
+                  f'{wrong:13} {missing:8} {repeated:9} {size:10}  '
+                  f'{problem or "ok"}')
+            failed |= bool(missing or repeated or problem or
+                           mode in ACCURATE and frames != expected)
+        sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
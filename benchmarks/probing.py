@@ -0,0 +1,100 @@
+# SPDX-FileCopyrightText: 2024 Alexander Sosedkin <monk@unboiled.info>
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+# Compares CPU time and results of telling the duration of growing .part files
+# with ffprobe (as the intermerger used to) and with yousable.back.probe,
+# simulating several livestreams being recorded at once
+# and probed every time they grow, plus once more after they've stopped.
+# Usage: python benchmarks/probing.py [duration] [streams] [steps]
+
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import ffmpeg
+
+from yousable.back import probe
+
+
+FORMATS = {  # name -> ffmpeg arguments, like what livestreams get saved as
+    'fmp4-video': ['-c:v', 'libx264', '-g', '50', '-c:a', 'aac',
+                   '-movflags', 'frag_keyframe+empty_moov+default_base_moof',
+                   '-f', 'mp4'],
+    'fmp4-audio': ['-vn', '-c:a', 'aac', '-frag_duration', '2000000',
+                   '-movflags', 'frag_keyframe+empty_moov+default_base_moof',
+                   '-f', 'mp4'],
+    'mpegts': ['-c:v', 'libx264', '-g', '50', '-c:a', 'aac', '-f', 'mpegts'],
+}
+
+
+def _cpu():
+    s, c = (resource.getrusage(resource.RUSAGE_SELF),
+            resource.getrusage(resource.RUSAGE_CHILDREN))
+    return s.ru_utime + s.ru_stime + c.ru_utime + c.ru_stime
+
+
+def generate(filename, duration, args):
+    subprocess.run(['ffmpeg', '-v', 'error', '-y',
+                    '-f', 'lavfi', '-i', 'testsrc2=rate=25:size=640x360',
+                    '-f', 'lavfi', '-i', 'sine=frequency=440',
+                    '-t', str(duration), *args, filename], check=True)
+
+
+def ffprobe_duration(path):
+    return float(ffmpeg.probe(path)['format']['duration'])
+
+
+def run(method, sources, parts, steps):
+    """Grow the .part files step by step, probing all of them each time."""
+    for part in parts:
+        open(part, 'wb').close()
+    durations, errors, cpu = {}, 0, 0
+    for step in range(1, steps + 2):  # and once more after they're done
+        for source, part in zip(sources, parts):
+            size = os.path.getsize(source) * min(step, steps) // steps
+            with open(source, 'rb') as src, open(part, 'r+b') as dst:
+                src.seek(os.path.getsize(part))
+                dst.seek(0, os.SEEK_END)
+                dst.write(src.read(size - os.path.getsize(part)))
+        start = _cpu()
+        for part in parts:
+            try:
+                durations[part] = method(part)
+            except Exception:
+                durations[part], errors = None, errors + 1
+        cpu += _cpu() - start
+    return cpu, durations, errors
+
+
+def main():
+    duration = float(sys.argv[1]) if len(sys.argv) > 1 else 60
+    streams = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    steps = int(sys.argv[3]) if len(sys.argv) > 3 else 30
+    with tempfile.TemporaryDirectory() as workdir:
+        print(f'{streams} streams of {duration}s, probed {steps + 1} times')
+        print(f'{"format":11} {"method":8} {"cpu":>8} {"wall":>8} '
+              f'{"per probe":>10} {"final durations":>22} {"errors":>7}')
+        for name, args in FORMATS.items():
+            source = os.path.join(workdir, f'{name}.src')
+            generate(source, duration, args)
+            sources = [source] * streams
+            parts = [os.path.join(workdir, f'{name}.{i}.part')
+                     for i in range(streams)]
+            for method_name, method in (('ffprobe', ffprobe_duration),
+                                        ('probe', probe.duration)):
+                wall = time.time()
+                cpu, durations, errors = run(method, sources, parts, steps)
+                wall = time.time() - wall
+                finals = sorted({f'{d:.2f}' if d is not None else '?'
+                                 for d in durations.values()})
+                print(f'{name:11} {method_name:8} {cpu:7.2f}s {wall:7.2f}s '
+                      f'{cpu / streams / (steps + 1) * 1e3:8.2f}ms '
+                      f'{",".join(finals):>22} {errors:7}')
+        print(f'probe methods used: {dict(probe.stats)}')
+
+
+if __name__ == '__main__':
+    main()
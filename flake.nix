@@ -22,6 +22,7 @@
 
       nativeDeps = pkgs: with pkgs; [
         ffmpeg_7-headless
+        util-linux  # ionice
       ];
 
       yousable-package = {pkgs, python3Packages}:
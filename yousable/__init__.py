@@ -1,7 +1,9 @@
 # SPDX-FileCopyrightText: 2022 Alexander Sosedkin <monk@unboiled.info>
 # SPDX-License-Identifier: AGPL-3.0-or-later
 
+from . import access
 from . import back
 from . import front
 from . import main
+from . import tiers
 from . import utils
@@ -0,0 +1,119 @@
+# SPDX-FileCopyrightText: 2024 Alexander Sosedkin <monk@unboiled.info>
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+# Remembering what the front-end has served, for the back-end to act upon.
+# The front-end creates the schema once with `connect` on start
+# and records through a connection per thread.
+
+import math
+import os
+import sqlite3
+import sys
+import time
+
+from yousable.utils import thread_cached, thread_uncache
+
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS access (
+    feed TEXT NOT NULL,
+    entry_id TEXT NOT NULL,
+    profile TEXT NOT NULL,
+    hits INTEGER NOT NULL DEFAULT 0,
+    last REAL NOT NULL,
+    PRIMARY KEY (feed, entry_id, profile)
+);
+CREATE TABLE IF NOT EXISTS demand (
+    feed TEXT NOT NULL,
+    profile TEXT NOT NULL,
+    kind TEXT NOT NULL,  -- poll (of a feed) or download (of an enclosure)
+    score REAL NOT NULL,  -- requests, exponentially decaying with HALF_LIFE
+    last REAL NOT NULL,
+    PRIMARY KEY (feed, profile, kind)
+);
+CREATE TABLE IF NOT EXISTS since (
+    ts REAL NOT NULL  -- when recording has started
+);
+'''
+
+HALF_LIFE = 7 * 86400  # seconds
+KINDS = ('poll', 'download')
+
+
+def _decay(elapsed):
+    return math.pow(.5, max(elapsed, 0) / HALF_LIFE)
+
+
+def _path(config):
+    return os.path.join(config['paths']['meta'], 'access.sqlite')
+
+
+def _open(config):
+    db = sqlite3.connect(_path(config), timeout=10, isolation_level=None)
+    db.execute('PRAGMA journal_mode=' +
+               ('DELETE' if config['limits']['multi_node'] else 'WAL'))
+    db.execute('PRAGMA synchronous=NORMAL')
+    db.create_function('decay', 1, _decay, deterministic=True)
+    return db
+
+
+def connect(config):
+    """Open the database, creating the schema if needed."""
+    os.makedirs(config['paths']['meta'], exist_ok=True)
+    db = _open(config)
+    db.executescript(SCHEMA)
+    db.execute('INSERT INTO since SELECT ? WHERE NOT EXISTS '
+               '(SELECT 1 FROM since)', (time.time(),))
+    return db
+
+
+def _write(config, what, query, params):
+    """Execute a query, never failing the request."""
+    key = 'access', _path(config)
+    try:
+        thread_cached(key, lambda: _open(config)).execute(query, params)
+    except (OSError, sqlite3.Error) as ex:
+        print(f'could not record {what}: {ex}', file=sys.stderr)
+        db = thread_uncache(key)  # reconnect next time
+        if db is not None:
+            db.close()
+
+
+def record(config, feed, entry_id, profile):
+    """Note that a file has been served."""
+    _write(config, f'access to {feed} {entry_id} {profile}', '''
+        INSERT INTO access (feed, entry_id, profile, hits, last)
+        VALUES (?, ?, ?, 1, ?)
+        ON CONFLICT (feed, entry_id, profile) DO UPDATE SET
+            hits = hits + 1, last = excluded.last
+    ''', (feed, entry_id, profile, time.time()))
+
+
+def record_demand(config, feed, profile, kind):
+    """Note that a feed has been polled or an enclosure requested."""
+    _write(config, f'{kind} of {feed} {profile}', '''
+        INSERT INTO demand (feed, profile, kind, score, last)
+        VALUES (?, ?, ?, 1, ?)
+        ON CONFLICT (feed, profile, kind) DO UPDATE SET
+            score = score * decay(excluded.last - last) + 1,
+            last = excluded.last
+    ''', (feed, profile, kind, time.time()))
+
+
+def last_accessed(db):
+    """{(feed, entry_id, profile): timestamp} of everything ever served."""
+    return {(feed, entry_id, profile): last
+            for feed, entry_id, profile, last in
+            db.execute('SELECT feed, entry_id, profile, last FROM access')}
+
+
+def demand(db):
+    """
+    {(feed, profile, kind): (score, last)}, scores decayed to the present,
+    and when the recording has started.
+    """
+    now = time.time()
+    since, = db.execute('SELECT min(ts) FROM since').fetchone()
+    rows = db.execute('SELECT feed, profile, kind, score, last FROM demand')
+    return {(feed, profile, kind): (score * _decay(now - last), last)
+            for feed, profile, kind, score, last in rows}, since
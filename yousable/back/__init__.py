@@ -1,7 +1,8 @@
 # SPDX-FileCopyrightText: 2022 Alexander Sosedkin <monk@unboiled.info>
 # SPDX-License-Identifier: AGPL-3.0-or-later
 
+import yousable.back.cleaner as cleaner
 import yousable.back.crawler as crawler
 import yousable.back.downloader as downloader
 
-__all__ = ['crawler', 'downloader']
+__all__ = ['cleaner', 'crawler', 'downloader']
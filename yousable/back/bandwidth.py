@@ -0,0 +1,135 @@
+# SPDX-FileCopyrightText: 2024 Alexander Sosedkin <monk@unboiled.info>
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+# A bandwidth budget shared by all the downloading and streaming processes:
+# a token bucket in a locked file, topped up according to the schedule,
+# with live recordings served before downloads and downloads before backfill.
+
+import contextlib
+import sys
+import time
+
+from yousable.utils import locked_state
+
+
+CLASSES = ('live', 'download', 'backfill')  # highest priority first
+ACTIVE_SECONDS = 10  # a class is active for this long after its last transfer
+BATCH_BYTES = 64 * 1024  # don't lock the state for every tiny chunk
+
+
+def _minutes(hhmm):
+    h, m = hhmm.split(':')
+    return int(h) * 60 + int(m)
+
+
+def rate(config, now=None):
+    """Current budget in bytes per second, None for unlimited."""
+    limits = config['limits']
+    t = time.localtime(now)
+    minutes = t.tm_hour * 60 + t.tm_min
+    for period in limits['bandwidth_schedule']:
+        start, end = _minutes(period['from']), _minutes(period['to'])
+        if (start <= minutes < end if start <= end
+                else minutes >= start or minutes < end):  # past midnight
+            return period['bytes_per_second']
+    return limits['bandwidth_bytes_per_second']
+
+
+@contextlib.contextmanager
+def _state(config):
+    with locked_state(config, 'bandwidth') as state:
+        state.setdefault('tokens', 0)
+        state.setdefault('updated', time.time())
+        state.setdefault('classes', {})  # class -> {bytes, last}
+        state.setdefault('feeds', {})  # feed -> [day, bytes]
+        yield state
+
+
+def _account(state, cls, feed, nbytes, now):
+    c = state['classes'].setdefault(cls, {'bytes': 0, 'last': 0})
+    c['bytes'] += nbytes
+    c['last'] = now
+    day = time.strftime('%Y-%m-%d', time.localtime(now))
+    feed_day, feed_bytes = state['feeds'].get(feed, (day, 0))
+    state['feeds'][feed] = day, (feed_bytes if feed_day == day else 0) + nbytes
+
+
+def _try_take(config, cls, feed, nbytes):
+    """Take tokens for `nbytes` or tell how long to wait before retrying."""
+    now = time.time()
+    with _state(config) as state:
+        r = rate(config, now)
+        if r is None:
+            state['tokens'], state['updated'] = 0, now
+            _account(state, cls, feed, nbytes, now)
+            return 0
+        burst = r * config['limits']['bandwidth_burst_seconds']
+        elapsed = max(now - state['updated'], 0)
+        state['tokens'] = min(burst, state['tokens'] + elapsed * r)
+        state['updated'] = now
+        higher_active = any(
+            state['classes'].get(c, {}).get('last', 0) > now - ACTIVE_SECONDS
+            for c in CLASSES[:CLASSES.index(cls)]
+        )
+        reserve = burst / 2 if higher_active else 0
+        if state['tokens'] > reserve:  # large chunks go into debt
+            state['tokens'] -= nbytes
+            _account(state, cls, feed, nbytes, now)
+            return 0
+        return (reserve - state['tokens']) / r + .01
+
+
+def acquire(config, cls, feed, nbytes):
+    """Account for `nbytes` transferred, sleeping if over the budget."""
+    while (wait := _try_take(config, cls, feed, nbytes)) > 0:
+        time.sleep(min(wait, 1))
+
+
+def make_progress_hook(config, cls, feed):
+    """Pace a yt-dlp download according to the shared budget."""
+    seen = {}  # filename -> downloaded bytes
+    pending = 0
+
+    def progress_hook(d):
+        nonlocal pending
+        downloaded = d.get('downloaded_bytes')
+        if downloaded is None:
+            return
+        prev = seen.get(d['filename'], 0)
+        pending += downloaded - prev if downloaded >= prev else downloaded
+        seen[d['filename']] = downloaded
+        if pending >= BATCH_BYTES or d.get('status') == 'finished':
+            acquire(config, cls, feed, pending)
+            pending = 0
+
+    return progress_hook
+
+
+def over_quota(config, feed):
+    """Tell if a feed has used up its bandwidth_daily_bytes for today."""
+    quota = config['feeds'][feed]['bandwidth_daily_bytes']
+    if quota is None:
+        return False
+    with _state(config) as state:
+        day, used = state['feeds'].get(feed, (None, 0))
+    return day == time.strftime('%Y-%m-%d') and used >= quota
+
+
+def usage(config):
+    """(timestamp, {class: bytes transferred so far})"""
+    with _state(config) as state:
+        return time.time(), {c: state['classes'].get(c, {}).get('bytes', 0)
+                             for c in CLASSES}
+
+
+def report(prev_usage, cur_usage):
+    (prev_t, prev), (cur_t, cur) = prev_usage, cur_usage
+    elapsed = max(cur_t - prev_t, 1)
+    return ', '.join(f'{c} {(cur[c] - prev.get(c, 0)) / elapsed / 1e3:.0f}kB/s'
+                     for c in CLASSES)
+
+
+def log_budget(config):
+    r = rate(config)
+    print('bandwidth budget: ' + (f'{r / 1e3:.0f}kB/s' if r else 'unlimited'),
+          file=sys.stderr)
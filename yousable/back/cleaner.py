@@ -0,0 +1,367 @@
+# SPDX-FileCopyrightText: 2024 Alexander Sosedkin <monk@unboiled.info>
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+# Enforcing per-feed retention and disk quotas, moving old media
+# to the cold tier, removing leftovers.
+
+import collections
+import json
+import os
+import shutil
+import sys
+import time
+
+import yousable.access as access
+import yousable.tiers as tiers
+import yousable.back.extraction as extraction
+import yousable.back.finalize as finalize
+import yousable.back.jobs as jobs
+import yousable.back.leases as leases
+import yousable.back.resume as resume
+import yousable.back.sources as sources
+import yousable.back.store as store
+from yousable.utils import listing, proctitle, sleep
+
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS listings (
+    dir TEXT PRIMARY KEY,
+    mtime REAL NOT NULL,
+    files TEXT NOT NULL  -- JSON {name: [size, mtime, inode]}
+);
+'''
+
+IN_FLIGHT = ('running', 'fetched', 'processing')
+
+Media = collections.namedtuple(
+    'Media', ('feed', 'entry_id', 'profile', 'size', 'mtime', 'inode')
+)
+
+
+def _subdirs(d):
+    try:
+        return [e.name for e in os.scandir(d)
+                if e.is_dir(follow_symlinks=False)]
+    except FileNotFoundError:
+        return []
+
+
+def _listing(db, d, changed=None):
+    """
+    {name: (size, mtime, inode)} of a directory, rescanned if changed.
+    Files written to in place keep the size and mtime of the last rescan.
+    The directories rescanned are added to `changed` if given.
+    """
+    try:
+        mtime = os.stat(d).st_mtime
+    except FileNotFoundError:
+        return {}
+    row = db.execute('SELECT mtime, files FROM listings WHERE dir = ?',
+                     (d,)).fetchone()
+    if row and row[0] == mtime:
+        return json.loads(row[1])
+    files = listing(d)
+    if changed is not None:
+        changed.add(d)
+    db.execute('''
+        INSERT INTO listings (dir, mtime, files) VALUES (?, ?, ?)
+        ON CONFLICT (dir) DO UPDATE SET
+            mtime = excluded.mtime, files = excluded.files
+    ''', (d, mtime, json.dumps(files)))
+    return files
+
+
+def _forget_listings(db, seen):
+    gone = [(d,) for d, in db.execute('SELECT dir FROM listings')
+            if d not in seen]
+    db.executemany('DELETE FROM listings WHERE dir = ?', gone)
+
+
+def _remove(path, reason):
+    print(f'removing {path}: {reason}', file=sys.stderr)
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    elif os.path.lexists(path):
+        os.unlink(path)
+
+
+def _in_flight(db, feed, entry_id, profiles):
+    return any(jobs.job_state(db, feed, entry_id, profile) in IN_FLIGHT
+               for profile in profiles)
+
+
+def _current_entries(config, feed):
+    try:
+        with open(os.path.join(config['paths']['meta'], feed,
+                               'feed.json')) as f:
+            return {e['id'] for e in json.load(f)['entries'] if e is not None}
+    except FileNotFoundError:
+        return None
+
+
+def _entry_ts(config, feed, entry_id, files):
+    try:
+        return os.stat(os.path.join(config['paths']['meta'], feed, entry_id,
+                                    'first_seen')).st_mtime
+    except FileNotFoundError:
+        return max((f[1] for f in files.values()), default=0)
+
+
+def _remove_entry(config, db, feed, entry_id, reason):
+    for d in ('out', 'meta', 'tmp', 'sources', 'cold'):
+        if config['paths'][d]:
+            path = os.path.join(config['paths'][d], feed, entry_id)
+            if os.path.exists(path):
+                _remove(path, reason)
+    jobs.forget(db, feed, entry_id)
+
+
+def apply_retention(config, db, feed, entries):
+    """
+    Remove the entries that are no longer in the feed
+    unless they're among the last keep_entries ones
+    or younger than keep_entries_seconds.
+    Takes and returns {entry_id: listing}.
+    """
+    feed_cfg = config['feeds'][feed]
+    current = _current_entries(config, feed)
+    if current is None:  # not crawled yet
+        return entries
+    now = time.time()
+    ts = {entry_id: _entry_ts(config, feed, entry_id, files)
+          for entry_id, files in entries.items()}
+    by_recency = sorted(entries, key=ts.get, reverse=True)
+    protected = current | set(by_recency[:feed_cfg['keep_entries']])
+    for entry_id in by_recency:
+        if (entry_id in protected or
+                ts[entry_id] > now - feed_cfg['keep_entries_seconds'] or
+                _in_flight(db, feed, entry_id, config['profiles'])):
+            continue
+        _remove_entry(config, db, feed, entry_id, 'past retention')
+        del entries[entry_id]
+    return entries
+
+
+def _media(config, feed, entries):
+    for entry_id, files in entries.items():
+        for profile, profile_cfg in config['profiles'].items():
+            name = f'{profile}.{profile_cfg["container"]}'
+            if name in files:
+                yield Media(feed, entry_id, profile, *files[name])
+
+
+def _evict(config, db, m):
+    container = config['profiles'][m.profile]['container']
+    entry_dir = os.path.join(config['paths']['out'], m.feed, m.entry_id)
+    _remove(os.path.join(entry_dir, f'{m.profile}.{container}'), 'evicted')
+    sb_path = os.path.join(entry_dir, f'.{m.profile}.sponsorblock.json')
+    if os.path.exists(sb_path):
+        os.unlink(sb_path)
+    jobs.evict(db, m.feed, m.entry_id, m.profile)
+
+
+def enforce_quota(config, db, media, quota, last_access, what):
+    """
+    Once `media` take up more than the high watermark of `quota`,
+    evict the least recently accessed ones down to the low watermark.
+    Files hardlinked into several feeds are counted once
+    and only free up space once evicted from all of them.
+    Returns what's left.
+    """
+    limits = config['limits']
+    links = collections.Counter(m.inode for m in media)
+    total = sum({m.inode: m.size for m in media}.values())
+    if quota is None or total <= quota * limits['clean_high_watermark']:
+        return media
+    target = quota * limits['clean_low_watermark']
+    print(f'{what}: {total} bytes used out of {quota}, '
+          f'evicting down to {int(target)}', file=sys.stderr)
+    lru = sorted(media, key=lambda m: last_access.get(m[:3], m.mtime))
+    evicted = set()
+    for m in lru:
+        if total <= target:
+            break
+        _evict(config, db, m)
+        evicted.add(m)
+        links[m.inode] -= 1
+        if not links[m.inode]:
+            total -= m.size
+    return [m for m in media if m not in evicted]
+
+
+def _reconcile_tiers(config, db, tiers_db, seen, changed):
+    """
+    Reconcile the tiers index for the entries
+    that have changed in paths.out or paths.cold since the last time.
+    """
+    out, cold = config['paths']['out'], config['paths']['cold']
+    keys = {key[:2] for key in tiers.cold_files(tiers_db)}
+    for feed in config['feeds']:
+        for entry_id in _subdirs(os.path.join(cold, feed)):
+            d = os.path.join(cold, feed, entry_id)
+            _listing(db, d, changed)
+            seen.add(d)
+            keys.add((feed, entry_id))
+    entries = set()
+    for feed, entry_id in keys:
+        hot_d = os.path.join(out, feed, entry_id)
+        cold_d = os.path.join(cold, feed, entry_id)
+        if hot_d in changed or hot_d not in seen or cold_d in changed:
+            entries.add((feed, entry_id))
+    tiers.gc(config, tiers_db, entries)
+
+
+def cool_down(config, db, media, last_access, seen, changed):
+    """
+    Move the media of the entries older than cold_after_seconds
+    and the media not served for cold_idle_seconds to paths.cold.
+    """
+    limits = config['limits']
+    after, idle = limits['cold_after_seconds'], limits['cold_idle_seconds']
+    now = time.time()
+    tiers_db = tiers.connect(config)
+    try:
+        for m in media:
+            if (after is not None and
+                    _entry_ts(config, m.feed, m.entry_id,
+                              {m.profile: m[3:]}) < now - after):
+                reason = 'old'
+            elif (idle is not None and
+                    last_access.get(m[:3], m.mtime) < now - idle):
+                reason = 'not served lately'
+            else:
+                continue
+            if _in_flight(db, m.feed, m.entry_id, [m.profile]):
+                continue
+            container = config['profiles'][m.profile]['container']
+            proctitle(f'cooling down {m.feed} {m.entry_id} {m.profile}...')
+            tiers.migrate(config, tiers_db, m.feed, m.entry_id,
+                          f'{m.profile}.{container}', reason)
+        _reconcile_tiers(config, db, tiers_db, seen, changed)
+    finally:
+        tiers_db.close()
+
+
+def remove_orphans(config, db, seen):
+    feeds = config['feeds']
+    paths = config['paths']
+
+    def cached_listing(d):
+        seen.add(d)
+        return _listing(db, d)
+
+    for d in ('meta', 'tmp', 'sources', 'cold'):
+        if paths[d]:
+            for feed in _subdirs(paths[d]):
+                if feed not in feeds and not (d == 'cold' and
+                                              feed == tiers.STORE):
+                    _remove(os.path.join(paths[d], feed), 'no such feed')
+    for feed in jobs.feeds(db):
+        if feed not in feeds:
+            jobs.forget(db, feed)
+
+    for feed, feed_cfg in feeds.items():
+        for entry_id in _subdirs(os.path.join(paths['tmp'], feed)):
+            has_meta = os.path.exists(os.path.join(paths['meta'],
+                                                   feed, entry_id))
+            for profile in _subdirs(os.path.join(paths['tmp'],
+                                                 feed, entry_id)):
+                if (has_meta and profile in feed_cfg['profiles'] or
+                        _in_flight(db, feed, entry_id, [profile])):
+                    continue
+                _remove(os.path.join(paths['tmp'], feed, entry_id, profile),
+                        'orphaned')
+                staging = os.path.join(paths['out'], feed, entry_id,
+                                       finalize.STAGING.format(
+                                           profile=profile))
+                if os.path.exists(staging):
+                    _remove(staging, 'orphaned')
+        for d in ('sources', 'cold'):
+            if not paths[d]:
+                continue
+            for entry_id in _subdirs(os.path.join(paths[d], feed)):
+                if not os.path.exists(os.path.join(paths['out'],
+                                                   feed, entry_id)):
+                    _remove(os.path.join(paths[d], feed, entry_id),
+                            'orphaned')
+    resume.gc(config, db, cached_listing)
+    extraction.gc(config)
+    leases.gc(config)
+    if paths['sources']:
+        sources.evict(config, cached_listing)
+
+    if paths['live']:  # live/<profile>/<feed>/<slices>
+        now = time.time()
+        for profile in _subdirs(paths['live']):
+            for feed in _subdirs(os.path.join(paths['live'], profile)):
+                d = os.path.join(paths['live'], profile, feed)
+                if profile not in config['profiles'] or feed not in feeds:
+                    _remove(d, 'orphaned')
+                    continue
+                max_age = feeds[feed]['keep_entries_seconds']
+                for name, (_, mtime, _) in cached_listing(d).items():
+                    path = os.path.join(d, name)
+                    if '.tmp.' in name:  # still being written to
+                        try:
+                            mtime = os.stat(path).st_mtime
+                        except FileNotFoundError:
+                            continue
+                    if mtime < now - max_age:
+                        _remove(path, 'old live slice')
+
+
+def clean(config, db, access_db):
+    start = time.time()
+    last_access = access.last_accessed(access_db)
+    media, seen, changed = [], set(), set()
+    for feed in config['feeds']:
+        proctitle(f'cleaning {feed}...')
+        out_dir = os.path.join(config['paths']['out'], feed)
+        meta_dir = os.path.join(config['paths']['meta'], feed)
+        entries = {}
+        for entry_id in set(_subdirs(out_dir)) | set(_subdirs(meta_dir)):
+            d = os.path.join(out_dir, entry_id)
+            entries[entry_id] = _listing(db, d, changed)
+            seen.add(d)
+        entries = apply_retention(config, db, feed, entries)
+        media.extend(_media(config, feed, entries))
+
+    proctitle('enforcing quotas...')
+    for profile, profile_cfg in config['profiles'].items():
+        kept = enforce_quota(config, db,
+                             [m for m in media if m.profile == profile],
+                             profile_cfg['max_bytes'], last_access, profile)
+        media = [m for m in media if m.profile != profile] + kept
+    media = enforce_quota(config, db, media,
+                          config['limits']['out_max_bytes'],
+                          last_access, 'out')
+    if store.enabled(config):
+        store.gc(config)
+
+    if tiers.enabled(config):
+        proctitle('cooling down...')
+        cool_down(config, db, media, last_access, seen, changed)
+
+    proctitle('removing orphans...')
+    remove_orphans(config, db, seen)
+    _forget_listings(db, seen)
+    print(f'cleaned up in {time.time() - start:.1f}s', file=sys.stderr)
+
+
+def main(config):
+    proctitle('spinning up...')
+    db = jobs.connect(config)
+    db.executescript(SCHEMA)
+    access_db = access.connect(config)
+    while True:
+        # one host cleans up, another one takes over if it goes down
+        if leases.acquire(config, 'cleaner',
+                          config['limits']['clean_seconds'] * 2):
+            clean(config, db, access_db)
+            proctitle('cleaned')
+        else:
+            print(f'cleaning on {leases.held(config, "cleaner")}',
+                  file=sys.stderr)
+            proctitle('cleaning elsewhere')
+        sleep('cleaned', config=config,
+              base_sec=config['limits']['clean_seconds'])
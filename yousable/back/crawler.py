@@ -2,6 +2,7 @@
 # SPDX-License-Identifier: AGPL-3.0-or-later
 
 import datetime
+import hashlib
 import json
 import os
 import pathlib
@@ -12,7 +13,11 @@ import time
 
 import yt_dlp
 
+import yousable.back.demand as demand
+import yousable.back.jobs as jobs
+import yousable.back.leases as leases
 from yousable.utils import sleep, proctitle, dl_options
+from yousable.back.filters import compile_filters
 from yousable.back.rss_timestamp import latest_timestamp_of_feeds
 
 
@@ -34,12 +39,41 @@ class MyStripPP(yt_dlp.postprocessor.PostProcessor):
         return [], info
 
 
+# change on every crawl without the entry changing in any meaningful way
+VOLATILE_KEYS = frozenset((
+    'epoch', '_version', 'formats', 'url', 'manifest_url', 'fragments',
+    'http_headers', 'subtitles', 'requested_subtitles',
+    'view_count', 'like_count', 'comment_count', 'concurrent_view_count',
+    'channel_follower_count',
+))
+
+
 def _write_json(path, data):
     with open(path + '.new', 'w') as f:
         json.dump(data, f)
     os.rename(path + '.new', path)
 
 
+def _digest(info):
+    stable = {k: v for k, v in info.items() if k not in VOLATILE_KEYS}
+    return hashlib.sha256(json.dumps(stable, sort_keys=True).encode()
+                          ).hexdigest()
+
+
+def _write_if_changed(json_path, digest_path, data, digest):
+    try:
+        with open(digest_path) as f:
+            if f.read() == digest:
+                return False
+    except FileNotFoundError:
+        pass
+    _write_json(json_path, data)
+    with open(digest_path + '.new', 'w') as f:
+        f.write(digest)
+    os.rename(digest_path + '.new', digest_path)
+    return True
+
+
 def feed_overduedness(config, feed, now):
     def feed_pathogen(d, *r):
         return os.path.join(config['paths'][d], feed, *r)
@@ -57,7 +91,8 @@ def feed_overduedness(config, feed, now):
 
 def most_overdue_feeds(config, top=2):
     t = time.time()
-    d = {feed: feed_overduedness(config, feed, t) for feed in config['feeds']}
+    d = {feed: feed_overduedness(config, feed, t) for feed in config['feeds']
+         if leases.held(config, f'crawl-{feed}') is None}  # elsewhere
     d = {feed: overduedness for feed, overduedness in d.items()
          if overduedness > 0}
     if d:
@@ -72,7 +107,7 @@ def most_overdue_feeds(config, top=2):
     return d
 
 
-def crawl_feed(config, feed):
+def crawl_feed(config, feed, feed_filter, db):
     def feed_pathogen(d, *r):
         return os.path.join(config['paths'][d], feed, *r)
 
@@ -195,10 +230,19 @@ def crawl_feed(config, feed):
     now = datetime.datetime.now(datetime.timezone.utc)
     max_age = datetime.timedelta(seconds=feed_cfg['keep_entries_seconds'])
     max_age += datetime.timedelta(days=1)  # upload_date coarseness
+    accepted_entries, entry_digests, changed = [], [], []
     for entry_info in info['entries']:
         if entry_info is None:
             print('SKIPPING None', file=sys.stderr)
             continue
+        rejection_reason = feed_filter(entry_info, now.timestamp())
+        if rejection_reason:
+            print(f'{feed}: filtered out {entry_info["id"]}: '
+                  f'{rejection_reason}', file=sys.stderr)
+            continue
+        accepted_entries.append(entry_info)
+        entry_digest = _digest(entry_info)
+        entry_digests.append(entry_digest)
         if (entry_info.get('upload_date') and
                 entry_info.get('live_status')
                 not in ('is_live', 'is_upcoming')):
@@ -213,31 +257,46 @@ def crawl_feed(config, feed):
         def entry_pathogen(d, *r):
             return feed_pathogen(d, entry_info['id'], *r)
         os.makedirs(entry_pathogen('meta'), exist_ok=True)
-        _write_json(entry_pathogen('meta', 'entry.json'), entry_info)
+        if _write_if_changed(entry_pathogen('meta', 'entry.json'),
+                             entry_pathogen('meta', 'digest'),
+                             entry_info, entry_digest):
+            changed.append(entry_info)
         if not os.path.exists(entry_pathogen('meta', 'first_seen')):
             with open(entry_pathogen('meta', 'first_seen'), 'w'):
                 pass
 
+    info['entries'] = accepted_entries
     os.makedirs(feed_pathogen('meta'), exist_ok=True)
-    _write_json(feed_pathogen('meta', 'feed.json'), info)
+    _write_if_changed(feed_pathogen('meta', 'feed.json'),
+                      feed_pathogen('meta', 'digest'), info,
+                      _digest({**info, 'entries': entry_digests}))
+    jobs.enqueue(db, feed, demand.plan(config, feed, changed))
 
     if ts_new is not None:
         with open(rss_timestamp_file, 'w') as f:
             f.write(ts_new)
     pathlib.Path(checked_marker_file).touch()
-    refreshed_marker_file = feed_pathogen('meta', 'refreshed')
-    pathlib.Path(refreshed_marker_file).touch()
 
-    print(f'{feed} {len(info["entries"])}: refreshed.', file=sys.stderr)
+    print(f'{feed} {len(info["entries"])}: refreshed, '
+          f'{len(changed)} entries changed.', file=sys.stderr)
     proctitle(f'{feed} refreshed')
 
 
 def main(config):
     proctitle('spinning up...')
+    feed_filters = compile_filters(config)
+    db = jobs.connect(config)
     while True:
         most_overdue = list(most_overdue_feeds(config, top=2).keys())
         if most_overdue:
             picked_feed = random.choice(most_overdue)
-            crawl_feed(config, picked_feed)
+            lease = f'crawl-{picked_feed}'  # against other hosts' crawlers
+            if leases.acquire(config, lease,
+                              config['feeds'][picked_feed]['poll_seconds']):
+                try:
+                    crawl_feed(config, picked_feed,
+                               feed_filters[picked_feed], db)
+                finally:
+                    leases.release(config, lease)
         else:
             sleep('just chilling', config=config)
@@ -0,0 +1,114 @@
+# SPDX-FileCopyrightText: 2024 Alexander Sosedkin <monk@unboiled.info>
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+# Ordering the download queue by what's actually in demand:
+# fresh entries first, of the feeds that get polled,
+# in the profiles that get requested; skipping the profiles nobody uses
+# and the lazy ones, which are only made once somebody asks for them.
+
+import json
+import os
+import sys
+import time
+
+import yousable.access as access
+import yousable.back.jobs as jobs
+from yousable.back.filters import entry_age
+from yousable.utils import entry_origin
+
+
+WEIGHT = .3  # of each of the bonuses, so that they add up to less than 1
+POLLS_HALF = 24  # decayed polls of a feed that give half the feed bonus
+
+
+def snapshot(config):
+    db = access.connect(config)
+    try:
+        return access.demand(db)
+    finally:
+        db.close()
+
+
+def wanted(config, snapshot, feed, profile, now=None):
+    """Tell whether a profile of a feed should be downloaded eagerly."""
+    idle = config['limits']['eager_idle_seconds']
+    if idle is None:
+        return True
+    demand, since = snapshot
+    now = now or time.time()
+    if since > now - idle:
+        return True  # not watching for long enough to tell
+    last = max(demand.get((feed, profile, kind), (0, 0))[1]
+               for kind in access.KINDS)
+    return last > now - idle
+
+
+def priority(snapshot, feed, profile, entry_info, base, now=None):
+    """
+    Add up to 1 to the `base` priority
+    for the recency of the entry, the polls of the feed
+    and the share of the downloads that the profile gets.
+    """
+    demand, _ = snapshot
+    now = now or time.time()
+    age = entry_age(entry_info, now)
+    recency = 1 / (1 + max(age, 0) / 86400) if age is not None else 0
+    polls = sum(score for (f, _, kind), (score, _) in demand.items()
+                if f == feed and kind == 'poll')
+    downloads = {(f, p): score for (f, p, kind), (score, _) in demand.items()
+                 if kind == 'download'}
+    total_downloads = sum(downloads.values())
+    share = (sum(score for (_, p), score in downloads.items() if p == profile)
+             / total_downloads if total_downloads else 0)
+    return base + WEIGHT * (recency + polls / (polls + POLLS_HALF) + share)
+
+
+def plan(config, feed, entries, base=0):
+    """(entry_id, profile, origin, priority) of the jobs for `entries`."""
+    snap = snapshot(config)
+    now = time.time()
+    eager, lazy = [], []
+    for profile in config['feeds'][feed]['profiles']:
+        if config['profiles'][profile]['lazy']:
+            lazy.append(profile)
+        elif wanted(config, snap, feed, profile, now):
+            eager.append(profile)
+        else:
+            if entries:
+                print(f'{feed}: not downloading {profile} eagerly, '
+                      'nobody has requested it lately', file=sys.stderr)
+            lazy.append(profile)
+    return [(e['id'], profile, entry_origin(e),
+             priority(snap, feed, profile, e,
+                      jobs.priority(e, default=base), now))
+            for e in entries for profile in eager + lazy
+            if profile in eager or _exists(config, feed, e['id'], profile)]
+
+
+def _exists(config, feed, entry_id, profile):
+    container = config['profiles'][profile]['container']
+    return os.path.exists(os.path.join(config['paths']['out'], feed,
+                                       entry_id, f'{profile}.{container}'))
+
+
+def request(config, feed, entry_id, profile):
+    """
+    Queue making a missing file somebody has asked for.
+    Tells whether it's on its way.
+    """
+    if profile not in config['feeds'][feed]['profiles']:
+        return False
+    try:
+        with open(os.path.join(config['paths']['meta'], feed, entry_id,
+                               'entry.json')) as f:
+            entry_info = json.load(f)
+    except FileNotFoundError:
+        return False
+    db = jobs.connect(config)
+    try:
+        state = jobs.request(db, feed, entry_id, profile,
+                             entry_origin(entry_info),
+                             jobs.PRIORITY_ON_DEMAND)
+    finally:
+        db.close()
+    return state != 'failed'
@@ -0,0 +1,129 @@
+# SPDX-FileCopyrightText: 2024 Alexander Sosedkin <monk@unboiled.info>
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+# Producing profiles from the local files of other profiles
+# instead of fetching them again.
+
+import math
+import os
+import re
+import sys
+import time
+
+import ffmpeg
+
+import yousable.sponsorblock
+import yousable.tiers
+import yousable.back.finalize as finalize
+from yousable.utils import proctitle
+
+
+# same as what FFmpegExtractAudioPP would pick
+AUDIO_CODECS = {
+    'aac': 'aac', 'm4a': 'aac', 'mka': 'copy',
+    'mp3': 'libmp3lame', 'opus': 'libopus',
+    'ogg': 'libvorbis', 'vorbis': 'libvorbis',
+    'flac': 'flac', 'alac': 'alac', 'aiff': 'pcm_s16be', 'wav': 'pcm_s16le',
+}
+
+
+def _resolution(profile_cfg):
+    """The first `res:N` of the profile's format_sort, or None."""
+    for field in profile_cfg['download'].get('format_sort', []):
+        m = re.fullmatch(r'\+?res:(\d+)', str(field))
+        if m:
+            return int(m.group(1))
+
+
+def _inferred_source(config, feed, profile):
+    """
+    Pick a source for a profile with no `derive_from`:
+    audio-only profiles are extracted from a requested video profile,
+    video profiles with `derive` options are transcoded
+    from the smallest requested profile of a higher resolution.
+    """
+    profile_cfg = config['profiles'][profile]
+    resolution = _resolution(profile_cfg)
+    if profile_cfg['video'] and (not profile_cfg['derive'] or
+                                 resolution is None):
+        return
+    candidates = []
+    for source in config['feeds'][feed]['profiles']:
+        source_cfg = config['profiles'][source]
+        if (source == profile or not source_cfg['video'] or
+                source_cfg['lazy'] or source_cfg['derive_from'] == profile):
+            continue
+        source_resolution = _resolution(source_cfg)
+        if profile_cfg['video'] and (source_resolution is None or
+                                     source_resolution <= resolution):
+            continue
+        candidates.append((source_resolution or math.inf, source))
+    if candidates:
+        return min(candidates)[1]
+
+
+def derivation_source(config, feed, profile):
+    """
+    Pick the profile of the same feed to derive `profile` from
+    by following `derive_from` or inferring it if it's unset,
+    or None if it has to be downloaded.
+    """
+    requested = config['feeds'][feed]['profiles']
+    if config['profiles'][profile]['derive_from'] is None:
+        return _inferred_source(config, feed, profile)
+    seen = {profile}
+    source = config['profiles'][profile]['derive_from']
+    while source and source not in seen:
+        if source in requested:
+            return source
+        seen.add(source)
+        source = config['profiles'][source]['derive_from']
+
+
+def _ffmpeg_kwargs(profile_cfg):
+    if profile_cfg['derive']:
+        return profile_cfg['derive']
+    if not profile_cfg['video']:
+        return {'vn': None, 'acodec': AUDIO_CODECS[profile_cfg['container']]}
+    return {'c': 'copy'}  # remux
+
+
+def derive(config, feed, entry_info, entry_pathogen, profile, source):
+    start = time.time()
+    profile_cfg = config['profiles'][profile]
+    container = profile_cfg['container']
+    source_container = config['profiles'][source]['container']
+    source_file = entry_pathogen('out', f'{source}.{source_container}')
+    source_sb_path = entry_pathogen('out', f'.{source}.sponsorblock.json')
+    out_file = entry_pathogen('out', f'{profile}.{container}')
+    sb_path = entry_pathogen('out', f'.{profile}.sponsorblock.json')
+    log_name = f'{profile}<{source} {entry_info["id"]}'
+
+    if not os.path.exists(source_file):
+        print(f'{log_name}: no {source} to derive from yet', file=sys.stderr)
+        return
+    if (os.path.exists(out_file) and
+            os.stat(out_file).st_mtime >= os.stat(source_file).st_mtime):
+        print(f'{log_name} has already been derived', file=sys.stderr)
+        return
+
+    proctitle(f'deriving {log_name}...')
+    print(f'{log_name} begins deriving', file=sys.stderr)
+    os.makedirs(entry_pathogen('tmp', profile), exist_ok=True)
+    os.makedirs(finalize.staging(config, entry_pathogen, profile),
+                exist_ok=True)
+    tmp_file = finalize.staging(config, entry_pathogen, profile,
+                                f'derived.{container}')
+    ffmpeg.input(source_file)\
+          .output(tmp_file, **_ffmpeg_kwargs(profile_cfg))\
+          .run(overwrite_output=True, quiet=True)
+    finalize.move(tmp_file, out_file, log_name)
+    yousable.tiers.replaced(config, feed, entry_info['id'],
+                            f'{profile}.{container}')
+    if os.path.exists(source_sb_path):
+        sb = yousable.sponsorblock.file_read(source_sb_path)
+        yousable.sponsorblock.file_write(sb, sb_path)
+    finalize.cleanup(config, entry_pathogen, profile)
+    proctitle('finished')
+    print(f'{log_name} has finished deriving in {time.time() - start:.1f}s',
+          file=sys.stderr)
@@ -1,11 +1,12 @@
 # SPDX-FileCopyrightText: 2022 Alexander Sosedkin <monk@unboiled.info>
 # SPDX-License-Identifier: AGPL-3.0-or-later
 
+import functools
 import json
 import os
-import shutil
 import sys
 import time
+import urllib.parse
 
 import ffmpeg
 import yt_dlp
@@ -15,11 +16,24 @@ from yt_dlp.postprocessor.ffmpeg import (
     FFmpegExtractAudioPP,
     FFmpegVideoRemuxerPP,
 )
-from yt_dlp.postprocessor.modify_chapters import ModifyChaptersPP
 
 import yousable.sponsorblock
+import yousable.tiers
+import yousable.back.bandwidth as bandwidth
+import yousable.back.extraction as extraction
+import yousable.back.fragments as fragments
+import yousable.back.probe as probe
+import yousable.back.finalize as finalize
+import yousable.back.resume as resume
+import yousable.back.sources as sources
+import yousable.back.store as store
+from yousable.back.derive import derivation_source, derive
+from yousable.back.smartcut import SmartCutPP
+from yousable.back.sources import KeepSourcePP
+from yousable.back.stream import get_file_and_duration
 from yousable.sponsorblock import SponsorBlockPPCached
-from yousable.utils import proctitle, sleep, dl_options
+from yousable.utils import proctitle, sleep, throttle, dl_options
+from yousable.utils import entry_origin
 
 
 def shorten(s, to=30):
@@ -67,66 +81,85 @@ def make_progress_hook(log_prefix, progressfile, target_interval=20):
     return progress_hook
 
 
-def download(config, feed, entry_pathogen, profile, retries=2):
-    progressfile = entry_pathogen('tmp', profile, 'progress')
-    start = time.time()
-
-    entry_json = entry_pathogen('meta', 'entry.json')
-    with open(entry_json) as f:
-        entry_info = json.load(f)
-
-    live_status = entry_info.get('live_status')
-    if live_status in ('is_upcoming', 'is_live'):
-        print(f'{feed} {entry_info["id"]}: {live_status=}', file=sys.stdout)
-        return
-
+def _add_postprocessors(ydl, config, feed, profile, sb, sb_global_path,
+                        keep_source=False):
     container = config['profiles'][profile]['container']
     audio_only = not config['profiles'][profile]['video']
     sb_cats = config['feeds'][feed]['sponsorblock_remove']
+    if sb and sb_cats or keep_source:
+        _add_postprocessor(ydl, FFmpegVideoRemuxerPP,
+                           preferedformat=container)
+    if keep_source:
+        _add_postprocessor(ydl, KeepSourcePP,
+                           config=config, feed=feed, profile=profile)
+    if sb and sb_cats:
+        #_add_postprocessor(ydl, FFmpegEmbedSubtitlePP)
+        _add_postprocessor(ydl, SponsorBlockPPCached,
+                           categories=sb_cats,
+                           cachefile=sb_global_path)
+        cut = config['feeds'][feed]['sponsorblock_cut']
+        _add_postprocessor(ydl, SmartCutPP,
+                           remove_sponsor_segments=sb_cats,
+                           force_keyframes=(cut == 'exact'),  # slow
+                           smart=(cut == 'smart'))
+    if audio_only:
+        _add_postprocessor(ydl, FFmpegExtractAudioPP,
+                           preferredcodec=container)
+    if not audio_only:
+        _add_postprocessor(ydl, EmbedThumbnailPP)
 
-    pretty_log_name = f'{profile} {entry_info["id"]} {entry_info["title"]}'
-    pretty_log_name = shorten(pretty_log_name)
 
-    sb = None
-    sb_global_path = entry_pathogen('meta', 'sponsorblock.json')
-    sb_specific_path = entry_pathogen('out', f'.{profile}.sponsorblock.json')
-    if sb_cats:
-        proctitle('querying sponsorblock...')
-        sb = yousable.sponsorblock.query_cached(entry_info["id"],
-                                                sb_global_path)
-        sb_prev = yousable.sponsorblock.file_read(sb_specific_path)
-        if os.path.exists(entry_pathogen('out', profile + '.' + container)):
-            if not yousable.sponsorblock.is_outdated(sb_prev, sb):
-                print(f'{pretty_log_name} has already been downloaded',
-                      file=sys.stderr)
-                proctitle('done, already downloaded')
-                return
-            else:
-                print(f'{pretty_log_name} SponsorBlock data out of date, '
-                  're-downloading...', file=sys.stderr)
-    else:
-        if os.path.exists(entry_pathogen('out', profile + '.' + container)):
-            print(f'{pretty_log_name} has already been downloaded',
-                  file=sys.stderr)
-            return
+HANDOFF = 'fetched.json'  # what the fetching stage leaves for processing
+
 
+class HandOffPP(yt_dlp.postprocessor.PostProcessor):
+    """Save what the post-processing stage needs to pick up the download."""
+
+    def __init__(self, downloader=None, path=None, sb=None):
+        super(HandOffPP, self).__init__(downloader)
+        self.path, self.sb = path, sb
+
+    def run(self, info):
+        _hand_off(self.path, info, self.sb, restored=False)
+        return [], info
+
+
+def _hand_off(path, info, sb, restored, derive_from=None):
+    info = {k: v for k, v in info.items()
+            if k not in ('__postprocessors', '__files_to_move')}
+    with open(path + '.tmp', 'w') as f:
+        json.dump({'info': yt_dlp.YoutubeDL.sanitize_info(info),
+                   'sb': sb, 'restored': restored,
+                   'derive_from': derive_from}, f)
+    os.rename(path + '.tmp', path)
+
+
+def _dl_opts(config, feed, entry_pathogen, profile, pretty_log_name,
+             bandwidth_class='download'):
+    progressfile = entry_pathogen('tmp', profile, 'progress')
+    container = config['profiles'][profile]['container']
     retry = lambda n: min(64 * 2**n, 256)
-    dl_opts = {
+    return {
         'quiet': True,
         #'verbose': True,
         'keepvideo': True,
         'keepfragments': True,
+        'continuedl': True,  # resume from what resume.ResumePP validated
         'skip_unavailable_fragments': False,
         'noprogress': True,
-        'progress_hooks': [make_progress_hook(pretty_log_name, progressfile)],
+        'progress_hooks': [
+            make_progress_hook(pretty_log_name, progressfile),
+            resume.make_progress_hook(entry_pathogen('tmp', profile)),
+            bandwidth.make_progress_hook(config, bandwidth_class, feed),
+        ],
         'outtmpl': 'media',
         'merge_output_format': container,
         'writethumbnail': True,
         #'writesubtitles': True,
         #'subtitleslangs': ['all', '-live_chat'],
         'paths': {
-            'temp': entry_pathogen('tmp', profile),
-            'home': entry_pathogen('tmp', profile),
+            'temp': finalize.staging(config, entry_pathogen, profile),
+            'home': finalize.staging(config, entry_pathogen, profile),
         },
         'sleep_interval': config['limits']['throttle_extra_seconds'] / 2,
         'max_sleep_interval_requests':
@@ -140,78 +173,331 @@ def download(config, feed, entry_pathogen, profile, retries=2):
         **config['profiles'][profile]['download'],
     }
 
+
+def _pretty_log_name(profile, entry_info):
+    return shorten(f'{profile} {entry_info["id"]} {entry_info["title"]}')
+
+
+def download(config, feed, entry_pathogen, profile, retries=2):
+    """Fetch and post-process in one go."""
+    for retries_left in reversed(range(retries)):
+        if not fetch(config, feed, entry_pathogen, profile):
+            return
+        if postprocess(config, feed, entry_pathogen, profile):
+            return
+        if retries_left:
+            sleep(f'{feed} {profile} short-retry-{retries_left}',
+                  config=config)
+    raise RuntimeError('downloaded file is too short')
+
+
+def fetch(config, feed, entry_pathogen, profile, bandwidth_class='download'):
+    """
+    Do the network part of downloading an entry
+    and hand it off for post-processing.
+    Returns whether post-processing is due.
+    """
+    start = time.time()
+
+    entry_json = entry_pathogen('meta', 'entry.json')
+    with open(entry_json) as f:
+        entry_info = json.load(f)
+
+    live_status = entry_info.get('live_status')
+    if live_status in ('is_upcoming', 'is_live'):
+        print(f'{feed} {entry_info["id"]}: {live_status=}', file=sys.stdout)
+        return False
+
+    source = derivation_source(config, feed, profile)
+    if source is not None:
+        source_container = config['profiles'][source]['container']
+        if os.path.exists(entry_pathogen('out', source + '.' +
+                                         source_container)):
+            # transcoding is for the post-processing stage to do
+            os.makedirs(entry_pathogen('tmp', profile), exist_ok=True)
+            _hand_off(entry_pathogen('tmp', profile, HANDOFF), entry_info,
+                      None, restored=False, derive_from=source)
+            return True
+        # the pool waits for pending sources, so this one isn't coming,
+        # e.g., it's lazy or has been evicted; download directly instead
+        print(f'{feed} {entry_info["id"]}: no {source} to derive {profile} '
+              'from, downloading', file=sys.stderr)
+
+    container = config['profiles'][profile]['container']
+    sb_cats = config['feeds'][feed]['sponsorblock_remove']
+    pretty_log_name = _pretty_log_name(profile, entry_info)
+    handoff_path = entry_pathogen('tmp', profile, HANDOFF)
+
+    sb = restored = None
+    sb_global_path = store.sponsorblock_path(config, entry_pathogen,
+                                             entry_info['id'])
+    sb_specific_path = entry_pathogen('out', f'.{profile}.sponsorblock.json')
+    out_path = entry_pathogen('out', f'{profile}.{container}')
+    out_exists = os.path.exists(out_path)
+    if sb_cats:
+        proctitle('querying sponsorblock...')
+        sb = yousable.sponsorblock.query_cached(entry_info["id"],
+                                                sb_global_path)
+        sb_prev = yousable.sponsorblock.file_read(sb_specific_path)
+        if out_exists and not yousable.sponsorblock.is_outdated(sb_prev, sb):
+            print(f'{pretty_log_name} has already been downloaded',
+                  file=sys.stderr)
+            proctitle('done, already downloaded')
+            return False
+    elif out_exists:
+        print(f'{pretty_log_name} has already been downloaded',
+              file=sys.stderr)
+        return False
+
+    if store.enabled(config) and store.take(config, feed, entry_pathogen,
+                                            entry_info['id'], profile,
+                                            store.cut_key(config, feed, sb)):
+        print(f'{pretty_log_name} is already there for another feed',
+              file=sys.stderr)
+        if sb_cats:
+            yousable.sponsorblock.file_write(sb, sb_specific_path)
+        return False
+
+    if out_exists:  # but SponsorBlock data is outdated
+        restored = sources.restore(config, feed, entry_pathogen,
+                                   entry_info['id'], profile)
+        if restored:
+            print(f'{pretty_log_name} SponsorBlock data out of date, '
+                  're-cutting...', file=sys.stderr)
+        else:
+            print(f'{pretty_log_name} SponsorBlock data out of date, '
+                  're-downloading...', file=sys.stderr)
+
     os.makedirs(entry_pathogen('out'), exist_ok=True)
     os.makedirs(entry_pathogen('tmp', profile), exist_ok=True)
+    os.makedirs(finalize.staging(config, entry_pathogen, profile),
+                exist_ok=True)
+
+    if restored:
+        _hand_off(handoff_path, {**entry_info, **restored}, sb,
+                  restored=True)
+        return True
 
+    dl_opts = _dl_opts(config, feed, entry_pathogen, profile, pretty_log_name,
+                       bandwidth_class)
     try:
-        with yt_dlp.YoutubeDL(dl_opts) as ydl:
-            if sb and sb_cats:
-                _add_postprocessor(ydl, FFmpegVideoRemuxerPP,
-                                   preferedformat=container)
-                #_add_postprocessor(ydl, FFmpegEmbedSubtitlePP)
-                _add_postprocessor(ydl, SponsorBlockPPCached,
-                                   categories=sb_cats,
-                                   cachefile=sb_global_path)
-                _add_postprocessor(ydl, ModifyChaptersPP,
-                                   remove_sponsor_segments=sb_cats,
-                                   force_keyframes=False)  # so much faster
-            if audio_only:
-                _add_postprocessor(ydl, FFmpegExtractAudioPP,
-                                   preferredcodec=container)
-            if not audio_only:
-                _add_postprocessor(ydl, EmbedThumbnailPP)
-
-            sleep(f'pre-dl {pretty_log_name}', config=config)
+        throttle(f'pre-dl {pretty_log_name}', config,
+                 entry_origin(entry_info))
+        proctitle(f'extracting {pretty_log_name}...')
+        proxy, info = extraction.extract(config, entry_pathogen, entry_info,
+                                         pretty_log_name)
+        controller = fragments.Controller(config, profile, pretty_log_name)
+        dl_opts['progress_hooks'].append(controller.progress_hook)
+        with yt_dlp.YoutubeDL({
+            **dl_opts, 'proxy': proxy,
+            **fragments.options(config, profile, proxy, controller),
+        }) as ydl:
+            controller.attach(ydl)
+            ydl.add_post_processor(
+                resume.ResumePP(ydl, tmp_dir=entry_pathogen('tmp', profile),
+                                media_dir=finalize.staging(config,
+                                                           entry_pathogen,
+                                                           profile),
+                                log_name=pretty_log_name),
+                when='before_dl'
+            )
+            _add_postprocessor(ydl, HandOffPP, path=handoff_path, sb=sb)
             proctitle(f'dl {pretty_log_name}...')
             print(f'{pretty_log_name} begins downloading', file=sys.stderr)
-
-            # doesn't re-sort formats
-            #r = ydl.download_with_info_file(entry_pathogen('meta', 'entry.json'))
-            url = (entry_info.get('original_url') or
-                   entry_info.get('webpage_url') or
-                   entry_info.get('url'))
-            r = ydl.download(url)
-            assert r == 0
+            # formats get selected and sorted according to the profile here
+            ydl.process_ie_result(info, download=True)
     except yt_dlp.utils.UserNotLive as ex:
         print(f'{feed} {entry_info["id"]} ERROR: {ex}', file=sys.stdout)
-        shutil.rmtree(entry_pathogen('tmp', profile))
-        # suppress
+        finalize.cleanup(config, entry_pathogen, profile)
+        return False  # suppress
     except yt_dlp.utils.DownloadError as ex:
         print(f'{feed} {entry_info["id"]} ERROR: {ex}', file=sys.stdout)
-        shutil.rmtree(entry_pathogen('tmp', profile))
+        print(f'{pretty_log_name} keeping the partial download to resume',
+              file=sys.stderr)
         raise
 
+    assert os.path.exists(handoff_path)
+    print(f'{pretty_log_name} has finished fetching '
+          f'in {time.time() - start:.1f}s', file=sys.stderr)
+    return True
+
+
+def _missing_seconds(path, expected):
+    """Seconds missing from a recording, in gaps or at the end."""
+    gaps = probe.gaps(path) or []  # can only tell for fragmented MP4
+    for where, seconds in gaps:
+        print(f'{path}: {seconds:.0f}s missing at {where:.0f}s',
+              file=sys.stderr)
+    return (sum(seconds for _, seconds in gaps) +
+            max(0, expected - (probe.duration(path) or 0)))
+
+
+def _fetch_thumbnail(config, info, basename):
+    """Fetch the thumbnail to embed like yt-dlp would have."""
+    thumbnails = [t for t in info.get('thumbnails') or [] if t.get('url')]
+    if not thumbnails:
+        return
+    t = thumbnails[-1]  # the best one
+    ext = os.path.splitext(urllib.parse.urlparse(t['url']).path)[1]
+    path = basename + (ext or '.jpg')
+    try:
+        with yt_dlp.YoutubeDL({'quiet': True,
+                               **dl_options(config, 'all')}) as ydl:
+            data = ydl.urlopen(t['url']).read()
+    except Exception as ex:
+        print(f'{info["id"]}: cannot fetch the thumbnail: {ex}',
+              file=sys.stderr)
+        return
+    with open(path, 'wb') as f:
+        f.write(data)
+    t['filepath'] = path
+
+
+def fetch_recording(config, feed, entry_pathogen, profile, info, ended):
+    """
+    Hand off the recording of a livestream that has just ended
+    for post-processing, like fetch() does with a download.
+    `info` is what's known about the livestream now that it's over,
+    `ended` is when the recording stopped.
+    Returns whether the recording is complete enough for that.
+    """
+    tolerance = config['limits']['live_vod_tolerance_seconds']
+    if tolerance is None:
+        return False
+    pretty_log_name = _pretty_log_name(profile, info)
+    video = config['profiles'][profile]['video']
+
+    recordings = {}
+    for track in ('video', 'audio') if video else ('audio',):
+        fd = get_file_and_duration(entry_pathogen('tmp', profile, track))
+        if fd is None:
+            print(f'{pretty_log_name} has no {track} recorded',
+                  file=sys.stderr)
+            return False
+        recordings[track] = fd[0]
+
+    expected = info.get('duration')
+    if not expected and info.get('release_timestamp'):
+        expected = ended - info['release_timestamp']
+    if not expected:
+        print(f'{pretty_log_name} cannot tell how long the recording '
+              'should be', file=sys.stderr)
+        return False
+    missing = max(_missing_seconds(path, expected)
+                  for path in recordings.values())
+    print(f'{pretty_log_name} recording misses {missing:.0f}s '
+          f'of {expected:.0f}s', file=sys.stderr)
+    if missing > tolerance:
+        return False
+
+    sb = None
+    if config['feeds'][feed]['sponsorblock_remove']:
+        proctitle('querying sponsorblock...')
+        sb = yousable.sponsorblock.query_cached(
+            info['id'],
+            store.sponsorblock_path(config, entry_pathogen, info['id'])
+        )
+
+    # remuxed into the container a download would've been merged into;
+    # audio goes into Matroska to be extracted from in post-processing
+    ext = config['profiles'][profile]['container'] if video else 'mka'
+    media = finalize.staging(config, entry_pathogen, profile, f'media.{ext}')
+    os.makedirs(entry_pathogen('out'), exist_ok=True)
+    os.makedirs(os.path.dirname(media), exist_ok=True)
+    proctitle(f'remuxing {pretty_log_name}...')
+    inputs = [ffmpeg.input(recordings[track]) for track in recordings]
+    codec_kwargs = {'vcodec': 'copy'} if video else {'vn': None}
+    ffmpeg.output(*inputs, media, acodec='copy', **codec_kwargs)\
+          .run(overwrite_output=True, quiet=True)
+
+    info = {**info, 'filepath': media, 'ext': ext,
+            'thumbnails': [dict(t) for t in info.get('thumbnails') or []]}
+    _fetch_thumbnail(config, info,
+                     finalize.staging(config, entry_pathogen, profile,
+                                      'media'))
+    _hand_off(entry_pathogen('tmp', profile, HANDOFF), info, sb,
+              restored=False)
+    print(f'{pretty_log_name} is handed off from the recording',
+          file=sys.stderr)
+    return True
+
+
+def postprocess(config, feed, entry_pathogen, profile):
+    """
+    Do the CPU-heavy part of downloading an entry
+    (remuxing, cutting, transcoding, embedding thumbnails,
+    deriving it from another profile) and move the result in place.
+    Returns False if the result turned out too short and was discarded.
+    """
+    start = time.time()
+    progressfile = entry_pathogen('tmp', profile, 'progress')
+    with open(entry_pathogen('meta', 'entry.json')) as f:
+        entry_info = json.load(f)
+    with open(entry_pathogen('tmp', profile, HANDOFF)) as f:
+        handoff = json.load(f)
+    info, sb, restored = handoff['info'], handoff['sb'], handoff['restored']
+    if handoff.get('derive_from'):
+        derive(config, feed, entry_info, entry_pathogen, profile,
+               handoff['derive_from'])
+        finalize.cleanup(config, entry_pathogen, profile)
+        return True
+
+    container = config['profiles'][profile]['container']
+    sb_cats = config['feeds'][feed]['sponsorblock_remove']
+    pretty_log_name = _pretty_log_name(profile, entry_info)
+    sb_global_path = store.sponsorblock_path(config, entry_pathogen,
+                                             entry_info['id'])
+    sb_specific_path = entry_pathogen('out', f'.{profile}.sponsorblock.json')
+
+    proctitle(f'processing {pretty_log_name}...')
+    print(f'{pretty_log_name} begins processing', file=sys.stderr)
+    dl_opts = _dl_opts(config, feed, entry_pathogen, profile, pretty_log_name)
+    with yt_dlp.YoutubeDL(dl_opts) as ydl:
+        _add_postprocessors(ydl, config, feed, profile,
+                            sb, sb_global_path,
+                            keep_source=(not restored and
+                                         sources.enabled(config, feed)))
+        ydl.post_process(info['filepath'], info)
+
     proctitle('moving...')
     with open(progressfile + '.tmp', 'w') as f:
         f.write('moving...')
     os.rename(progressfile + '.tmp', progressfile)
 
-    tmp_fname = entry_pathogen('tmp', profile, 'media.' + container)
+    staging = functools.partial(finalize.staging, config, entry_pathogen,
+                                profile)
+    tmp_fname = staging('media.' + container)
     if not os.path.exists(tmp_fname):
         # some really weird bug where extension gets eaten?
-        tmp_fname = entry_pathogen('tmp', profile, '.' + container)
+        tmp_fname = staging('.' + container)
         if not os.path.exists(tmp_fname):
             # some really weird bug where filename gets eaten?
-            tmp_fname = entry_pathogen('tmp', profile, 'media')
+            tmp_fname = staging('media')
     assert os.path.exists(tmp_fname)
     reported_duration = entry_info.get('duration')
-    real_duration = float(ffmpeg.probe(tmp_fname)['format']['duration'])
+    real_duration = probe.duration(tmp_fname)
+    if real_duration is None:
+        raise ValueError(f'cannot tell the duration of {tmp_fname}')
     print(f'{pretty_log_name} {reported_duration=} {real_duration=}',
           file=sys.stderr)
     if reported_duration:
         if not real_duration or real_duration < reported_duration * 0.4:
-            shutil.rmtree(entry_pathogen('tmp', profile))
-            print(f'{pretty_log_name} too short, {retries=}', file=sys.stderr)
-            sleep(f'{pretty_log_name} short-retry-{retries}', config=config)
-            if retries > 1:
-                print(f'{pretty_log_name} retrying retries={retries-1}')
-                download(config, feed, entry_pathogen, profile,
-                         retries=retries - 1)
-    shutil.move(tmp_fname, entry_pathogen('out', profile + '.' + container))
+            finalize.cleanup(config, entry_pathogen, profile)
+            print(f'{pretty_log_name} too short', file=sys.stderr)
+            return False
+    strategy = finalize.move(tmp_fname,
+                             entry_pathogen('out', f'{profile}.{container}'),
+                             pretty_log_name)
+    yousable.tiers.replaced(config, feed, entry_info['id'],
+                            f'{profile}.{container}')
     if sb_cats:
         yousable.sponsorblock.file_write(sb, sb_specific_path)
+    if store.enabled(config):
+        store.put(config, entry_pathogen, entry_info['id'], profile,
+                  store.cut_key(config, feed, sb))
     proctitle('cleaning...')
-    shutil.rmtree(entry_pathogen('tmp', profile))
+    finalize.cleanup(config, entry_pathogen, profile)
     proctitle('finished')
-    print(f'{pretty_log_name} has finished downloading '
-          f'in {time.time() - start:.1f}s')
+    print(f'{pretty_log_name} has finished processing '
+          f'in {time.time() - start:.1f}s ({strategy} into place)')
+    return True
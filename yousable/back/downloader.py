@@ -2,15 +2,31 @@
 # SPDX-License-Identifier: AGPL-3.0-or-later
 
 import json
+import multiprocessing
 import os
 import random
+import shutil
 import sys
 import time
-import traceback
 
-from yousable.back.download import download
+import yt_dlp
+
+import yousable.back.bandwidth as bandwidth
+import yousable.back.demand as demand
+import yousable.back.finalize as finalize
+import yousable.back.jobs as jobs
+import yousable.back.leases as leases
+import yousable.back.resume as resume
+from yousable.back.download import download, fetch_recording
+from yousable.back.filters import compile_filters
+from yousable.back.pool import DownloadPool, PostProcessPool
 from yousable.back.stream import stream
-from yousable.utils import start_process, proctitle, sleep
+from yousable.utils import start_process, proctitle, sleep, reap, dl_options
+from yousable.utils import entry_origin
+
+# (feed, entry_id) -> (release_timestamp, process, streaming event)
+# of waiters and streamers
+_live_processes = {}
 
 
 def shuffled(container):
@@ -33,12 +49,170 @@ def _download_enabled(config, profile):
     return True
 
 
+def _remove_recordings(entry_pathogen, profile):
+    for track in 'video', 'audio':
+        shutil.rmtree(entry_pathogen('tmp', profile, track),
+                      ignore_errors=True)
+
+
+def _vod_from_recording(config, feed, entry_info, entry_pathogen, profile,
+                        ended):
+    """
+    Make the VOD out of the recording if it's good enough
+    and hand it off to the post-processing pool, tell if so.
+    """
+    log_name = f'{feed} {entry_info["id"]} {profile}'
+    job = jobs.Job(feed, entry_info['id'], profile,
+                   entry_origin(entry_info), jobs.PRIORITY_LIVE)
+    with leases.kept(config, jobs.lease_name(job),
+                     config['limits']['lease_seconds']) as ours:
+        if not ours:
+            print(f'{log_name}: being downloaded elsewhere', file=sys.stderr)
+            _remove_recordings(entry_pathogen, profile)
+            return True
+        try:
+            try:  # duration and the rest as known now that it's over
+                info = {**entry_info,
+                        **_query_live_status(config, entry_info)}
+            except Exception as ex:
+                print(f'{log_name}: ERROR {ex}', file=sys.stderr)
+                info = entry_info
+            if not fetch_recording(config, feed, entry_pathogen, profile,
+                                   info, ended):
+                return False
+        except Exception as ex:
+            print(f'{log_name}: ERROR making the VOD out of the recording: '
+                  f'{ex}', file=sys.stderr)
+            return False
+        # before the pool gets to cleaning up paths.tmp on its own
+        _remove_recordings(entry_pathogen, profile)
+        db = jobs.connect(config)
+        try:
+            jobs.hand_off(db, job)
+        finally:
+            db.close()
+        return True
+
+
 def stream_then_download(config, feed, entry_info, entry_pathogen,
                          profile, video):
     stream(config, feed, entry_info, entry_pathogen, profile, video)
-    if _download_enabled(config, profile):
-        time.sleep(900)
-        download(config, feed, entry_pathogen, profile)
+    ended = time.time()
+    if not _download_enabled(config, profile):
+        _remove_recordings(entry_pathogen, profile)
+        return
+    if _vod_from_recording(config, feed, entry_info, entry_pathogen,
+                           profile, ended):
+        return
+    _remove_recordings(entry_pathogen, profile)
+    print(f'{feed} {entry_info["id"]} {profile}: '
+          'downloading the VOD anew', file=sys.stderr)
+    time.sleep(900)
+    download(config, feed, entry_pathogen, profile)
+
+
+def _start_streams(config, feed, entry_info, entry_pathogen):
+    ps = []
+    for profile in config['feeds'][feed]['profiles']:
+        status = f'{feed}@{profile}: {entry_info["id"]}'
+        if _live_enabled(status, config, profile):
+            video = config['profiles'][profile]['video']
+            ps.append(start_process(
+                f'stream_then_dl {entry_info["id"]} {profile}',
+                stream_then_download,
+                config, feed, entry_info, entry_pathogen, profile, video
+            ))
+    return ps
+
+
+def _query_live_status(config, entry_info):
+    url = (entry_info.get('original_url') or
+           entry_info.get('webpage_url') or
+           entry_info.get('url'))
+    opts = {
+        'quiet': True,
+        'ignore_no_formats_error': True,  # upcoming ones have no formats
+        'sleep_interval_requests':
+            config['limits']['throttle_extra_seconds'],
+        **dl_options(config, 'all'),
+    }
+    with yt_dlp.YoutubeDL(opts) as ydl:
+        info = ydl.extract_info(url, download=False)
+    return ydl.sanitize_info(info)
+
+
+def wait_then_stream(config, feed, entry_info, entry_pathogen, streaming):
+    lead = config['feeds'][feed]['live_wakeup_seconds']
+    recheck = config['limits']['throttle_live_recheck_seconds']
+    log_name = f'{feed} {entry_info["id"]}'
+    release_ts = entry_info['release_timestamp']
+    while True:
+        delay = release_ts - lead - time.time()
+        if delay > 0:
+            sleep(f'{log_name} wakeup', base_sec=delay, variance_sec=0)
+        proctitle('querying status...')
+        try:
+            info = _query_live_status(config, entry_info)
+        except Exception as ex:
+            print(f'{log_name}: ERROR {ex}', file=sys.stderr)
+            info = {'live_status': 'is_upcoming'}
+        live_status = info.get('live_status')
+        print(f'{log_name}: {live_status}', file=sys.stderr)
+        if live_status == 'is_live':
+            break
+        if live_status != 'is_upcoming':
+            print(f'{log_name}: not waiting anymore', file=sys.stderr)
+            proctitle('done')
+            return
+        if info.get('release_timestamp'):
+            release_ts = info['release_timestamp']
+        if release_ts - lead <= time.time():  # overdue, keep rechecking
+            sleep(f'{log_name} overdue', base_sec=recheck, variance_sec=0)
+    proctitle('streaming...')
+    streaming.set()  # not to be rescheduled anymore
+    for p in _start_streams(config, feed, {**entry_info, **info},
+                            entry_pathogen):
+        p.join()
+    proctitle('done')
+
+
+def _schedule_live(config, feed, entry_info, entry_pathogen):
+    k = feed, entry_info['id']
+    release_ts = entry_info.get('release_timestamp')
+    if k in _live_processes:
+        prev_release_ts, p, streaming = _live_processes[k]
+        if p.exitcode is None:
+            if (streaming.is_set() or
+                    entry_info.get('live_status') == 'is_live' or
+                    release_ts is None or release_ts == prev_release_ts):
+                return  # already waiting or streaming
+            print(f'{feed} {entry_info["id"]}: rescheduled '
+                  f'{prev_release_ts} -> {release_ts}', file=sys.stderr)
+            p.terminate()
+            p.join()
+        del _live_processes[k]
+    streaming = multiprocessing.Event()
+    if entry_info.get('live_status') == 'is_live':
+        streaming.set()
+        p = start_process(f'stream {entry_info["id"]}', _join_all,
+                          _start_streams, config, feed, entry_info,
+                          entry_pathogen)
+    elif release_ts:
+        print(f'{feed} {entry_info["id"]}: scheduling wakeup '
+              f'at {release_ts}', file=sys.stderr)
+        p = start_process(f'wakeup {entry_info["id"]}', wait_then_stream,
+                          config, feed, entry_info, entry_pathogen,
+                          streaming)
+    else:
+        print(f'{feed} {entry_info["id"]}: upcoming, but no release time',
+              file=sys.stderr)
+        return
+    _live_processes[k] = release_ts, p, streaming
+
+
+def _join_all(process_starter, *args):
+    for p in process_starter(*args):
+        p.join()
 
 
 def _entry_ts(feed_pathogen, feed, entry_id):
@@ -57,10 +231,12 @@ def _entry_ts(feed_pathogen, feed, entry_id):
     return 0
 
 
-def download_feed(config, feed_name):
-    proctitle(f'downloading {feed_name}...')
-    print(f'downloading {feed_name}...')
-
+def download_feed(config, feed_name, db, only_live=False):
+    """
+    Queue all the entries of a feed once in a revisit_seconds while,
+    e.g., to catch up with SponsorBlock updates or after a migration.
+    Regular changes are queued by the crawler as they are discovered.
+    """
     def feed_pathogen(d, *r):
         return os.path.join(config['paths'][d], feed_name, *r)
 
@@ -73,100 +249,96 @@ def download_feed(config, feed_name):
         print(f'SKIPPING {feed_name}: no metadata', file=sys.stderr)
         return
 
-    # Is it time to refresh already?
-
-    refreshed_marker_file = feed_pathogen('meta', 'refreshed')
-    downloaded_marker_file = feed_pathogen('meta', 'downloaded')
-    if (os.path.exists(refreshed_marker_file) and
-            os.path.exists(downloaded_marker_file)):
-        tr = os.stat(refreshed_marker_file).st_mtime
-        td = os.stat(downloaded_marker_file).st_mtime
-        if td > tr:  # TODO: could be even stricter with change detection?
-            print(f'skipping {feed_name}: '
-                  f'no updates for {int(time.time() - tr)}s',
-                  file=sys.stderr)
-            return
+    # Is it time for a revisit already?
 
-    downloaded_marker_file_tmp = feed_pathogen('meta', 'downloaded.tmp')
-    with open(downloaded_marker_file_tmp, 'w'):
-        pass
-
-    # Load metadata
-
-    with open(feed_pathogen('meta', 'feed.json')) as f:
-        feed_info = json.load(f)
-
-    # Download stuff
-
-    success = True
-    entries = feed_info['entries']
-    for i, e in enumerate(shuffled(entries)):
-        if e is None:
-            print(f'SKIPPING {feed_name}: null entry', file=sys.stderr)
-            success = False
-            continue
-
-        def entry_pathogen(d, *r):
-            return feed_pathogen(d, e['id'], *r)
-
-        entry_json = entry_pathogen('meta', 'entry.json')
-        if not os.path.exists(entry_json):
-            print(f'skipping {feed_name} {e["id"]}: no metadata')
-            success = False
-            continue
-
-        if e.get('live_status') == 'is_upcoming':
-            print(f'skipping {feed_name} {e["id"]}: is upcoming')
-            continue
-
-        # TODO: more flexible filtering
-        if e['id'].startswith('UC') or e['id'].startswith('UU'):
-            print(f'skipping {feed_name} {e["id"]}: id prefix', file=sys.stderr)
-            continue
-
-        # TODO: more flexible filtering
-        reported_duration = e.get('duration')
-        if reported_duration and reported_duration < 160:
-            print(f'skipping {feed_name} {e["id"]}: < 160s', file=sys.stderr)
-            continue
-
-        for profile in config['profiles']:
-            if profile not in feed_cfg['profiles']:
-                continue
-
-            status = f'{feed_name}@{profile}: {i}/{len(entries)} {e["id"]}'
-            proctitle(f'checking {status}')
-            print(f'checking {status}', file=sys.stderr)
-
-            try:
-                if e.get('live_status') == 'is_live':
-                    if _live_enabled(status, config, profile):
-                        video = config['profiles'][profile]['video']
-                        start_process(f'stream_then_dl {e["id"]} {profile}',
-                                      stream_then_download,
-                                      config, feed_name,
-                                      e, entry_pathogen,
-                                      profile, video)
-                else:
-                    download(config, feed_name, entry_pathogen, profile,
-                             retries=1)
-            except Exception as ex:
-                proctitle(f'ERROR {status}')
-                print(f'ERROR {status}', file=sys.stderr)
-                traceback.print_exception(ex)
-                sleep('ERROR', config=config)
-                success = False
+    due = jobs.revisit_due(db, feed_name, feed_cfg['revisit_seconds'])
+    if not due and not only_live:
+        return
+    proctitle(f'revisiting {feed_name}...')
 
-    # Mark feed as processed
-    if success:
-        os.rename(downloaded_marker_file_tmp, downloaded_marker_file)
+    with open(feed_json_path) as f:
+        entries = [e for e in json.load(f)['entries'] if e is not None]
+    if not due:  # just pick up upcoming livestreams after a restart
+        entries = [e for e in entries
+                   if e.get('live_status') in ('is_upcoming', 'is_live')]
+    print(f'{feed_name}: queueing {len(entries)} entries', file=sys.stderr)
+    jobs.enqueue(db, feed_name,
+                 demand.plan(config, feed_name, entries, base=-1))
+    if due:
+        jobs.mark_revisited(db, feed_name)
+
+
+def _triage(config, feed_filters, job):
+    """Handle what can be handled in-process, tell if a download is due."""
+    def entry_pathogen(d, *r):
+        return os.path.join(config['paths'][d], job.feed, job.entry_id, *r)
+
+    try:
+        with open(entry_pathogen('meta', 'entry.json')) as f:
+            e = json.load(f)
+    except FileNotFoundError:
+        print(f'skipping {job.feed} {job.entry_id}: no metadata',
+              file=sys.stderr)
+        return False
+
+    # safety net, the crawler should've filtered these out already
+    rejection_reason = feed_filters[job.feed](e)
+    if rejection_reason:
+        print(f'skipping {job.feed} {e["id"]}: {rejection_reason}',
+              file=sys.stderr)
+        return False
+
+    if e.get('live_status') in ('is_upcoming', 'is_live'):
+        _schedule_live(config, job.feed, e, entry_pathogen)
+        return False
+
+    if job.profile not in config['feeds'][job.feed]['profiles']:
+        return False  # config has changed since
+
+    return True
+
+
+def _leased(config, job):
+    """Tell if some downloader is still working on a claimed job."""
+    return leases.held(config, jobs.lease_name(job)) is not None
 
 
 def main(config):
     proctitle('spinning up...')
+    feed_filters = compile_filters(config)
+    db = jobs.connect(config)
+    jobs.migrate(config)
+    jobs.recover(db, lambda job: _leased(config, job))
+    pool = DownloadPool(config, db,
+                        lambda job: _triage(config, feed_filters, job))
+    pp_pool = PostProcessPool(config, db)
+
+    def alive(job):
+        return pool.runs(job) or pp_pool.runs(job) or _leased(config, job)
+
+    first_pass = True  # pick up upcoming livestreams after a restart
+    next_pass = 0
+    bandwidth.log_budget(config)
+    finalize.check_layout(config)
+    bw_usage = bandwidth.usage(config)
     while True:
-        feeds = list(config['feeds'])
-        for feed in shuffled(feeds):
-            download_feed(config, feed)
-            proctitle()
-        sleep('just chilling', config=config)
+        if time.time() >= next_pass:
+            feeds = list(config['feeds'])
+            for feed in shuffled(feeds):
+                download_feed(config, feed, db, only_live=first_pass)
+            first_pass = False
+            resume.gc(config, db)
+            jobs.recover(db, alive)
+            reap()
+            print(f'jobs: {jobs.count(db)}', file=sys.stderr)
+            prev_bw_usage, bw_usage = bw_usage, bandwidth.usage(config)
+            print(f'bandwidth: {bandwidth.report(prev_bw_usage, bw_usage)}',
+                  file=sys.stderr)
+            next_pass = (time.time() + config['limits']['throttle_seconds'] +
+                         random.random() *
+                         config['limits']['throttle_variance_seconds'])
+        pool.step()
+        pp_pool.step()
+        proctitle(f'{len(pool.running)} downloading, '
+                  f'{len(pp_pool.running)} processing')
+        time.sleep(1)
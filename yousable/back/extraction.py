@@ -0,0 +1,80 @@
+# SPDX-FileCopyrightText: 2024 Alexander Sosedkin <monk@unboiled.info>
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+# Extracting the info of an entry once for all of its profiles:
+# the unprocessed extractor result is cached for a while,
+# each profile then selects and sorts formats according to its own options.
+# Media URLs can be tied to the address they were extracted from,
+# so the downloads reuse the proxy the extraction went through.
+
+import contextlib
+import fcntl
+import glob
+import json
+import os
+import sys
+import time
+
+import yt_dlp
+
+from yousable.utils import dl_options, entry_url
+
+
+EXTRACTED = 'extracted.json'
+
+
+@contextlib.contextmanager
+def _locked(path):
+    with open(path + '.lock', 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _fresh(config, path):
+    try:
+        age = time.time() - os.stat(path).st_mtime
+    except FileNotFoundError:
+        return False
+    return age < config['limits']['extraction_ttl_seconds']
+
+
+def extract(config, entry_pathogen, entry_info, log_name):
+    """
+    Return the proxy used and the unprocessed info of an entry,
+    reusing an extraction made for another profile if it's recent enough.
+    """
+    path = entry_pathogen('tmp', EXTRACTED)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with _locked(path):  # let the other profiles wait and reuse it
+        if _fresh(config, path):
+            with open(path) as f:
+                extracted = json.load(f)
+            print(f'{log_name} reusing the extracted info', file=sys.stderr)
+            return extracted['proxy'], extracted['info']
+        opts = {
+            'quiet': True,
+            'sleep_interval_requests':
+                config['limits']['throttle_extra_seconds'],
+            **dl_options(config, 'all'),
+        }
+        with yt_dlp.YoutubeDL(opts) as ydl:
+            info = ydl.extract_info(entry_url(entry_info), download=False,
+                                    process=False)
+            info = ydl.sanitize_info(info, remove_private_keys=True)
+        with open(path + '.tmp', 'w') as f:
+            json.dump({'proxy': opts.get('proxy'), 'info': info}, f)
+        os.rename(path + '.tmp', path)
+        return opts.get('proxy'), info
+
+
+def gc(config):
+    """Remove the extracted info that is too old to be reused."""
+    for path in glob.glob(os.path.join(config['paths']['tmp'],
+                                       '*', '*', EXTRACTED)):
+        if not _fresh(config, path):
+            os.unlink(path)
+            if os.path.exists(path + '.lock'):
+                os.unlink(path + '.lock')
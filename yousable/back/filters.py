@@ -0,0 +1,106 @@
+# SPDX-FileCopyrightText: 2024 Alexander Sosedkin <monk@unboiled.info>
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+import datetime
+import re
+import time
+
+import yt_dlp
+
+
+def entry_age(entry, now):
+    ts = entry.get('release_timestamp') or entry.get('timestamp')
+    if ts:
+        return now - ts
+    if entry.get('upload_date'):
+        udts = datetime.datetime.strptime(entry['upload_date'], '%Y%m%d')
+        udts = udts.replace(tzinfo=datetime.timezone.utc)
+        # upload_date coarseness, err on the side of keeping
+        return now - udts.timestamp() - 86400
+
+
+def _is_short(entry):
+    url = (entry.get('original_url') or entry.get('webpage_url') or
+           entry.get('url') or '')
+    if '/shorts/' in url:
+        return True
+    duration, width, height = (entry.get('duration'),
+                               entry.get('width'), entry.get('height'))
+    return bool(duration and duration <= 60 and
+                width and height and height > width)
+
+
+def compile_filter(spec):
+    """
+    Turn a `filters` config section into a function
+    that returns a reason to reject an entry or None to accept it.
+    """
+    checks = []
+
+    for prefix in spec['id_prefix_reject']:
+        checks.append(lambda e, now, prefix=prefix:
+                      e['id'].startswith(prefix) and f'id prefix {prefix}')
+
+    if spec['min_duration']:
+        min_duration = spec['min_duration']
+        checks.append(lambda e, now:
+                      e.get('duration') and e['duration'] < min_duration
+                      and f'< {min_duration}s')
+
+    if spec['max_duration']:
+        max_duration = spec['max_duration']
+        checks.append(lambda e, now:
+                      e.get('duration') and e['duration'] > max_duration
+                      and f'> {max_duration}s')
+
+    if spec['max_age_seconds']:
+        max_age = spec['max_age_seconds']
+        def check_age(e, now):
+            age = entry_age(e, now)
+            return age is not None and age > max_age and f'{int(age)}s old'
+        checks.append(check_age)
+
+    if spec['title_match']:
+        title_match = re.compile(spec['title_match'])
+        checks.append(lambda e, now:
+                      not title_match.search(e.get('title') or '')
+                      and 'title mismatch')
+
+    if spec['title_reject']:
+        title_reject = re.compile(spec['title_reject'])
+        checks.append(lambda e, now:
+                      title_reject.search(e.get('title') or '')
+                      and 'title rejected')
+
+    if spec['live_status_reject']:
+        live_status_reject = frozenset(spec['live_status_reject'])
+        checks.append(lambda e, now:
+                      e.get('live_status') in live_status_reject
+                      and f'{e["live_status"]}')
+
+    if spec['availability_reject']:
+        availability_reject = frozenset(spec['availability_reject'])
+        checks.append(lambda e, now:
+                      e.get('availability') in availability_reject
+                      and f'{e["availability"]}')
+
+    if spec['reject_shorts']:
+        checks.append(lambda e, now: _is_short(e) and 'short')
+
+    if spec['match_filter']:
+        match_filter = yt_dlp.utils.match_filter_func(spec['match_filter'])
+        checks.append(lambda e, now: match_filter(e, incomplete=False))
+
+    def rejection_reason(entry, now=None):
+        now = now if now is not None else time.time()
+        for check in checks:
+            reason = check(entry, now)
+            if reason:
+                return reason
+
+    return rejection_reason
+
+
+def compile_filters(config):
+    return {feed: compile_filter(config['feeds'][feed]['filters'])
+            for feed in config['feeds']}
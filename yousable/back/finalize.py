@@ -0,0 +1,145 @@
+# SPDX-FileCopyrightText: 2024 Alexander Sosedkin <monk@unboiled.info>
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+# Moving finished files from paths.tmp to where they belong
+# without copying them byte by byte through userspace if it can be helped:
+# rename if on the same filesystem, else reflink, else copy_file_range,
+# staging next to the destination and renaming it into place at the end.
+# If paths.tmp isn't on the same filesystem as paths.out, the media
+# is made in a staging directory in paths.out to begin with
+# (the bookkeeping stays in paths.tmp), so that finishing it is a rename.
+
+import errno
+import fcntl
+import functools
+import os
+import shutil
+import sys
+import time
+
+
+FICLONE = 0x40049409  # _IOW(0x94, 9, int) from linux/fs.h
+UNSUPPORTED = (errno.EXDEV, errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL,
+               errno.ENOSYS, errno.EBADF, errno.EPERM)
+STAGING = '.{profile}.staging'  # in the entry directory in paths.out
+
+
+def _device(path):
+    path = os.path.abspath(path)
+    while not os.path.exists(path):  # not created yet, look at the parent
+        parent = os.path.dirname(path)
+        if parent == path:
+            break
+        path = parent
+    return os.stat(path).st_dev
+
+
+@functools.lru_cache
+def _same_filesystem(path1, path2):
+    return _device(path1) == _device(path2)
+
+
+def check_layout(config):
+    """Warn if finishing a download would have to copy it."""
+    paths = config['paths']
+    if not _same_filesystem(paths['tmp'], paths['out']):
+        print('paths.tmp and paths.out are on different filesystems, '
+              'downloads will be staged in paths.out', file=sys.stderr)
+    for d in ('sources', 'store'):
+        if paths[d] and not _same_filesystem(paths['out'], paths[d]):
+            print(f'WARNING: paths.out and paths.{d} are on different '
+                  'filesystems, files will be reflinked if possible '
+                  'or copied otherwise', file=sys.stderr)
+
+
+def staging(config, entry_pathogen, profile, *rest):
+    """
+    Where the media of a download is made: paths.tmp if finishing it
+    from there is a rename, a hidden directory in paths.out otherwise.
+    """
+    if _same_filesystem(config['paths']['tmp'], config['paths']['out']):
+        return entry_pathogen('tmp', profile, *rest)
+    return entry_pathogen('out', STAGING.format(profile=profile), *rest)
+
+
+def cleanup(config, entry_pathogen, profile):
+    """Remove the working directories of a download."""
+    for d in {entry_pathogen('tmp', profile),
+              staging(config, entry_pathogen, profile)}:
+        shutil.rmtree(d, ignore_errors=True)
+
+
+def _reflink(src_f, dst_f):
+    fcntl.ioctl(dst_f.fileno(), FICLONE, src_f.fileno())
+
+
+def _copy_file_range(src_f, dst_f):
+    size = os.fstat(src_f.fileno()).st_size
+    copied = 0
+    while copied < size:
+        n = os.copy_file_range(src_f.fileno(), dst_f.fileno(), size - copied)
+        if not n:  # some filesystem combinations give up early
+            raise OSError(errno.EOPNOTSUPP,
+                          f'copy_file_range stopped at {copied}/{size}')
+        copied += n
+
+
+def _copy(src_f, dst_f):
+    shutil.copyfileobj(src_f, dst_f)  # sendfile() on Linux
+
+
+STRATEGIES = (('reflink', _reflink),
+              ('copy_file_range', _copy_file_range),
+              ('copy', _copy))
+
+
+def clone(src, dst):
+    """
+    Make a copy of `src` at `dst`, as cheap a one as the filesystems allow.
+    Returns the name of the strategy used.
+    """
+    staging = os.path.join(os.path.dirname(dst),
+                           f'.{os.path.basename(dst)}.staging')
+    try:
+        with open(src, 'rb') as src_f, open(staging, 'wb') as dst_f:
+            for name, strategy in STRATEGIES:
+                try:
+                    strategy(src_f, dst_f)
+                    break
+                except OSError as ex:
+                    if ex.errno not in UNSUPPORTED or name == 'copy':
+                        raise
+                    src_f.seek(0)
+                    dst_f.seek(0)
+                    dst_f.truncate()
+            os.fsync(dst_f.fileno())
+            src_size = os.fstat(src_f.fileno()).st_size
+            dst_size = os.fstat(dst_f.fileno()).st_size
+            if dst_size != src_size:
+                raise OSError(errno.EIO, f'copied {dst_size} bytes '
+                                         f'of {src_size} with {name}')
+        shutil.copystat(src, staging)
+        os.replace(staging, dst)
+    except BaseException:
+        if os.path.exists(staging):
+            os.unlink(staging)
+        raise
+    return name
+
+
+def move(src, dst, log_name=None):
+    """Move a file, logging how and how long it took if it wasn't a rename."""
+    start = time.time()
+    try:
+        os.rename(src, dst)
+        return 'rename'
+    except OSError as ex:
+        if ex.errno != errno.EXDEV:
+            raise
+    size = os.path.getsize(src)
+    strategy = clone(src, dst)
+    os.unlink(src)
+    duration = time.time() - start
+    print(f'{log_name or dst}: moved {size} bytes with {strategy} '
+          f'in {duration:.1f}s', file=sys.stderr)
+    return strategy
@@ -0,0 +1,134 @@
+# SPDX-FileCopyrightText: 2024 Alexander Sosedkin <monk@unboiled.info>
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+# Adapting the number of fragments fetched in parallel
+# to the throughput achieved and the errors encountered,
+# separately for each profile and proxy.
+# yt-dlp reads the setting when it starts downloading a file,
+# so it changes between files (e.g., video and audio) and downloads.
+
+import random
+import sys
+import time
+
+from yousable.utils import locked_state
+
+
+SMOOTHING = .3  # of the exponentially weighted throughput per concurrency
+GAIN = 1.1  # an extra fragment in flight must speed things up by this much
+EXPLORE = .1  # chance to try one more than the best known
+
+
+def _key(profile, proxy):
+    return f'{profile}@{proxy or "direct"}'
+
+
+def _bounds(config, profile):
+    profile_cfg = config['profiles'][profile]
+    lo = profile_cfg['concurrent_fragments']
+    hi = profile_cfg['concurrent_fragments_max']
+    return lo, max(lo, hi if hi is not None else lo)
+
+
+def concurrency(config, profile, proxy):
+    """How many fragments to fetch in parallel now."""
+    lo, hi = _bounds(config, profile)
+    if lo == hi:
+        return lo
+    with locked_state(config, 'fragments') as state:
+        n = state.get(_key(profile, proxy), {}).get('n', lo)
+    return min(max(n, lo), hi)
+
+
+def _next(n, lo, hi, rates, error_ratio, max_error_ratio):
+    if error_ratio > max_error_ratio:
+        return max(lo, n // 2)
+    fewer = rates.get(str(n - 1))
+    if n < hi and (fewer is None or rates[str(n)] > fewer * GAIN):
+        return n + 1  # still paying off
+    top = max(rates.values())  # settle on the fewest that get close to it
+    best = min(int(k) for k, rate in rates.items() if rate * GAIN >= top)
+    if best < hi and random.random() < EXPLORE:
+        return best + 1  # conditions might have changed
+    return best
+
+
+def _learn(config, profile, proxy, n, rate, error_ratio):
+    lo, hi = _bounds(config, profile)
+    with locked_state(config, 'fragments') as state:
+        s = state.setdefault(_key(profile, proxy), {'n': n, 'rates': {}})
+        prev = s['rates'].get(str(n))
+        s['rates'][str(n)] = (rate if prev is None
+                              else prev + SMOOTHING * (rate - prev))
+        s['n'] = _next(n, lo, hi, s['rates'], error_ratio,
+                       config['limits']['fragment_error_ratio'])
+        return s['n']
+
+
+def options(config, profile, proxy, controller):
+    """yt-dlp options for a download watched by `controller`."""
+    if 'concurrent_fragment_downloads' in \
+            config['profiles'][profile]['download']:
+        return {'logger': controller}  # set by hand, just log the rates
+    return {'logger': controller,
+            'concurrent_fragment_downloads':
+                concurrency(config, profile, proxy)}
+
+
+class Controller:
+    """
+    Watches a download through a progress hook and a logger,
+    learns from each fragmented file and applies the outcome right away.
+    """
+
+    def __init__(self, config, profile, log_name):
+        self.config, self.profile, self.log_name = config, profile, log_name
+        self.ydl = None
+        self.errors = 0
+        self.started = {}  # filename -> (time, errors, downloaded bytes)
+        self.counts = {}  # filename -> fragments
+
+    def attach(self, ydl):
+        self.ydl = ydl
+
+    def progress_hook(self, d):
+        filename = d['filename']
+        if d['status'] == 'downloading':
+            self.started.setdefault(filename, (time.time(), self.errors,
+                                               d.get('downloaded_bytes', 0)))
+            if d.get('fragment_count'):
+                self.counts[filename] = d['fragment_count']
+        if d['status'] != 'finished' or filename not in self.started:
+            return
+        start, errors_before, resumed_at = self.started.pop(filename)
+        count = self.counts.pop(filename, None)
+        if not count or self.ydl is None:
+            return  # not a fragmented download
+        lo, hi = _bounds(self.config, self.profile)
+        n = self.ydl.params.get('concurrent_fragment_downloads', 1)
+        size = d.get('total_bytes') or d.get('downloaded_bytes') or 0
+        rate = (size - resumed_at) / max(time.time() - start, .001)
+        error_ratio = (self.errors - errors_before) / count
+        print(f'{self.log_name}: {count} fragments {n} at a time '
+              f'at {rate / 1e3:.0f}kB/s, {error_ratio:.0%} errors',
+              file=sys.stderr)
+        if lo == hi:
+            return
+        n_next = _learn(self.config, self.profile,
+                        self.ydl.params.get('proxy'), n, rate, error_ratio)
+        if n_next != n:
+            print(f'{self.log_name}: switching to {n_next} fragments '
+                  'at a time', file=sys.stderr)
+            self.ydl.params['concurrent_fragment_downloads'] = n_next
+
+    # to be passed as yt-dlp's logger, counting the fragment errors
+
+    def debug(self, msg):
+        if msg.startswith('[download] Got error'):
+            self.errors += 1
+
+    def warning(self, msg):
+        print(f'WARNING: {msg}', file=sys.stderr)
+
+    def error(self, msg):
+        print(msg, file=sys.stderr)
@@ -0,0 +1,293 @@
+# SPDX-FileCopyrightText: 2024 Alexander Sosedkin <monk@unboiled.info>
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+# A persistent queue of (feed, entry, profile) download jobs,
+# filled by the crawler and drained by the downloader in two stages:
+# queued -> running (fetching) -> fetched -> processing -> done,
+# falling back to queued on errors, then to failed if they persist.
+# The cleaner marks the ones it has removed to save space as evicted.
+
+import collections
+import contextlib
+import math
+import os
+import sqlite3
+import sys
+import time
+
+
+Job = collections.namedtuple('Job', ('feed', 'entry_id', 'profile', 'origin',
+                                     'priority'))
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    feed TEXT NOT NULL,
+    entry_id TEXT NOT NULL,
+    profile TEXT NOT NULL,
+    origin TEXT NOT NULL,
+    state TEXT NOT NULL DEFAULT 'queued',  -- see the header
+    dirty INTEGER NOT NULL DEFAULT 0,  -- entry changed while running
+    priority REAL NOT NULL DEFAULT 0,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_try REAL NOT NULL DEFAULT 0,
+    updated REAL NOT NULL DEFAULT 0,
+    PRIMARY KEY (feed, entry_id, profile)
+);
+CREATE INDEX IF NOT EXISTS jobs_pending
+    ON jobs (state, priority DESC, next_try);
+CREATE TABLE IF NOT EXISTS feeds (
+    feed TEXT PRIMARY KEY,
+    revisited REAL NOT NULL
+);
+'''
+
+PENDING = ('queued', 'running', 'fetched', 'processing')
+CLAIMED = {'queued': 'running', 'fetched': 'processing'}
+
+PRIORITY_LIVE = 1000  # gets triaged even when all the download slots are busy
+PRIORITY_ON_DEMAND = 500  # requested from the front-end, someone's waiting
+
+LEGACY_MARKERS = ('refreshed', 'downloaded', 'downloaded.tmp',
+                  'changes', 'changes.lock')
+
+
+def connect(config):
+    os.makedirs(config['paths']['meta'], exist_ok=True)
+    db = sqlite3.connect(os.path.join(config['paths']['meta'], 'jobs.sqlite'),
+                         timeout=60, isolation_level=None)
+    # WAL needs shared memory, which hosts sharing paths.meta don't have
+    db.execute('PRAGMA journal_mode=' +
+               ('DELETE' if config['limits']['multi_node'] else 'WAL'))
+    db.execute('PRAGMA synchronous=NORMAL')
+    db.executescript(SCHEMA)
+    return db
+
+
+@contextlib.contextmanager
+def _transaction(db):
+    db.execute('BEGIN IMMEDIATE')
+    try:
+        yield
+    except BaseException:
+        db.execute('ROLLBACK')
+        raise
+    db.execute('COMMIT')
+
+
+def priority(entry_info, default=0):
+    if entry_info.get('live_status') in ('is_upcoming', 'is_live'):
+        return PRIORITY_LIVE
+    return default
+
+
+def enqueue(db, feed, entries):
+    """
+    Queue downloads of `entries`
+    ((entry_id, profile, origin, priority) tuples).
+    """
+    now = time.time()
+    with _transaction(db):
+        db.executemany('''
+            INSERT INTO jobs (feed, entry_id, profile, origin,
+                              priority, next_try, updated)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (feed, entry_id, profile) DO UPDATE SET
+                state = CASE
+                    WHEN state IN ('running', 'fetched', 'processing',
+                                   'evicted')
+                    THEN state ELSE 'queued' END,
+                dirty = (state IN ('running', 'processing')),
+                priority = excluded.priority,
+                attempts = 0,
+                next_try = excluded.next_try,
+                updated = excluded.updated
+        ''', [(feed, entry_id, profile, origin, priority, now, now)
+              for entry_id, profile, origin, priority in entries])
+
+
+def claim(db, acceptable, min_priority=None, lookahead=64, state='queued'):
+    """
+    Atomically claim the most important acceptable job
+    waiting in `state` (queued for fetching, fetched for processing).
+    """
+    now = time.time()
+    min_priority = min_priority if min_priority is not None else -math.inf
+    candidates = db.execute('''
+        SELECT feed, entry_id, profile, origin, priority FROM jobs
+        WHERE state = ? AND priority >= ? AND next_try <= ?
+        ORDER BY priority DESC, next_try LIMIT ?
+    ''', (state, min_priority, now, lookahead)).fetchall()
+    for row in candidates:
+        job = Job(*row)
+        if not acceptable(job):
+            continue
+        cur = db.execute('''
+            UPDATE jobs SET state = ?, updated = ?
+            WHERE feed = ? AND entry_id = ? AND profile = ? AND state = ?
+        ''', (CLAIMED[state], now, job.feed, job.entry_id, job.profile,
+              state))
+        if cur.rowcount == 1:
+            return job
+
+
+def finish(db, job, success, limits):
+    now = time.time()
+    key = job.feed, job.entry_id, job.profile
+    with _transaction(db):
+        attempts, dirty = db.execute('''
+            SELECT attempts, dirty FROM jobs
+            WHERE feed = ? AND entry_id = ? AND profile = ?
+        ''', key).fetchone()
+        if dirty:
+            state, attempts, next_try = 'queued', 0, now
+        elif success:
+            state, attempts, next_try = 'done', 0, now
+        else:
+            attempts += 1
+            state = ('failed' if attempts >= limits['retry_attempts']
+                     else 'queued')
+            backoff = limits['retry_seconds'] * 2 ** (attempts - 1)
+            next_try = now + min(backoff, limits['retry_max_seconds'])
+        db.execute('''
+            UPDATE jobs SET state = ?, dirty = 0, attempts = ?,
+                            next_try = ?, updated = ?
+            WHERE feed = ? AND entry_id = ? AND profile = ?
+        ''', (state, attempts, next_try, now, *key))
+    return state
+
+
+def request(db, feed, entry_id, profile, origin, priority):
+    """
+    Queue a job for a file someone has asked for unless it has failed,
+    prioritize it if it's already on its way. Returns the resulting state.
+    """
+    now = time.time()
+    with _transaction(db):
+        state = job_state(db, feed, entry_id, profile)
+        if state == 'failed':
+            return state
+        if state in PENDING:
+            db.execute('''
+                UPDATE jobs SET priority = max(priority, ?)
+                WHERE feed = ? AND entry_id = ? AND profile = ?
+            ''', (priority, feed, entry_id, profile))
+            return state
+        db.execute('''
+            INSERT INTO jobs (feed, entry_id, profile, origin,
+                              priority, next_try, updated)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (feed, entry_id, profile) DO UPDATE SET
+                state = 'queued', dirty = 0, priority = excluded.priority,
+                attempts = 0, next_try = excluded.next_try,
+                updated = excluded.updated
+        ''', (feed, entry_id, profile, origin, priority, now, now))
+    print(f'{feed} {entry_id} {profile}: queued on request', file=sys.stderr)
+    return 'queued'
+
+
+def hand_off(db, job):
+    """Pass a fetched job on to post-processing."""
+    db.execute('''
+        INSERT INTO jobs (feed, entry_id, profile, origin, priority,
+                          state, updated)
+        VALUES (?, ?, ?, ?, ?, 'fetched', ?)
+        ON CONFLICT (feed, entry_id, profile) DO UPDATE SET
+            state = 'fetched', updated = excluded.updated
+    ''', (job.feed, job.entry_id, job.profile, job.origin, job.priority,
+          time.time()))
+
+
+def evict(db, feed, entry_id, profile, origin='unknown'):
+    """Mark a job as not to be downloaded again, its result was removed."""
+    db.execute('''
+        INSERT INTO jobs (feed, entry_id, profile, origin, state, updated)
+        VALUES (?, ?, ?, ?, 'evicted', ?)
+        ON CONFLICT (feed, entry_id, profile) DO UPDATE SET
+            state = 'evicted', updated = excluded.updated
+    ''', (feed, entry_id, profile, origin, time.time()))
+
+
+def forget(db, feed, entry_id=None):
+    """Drop the jobs of a removed entry or of a whole removed feed."""
+    if entry_id is None:
+        db.execute('DELETE FROM jobs WHERE feed = ?', (feed,))
+        db.execute('DELETE FROM feeds WHERE feed = ?', (feed,))
+    else:
+        db.execute('DELETE FROM jobs WHERE feed = ? AND entry_id = ?',
+                   (feed, entry_id))
+
+
+def feeds(db):
+    return [feed for feed, in db.execute('SELECT DISTINCT feed FROM jobs')]
+
+
+def in_flight_elsewhere(db, job):
+    """Tell if the same entry and profile is being done for another feed."""
+    return db.execute('''
+        SELECT 1 FROM jobs
+        WHERE entry_id = ? AND profile = ? AND feed != ?
+              AND state IN ('running', 'fetched', 'processing')
+    ''', (job.entry_id, job.profile, job.feed)).fetchone() is not None
+
+
+def job_state(db, feed, entry_id, profile):
+    row = db.execute('''
+        SELECT state FROM jobs WHERE feed = ? AND entry_id = ? AND profile = ?
+    ''', (feed, entry_id, profile)).fetchone()
+    return row[0] if row else None
+
+
+def count(db):
+    return dict(db.execute('SELECT state, count(*) FROM jobs GROUP BY state'))
+
+
+def lease_name(job):
+    """Name of the lease held by whoever is working on a claimed job."""
+    return f'job-{job.feed}-{job.entry_id}-{job.profile}'
+
+
+def recover(db, alive):
+    """
+    Requeue the jobs that were running when their downloader went down,
+    as told by `alive(job)` being false.
+    """
+    unclaimed = {v: k for k, v in CLAIMED.items()}
+    n = 0
+    with _transaction(db):
+        claimed = db.execute('''
+            SELECT feed, entry_id, profile, origin, priority, state FROM jobs
+            WHERE state IN ('running', 'processing')
+        ''').fetchall()
+        for *row, state in claimed:
+            job = Job(*row)
+            if not alive(job):
+                db.execute('''
+                    UPDATE jobs SET state = ?
+                    WHERE feed = ? AND entry_id = ? AND profile = ?
+                ''', (unclaimed[state], job.feed, job.entry_id, job.profile))
+                n += 1
+    if n:
+        print(f'requeued {n} interrupted jobs', file=sys.stderr)
+
+
+def revisit_due(db, feed, revisit_seconds):
+    row = db.execute('SELECT revisited FROM feeds WHERE feed = ?',
+                     (feed,)).fetchone()
+    return row is None or row[0] + revisit_seconds < time.time()
+
+
+def mark_revisited(db, feed):
+    db.execute('''
+        INSERT INTO feeds (feed, revisited) VALUES (?, ?)
+        ON CONFLICT (feed) DO UPDATE SET revisited = excluded.revisited
+    ''', (feed, time.time()))
+
+
+def migrate(config):
+    """Drop the marker files that used to track the state of the feeds."""
+    for feed in config['feeds']:
+        for marker in LEGACY_MARKERS:
+            path = os.path.join(config['paths']['meta'], feed, marker)
+            if os.path.exists(path):
+                print(f'{feed}: removing legacy {marker}', file=sys.stderr)
+                os.unlink(path)
@@ -0,0 +1,171 @@
+# SPDX-FileCopyrightText: 2024 Alexander Sosedkin <monk@unboiled.info>
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+# Leases on shared storage, so that several hosts can run the back-end
+# against the same paths without doing the same work twice.
+# A lease is a small JSON file in paths.meta/leases naming its holder
+# and when it expires; it's only read and written under a POSIX lock,
+# which NFS and CephFS honour across hosts, unlike mtimes and markers.
+# A holder has to renew its lease in time; once it doesn't,
+# because the process or the whole host went down, someone else takes over.
+# Expiry times are compared across hosts, so their clocks must be in sync.
+
+import contextlib
+import fcntl
+import json
+import os
+import socket
+import sys
+import threading
+import time
+import urllib.parse
+
+
+def holder():
+    """Identify the current process across the hosts."""
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+def _dir(config):
+    return os.path.join(config['paths']['meta'], 'leases')
+
+
+def _path(config, name):
+    return os.path.join(_dir(config), urllib.parse.quote(name, safe=''))
+
+
+@contextlib.contextmanager
+def _locked(path):
+    """Open and lock a lease file, making sure it's not been removed."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    while True:
+        with open(path, 'a+') as f:
+            fcntl.lockf(f, fcntl.LOCK_EX)
+            try:
+                try:
+                    current = (os.fstat(f.fileno()).st_ino ==
+                               os.stat(path).st_ino)
+                except FileNotFoundError:
+                    current = False
+                if current:  # not removed by gc meanwhile
+                    f.seek(0)
+                    yield f
+                    f.flush()
+                    return
+            finally:
+                fcntl.lockf(f, fcntl.LOCK_UN)
+
+
+def _read(f):
+    try:
+        return json.loads(f.read() or '{}')
+    except json.JSONDecodeError:
+        return {}
+
+
+def _write(f, lease):
+    f.seek(0)
+    f.truncate()
+    f.write(json.dumps(lease))
+
+
+def _alive(lease, now):
+    """Tell whether the lease is still held by somebody."""
+    if not lease.get('holder') or lease['expires'] < now:
+        return False
+    host, pid = lease['holder'].rsplit(':', 1)
+    if host == socket.gethostname():  # no need to wait for it to expire
+        try:
+            os.kill(int(pid), 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+    return True
+
+
+def acquire(config, name, ttl, by=None):
+    """Take or renew a lease for `ttl` seconds, tell if that worked."""
+    by = by or holder()
+    now = time.time()
+    with _locked(_path(config, name)) as f:
+        lease = _read(f)
+        if lease.get('holder') != by and _alive(lease, now):
+            return False
+        if lease.get('holder') not in (None, by):
+            print(f'lease {name}: taking over from {lease["holder"]}',
+                  file=sys.stderr)
+        _write(f, {'holder': by, 'expires': now + ttl})
+        return True
+
+
+def renew(config, name, ttl, by=None):
+    """Extend a lease held, tell if it's still ours."""
+    by = by or holder()
+    now = time.time()
+    with _locked(_path(config, name)) as f:
+        lease = _read(f)
+        if lease.get('holder') != by:
+            print(f'lease {name}: lost to {lease.get("holder")}',
+                  file=sys.stderr)
+            return False
+        _write(f, {'holder': by, 'expires': now + ttl})
+        return True
+
+
+def release(config, name, by=None):
+    by = by or holder()
+    with _locked(_path(config, name)) as f:
+        if _read(f).get('holder') == by:
+            _write(f, {})
+
+
+@contextlib.contextmanager
+def kept(config, name, ttl):
+    """
+    Hold a lease over a block, renewing it in a thread every `ttl` / 3;
+    yields whether it's been acquired.
+    """
+    if not acquire(config, name, ttl):
+        yield False
+        return
+    done = threading.Event()
+
+    def renewing():
+        while not done.wait(ttl / 3):
+            if not renew(config, name, ttl):
+                return
+
+    renewer = threading.Thread(target=renewing, daemon=True)
+    renewer.start()
+    try:
+        yield True
+    finally:
+        done.set()
+        renewer.join()
+        release(config, name)
+
+
+def held(config, name):
+    """Return the holder of a lease or None if it's free."""
+    if not os.path.exists(_path(config, name)):
+        return None
+    with _locked(_path(config, name)) as f:
+        lease = _read(f)
+    return lease['holder'] if _alive(lease, time.time()) else None
+
+
+def gc(config):
+    """Remove the files of the leases that have been free for a while."""
+    try:
+        names = os.listdir(_dir(config))
+    except FileNotFoundError:
+        return
+    now = time.time()
+    for fname in names:
+        path = os.path.join(_dir(config), fname)
+        with _locked(path) as f:
+            lease = _read(f)
+            if (not _alive(lease, now) and
+                    os.fstat(f.fileno()).st_mtime < now - 86400):
+                os.unlink(path)
@@ -0,0 +1,261 @@
+# SPDX-FileCopyrightText: 2024 Alexander Sosedkin <monk@unboiled.info>
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+import os
+import subprocess
+import sys
+import threading
+import time
+import traceback
+
+import yousable.back.bandwidth as bandwidth
+import yousable.back.jobs as jobs
+import yousable.back.leases as leases
+import yousable.back.store as store
+from yousable.back.derive import derivation_source
+from yousable.back.download import fetch, postprocess, HANDOFF
+from yousable.utils import start_process, proctitle, sleep
+
+
+def _entry_pathogen(config, job):
+    def entry_pathogen(d, *r):
+        return os.path.join(config['paths'][d], job.feed, job.entry_id, *r)
+    return entry_pathogen
+
+
+def _fetch_job(config, job):
+    status = f'{job.feed}@{job.profile}: {job.entry_id}'
+    try:
+        fetch(config, job.feed, _entry_pathogen(config, job), job.profile,
+              bandwidth_class='download' if job.priority >= 0 else 'backfill')
+    except Exception as ex:
+        proctitle(f'ERROR {status}')
+        print(f'ERROR {status}', file=sys.stderr)
+        traceback.print_exception(ex)
+        sleep('ERROR', config=config)  # hold the slot for a while
+        sys.exit(1)
+
+
+def _deprioritize(limits):
+    os.nice(limits['postprocess_nice'])
+    if limits['postprocess_ionice_class'] is not None:
+        try:
+            subprocess.run(['ionice',
+                            '-c', str(limits['postprocess_ionice_class']),
+                            '-p', str(os.getpid())], check=True)
+        except (OSError, subprocess.CalledProcessError) as ex:
+            print(f'could not ionice: {ex}', file=sys.stderr)
+
+
+def _postprocess_job(config, job):
+    status = f'{job.feed}@{job.profile}: {job.entry_id}'
+    _deprioritize(config['limits'])
+    try:
+        if not postprocess(config, job.feed, _entry_pathogen(config, job),
+                           job.profile):
+            sys.exit(1)  # too short, to be fetched again
+    except Exception as ex:
+        proctitle(f'ERROR {status}')
+        print(f'ERROR {status}', file=sys.stderr)
+        traceback.print_exception(ex)
+        sys.exit(1)
+
+
+class _Pool:
+    """
+    Runs claimed jobs in separate processes, kills stuck ones.
+    Holds a lease on each job it runs, so that the other hosts
+    leave them alone as long as this one is up;
+    the leases are renewed from a thread, so that they don't expire
+    while the main loop is busy with something else for a while.
+    """
+
+    kind = None
+
+    def __init__(self, config, db):
+        self.config = config
+        self.limits = config['limits']
+        self.db = db
+        self.running = {}  # job -> (process, start time)
+        self.lost = set()  # jobs whose leases have been taken over
+        self.lock = threading.Lock()  # no renewing a lease being released
+        threading.Thread(target=self._renewing, daemon=True).start()
+
+    def _claim(self, acceptable, **kwargs):
+        leased = []
+
+        def acceptable_and_leased(job):
+            if not acceptable(job) or not leases.acquire(
+                    self.config, jobs.lease_name(job),
+                    self.limits['lease_seconds']):
+                return False
+            leased.append(job)
+            return True
+
+        job = jobs.claim(self.db, acceptable_and_leased, **kwargs)
+        for other in leased:  # claimed by someone else after all
+            if other != job:
+                leases.release(self.config, jobs.lease_name(other))
+        return job
+
+    def _release(self, job):
+        leases.release(self.config, jobs.lease_name(job))
+
+    def _renewing(self):
+        ttl = self.limits['lease_seconds']
+        while True:
+            time.sleep(ttl / 3)
+            for job in list(self.running):
+                with self.lock:
+                    if (job in self.running and job not in self.lost and
+                            not leases.renew(self.config,
+                                             jobs.lease_name(job), ttl)):
+                        self.lost.add(job)
+
+    def _forget(self, job):
+        with self.lock:
+            del self.running[job]
+            self.lost.discard(job)
+
+    def _terminate_lost(self):
+        for job in list(self.lost):
+            p, _ = self.running[job]
+            print(f'{job.feed}@{job.profile} {job.entry_id}: '
+                  f'{self.kind} taken over, terminating', file=sys.stderr)
+            p.terminate()
+            p.join()
+            self._forget(job)
+
+    def runs(self, job):
+        """Tell if the job is being run by this pool."""
+        return any(jobs.lease_name(job) == jobs.lease_name(running)
+                   for running in list(self.running))
+
+    def _count_running(self, **kwargs):
+        return sum(all(getattr(job, k) == v for k, v in kwargs.items())
+                   for job in self.running)
+
+    def _finished(self, job, exitcode, duration):
+        state = jobs.finish(self.db, job, exitcode == 0, self.limits)
+        self._log(job, exitcode, duration, state)
+
+    def _log(self, job, exitcode, duration, state):
+        print(f'{job.feed}@{job.profile} {job.entry_id}: {self.kind} '
+              f'exited with {exitcode} in {duration:.1f}s, {state}',
+              file=sys.stderr)
+
+    def _reap(self, now):
+        for job, (p, started) in list(self.running.items()):
+            if (p.exitcode is None and
+                    now > started + self.limits['download_timeout_seconds']):
+                print(f'{job.feed}@{job.profile} {job.entry_id}: '
+                      f'{self.kind} timed out, terminating', file=sys.stderr)
+                p.terminate()
+                p.join()
+            if p.exitcode is not None:
+                p.join()
+                self._forget(job)
+                self._finished(job, p.exitcode, now - started)
+                self._release(job)
+
+
+class DownloadPool(_Pool):
+    """
+    Claims jobs from the job queue and fetches them in separate processes,
+    limiting how many of them run at once globally, per feed and per origin.
+    Spacing out the requests is left to `yousable.utils.throttle`.
+    `triage(job)` can handle a job in-process and return False
+    to mark it done without starting a download.
+    Fetched jobs are handed off to a `PostProcessPool`;
+    when too many of them pile up there, only live ones are claimed.
+    """
+
+    kind = 'fetching'
+
+    def __init__(self, config, db, triage):
+        super().__init__(config, db)
+        self.triage = triage
+
+    def _waits_for_source(self, job):
+        source = derivation_source(self.config, job.feed, job.profile)
+        if source is not None:
+            return jobs.job_state(self.db, job.feed, job.entry_id,
+                                  source) in jobs.PENDING
+        return False
+
+    def _can_start(self, job):
+        return (not self._waits_for_source(job) and
+                not (store.enabled(self.config) and  # wait and reuse
+                     jobs.in_flight_elsewhere(self.db, job)) and
+                not (job.priority < jobs.PRIORITY_LIVE and
+                     bandwidth.over_quota(self.config, job.feed)) and
+                self._count_running(feed=job.feed) <
+                    self.limits['downloads_per_feed'] and
+                self._count_running(origin=job.origin) <
+                    self.limits['downloads_per_origin'])
+
+    def _finished(self, job, exitcode, duration):
+        handoff = _entry_pathogen(self.config, job)('tmp', job.profile,
+                                                    HANDOFF)
+        if exitcode == 0 and os.path.exists(handoff):
+            jobs.hand_off(self.db, job)
+            self._log(job, exitcode, duration, 'fetched')
+        else:
+            super()._finished(job, exitcode, duration)
+
+    def _backlog(self):
+        c = jobs.count(self.db)
+        return c.get('fetched', 0) + c.get('processing', 0)
+
+    def step(self):
+        now = time.time()
+        self._reap(now)
+        self._terminate_lost()
+        while True:
+            slots_busy = (len(self.running) >= self.limits['downloads'] or
+                          self._backlog() >= self.limits['postprocess_queue'])
+            job = self._claim(self._can_start,
+                              min_priority=(jobs.PRIORITY_LIVE if slots_busy
+                                            else None))
+            if job is None:
+                break
+            try:
+                needs_download = self.triage(job)
+            except Exception as ex:
+                print(f'ERROR triaging {job}', file=sys.stderr)
+                traceback.print_exception(ex)
+                jobs.finish(self.db, job, False, self.limits)
+                self._release(job)
+                continue
+            if not needs_download:
+                jobs.finish(self.db, job, True, self.limits)
+                self._release(job)
+                continue
+            p = start_process(f'dl {job.entry_id} {job.profile}',
+                              _fetch_job, self.config, job)
+            self.running[job] = p, now
+
+
+class PostProcessPool(_Pool):
+    """
+    Claims fetched jobs and post-processes them in separate processes
+    at a lower CPU and IO priority, one per CPU unless configured otherwise.
+    """
+
+    kind = 'processing'
+
+    def __init__(self, config, db):
+        super().__init__(config, db)
+        self.size = self.limits['postprocesses'] or os.cpu_count() or 1
+
+    def step(self):
+        now = time.time()
+        self._reap(now)
+        self._terminate_lost()
+        while len(self.running) < self.size:
+            job = self._claim(lambda job: True, state='fetched')
+            if job is None:
+                break
+            p = start_process(f'pp {job.entry_id} {job.profile}',
+                              _postprocess_job, self.config, job)
+            self.running[job] = p, now
@@ -0,0 +1,385 @@
+# SPDX-FileCopyrightText: 2024 Alexander Sosedkin <monk@unboiled.info>
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+# Telling the duration of media files without spawning ffprobe:
+# MPEG-TS and (fragmented) ISO BMFF are parsed in-process,
+# reading just the headers and the ends of the growing livestream files,
+# the formats mutagen knows are left to it, the rest goes to ffprobe.
+# Results are cached by (path, size, mtime).
+
+import collections
+import os
+import struct
+import sys
+
+import ffmpeg
+import mutagen
+
+
+CACHE_SIZE = 1024
+TS_PACKET = 188
+TS_SCAN_BYTES = (256 * 1024, 4 * 1024 * 1024)  # from the ends, if not enough
+PTS_WRAP = 1 << 33
+
+_cache = collections.OrderedDict()  # path -> (size, mtime_ns, duration)
+stats = collections.Counter()  # method -> times used
+
+
+# MPEG-TS
+
+def _ts_sync(data):
+    for i in range(min(TS_PACKET, len(data))):
+        if all(data[j] == 0x47
+               for j in range(i, min(len(data), i + 3 * TS_PACKET),
+                              TS_PACKET)):
+            return i
+
+
+def _ts_timestamps(data):
+    """(pid, pts) of the PES packets starting in `data`."""
+    start = _ts_sync(data)
+    if start is None:
+        return
+    for i in range(start, len(data) - TS_PACKET + 1, TS_PACKET):
+        p = data[i:i + TS_PACKET]
+        if p[0] != 0x47 or not p[1] & 0x40:  # not a payload start
+            continue
+        pid = (p[1] & 0x1f) << 8 | p[2]
+        offset = 4
+        if p[3] & 0x20:  # adaptation field
+            offset += 1 + p[4]
+        pes = p[offset:]
+        if (len(pes) < 14 or pes[:3] != b'\0\0\1' or
+                not (0xc0 <= pes[3] <= 0xef or pes[3] == 0xbd) or
+                not pes[7] & 0x80):  # no PTS
+            continue
+        pts = ((pes[9] >> 1 & 0x07) << 30 | pes[10] << 22 |
+               (pes[11] >> 1) << 15 | pes[12] << 7 | pes[13] >> 1)
+        yield pid, pts
+
+
+def _ts_scan(f, offset, length):
+    f.seek(offset)
+    return list(_ts_timestamps(f.read(length)))
+
+
+def _ts_duration(f, size):
+    for scan in TS_SCAN_BYTES:  # a large keyframe can hide the timestamps
+        first, last = {}, {}
+        for pid, pts in _ts_scan(f, 0, scan):
+            first.setdefault(pid, pts)
+        for pid, pts in _ts_scan(f, max(0, size - scan), scan):
+            last[pid] = pts
+        if first and first.keys() == last.keys() or scan >= size:
+            break
+    spans = [(last[pid] - first[pid]) % PTS_WRAP
+             for pid in first if pid in last]
+    return max(spans) / 90000 if spans else None
+
+
+# ISO BMFF
+
+def _box_header(data, offset, end):
+    """(type, payload start, box end) of the box at `offset` in `data`."""
+    if offset + 8 > end:
+        return None
+    size, box_type = struct.unpack_from('>I4s', data, offset)
+    header = 8
+    if size == 1:
+        if offset + 16 > end:
+            return None
+        size, = struct.unpack_from('>Q', data, offset + 8)
+        header = 16
+    elif size == 0:
+        size = end - offset
+    if size < header:
+        return None
+    return box_type, offset + header, offset + size
+
+
+def _children(data, start, end):
+    offset = start
+    while (h := _box_header(data, offset, end)) is not None:
+        box_type, payload, box_end = h
+        if box_end > end:
+            return
+        yield box_type, payload, box_end
+        offset = box_end
+
+
+def _child(data, start, end, box_type):
+    for t, payload, box_end in _children(data, start, end):
+        if t == box_type:
+            return payload, box_end
+    return None, None
+
+
+def _full_box_u32_or_u64(data, offset, skip_v0, skip_v1):
+    """Read a field following version-dependent ones in a full box."""
+    if data[offset] == 1:
+        return struct.unpack_from('>Q', data, offset + 4 + skip_v1)[0]
+    return struct.unpack_from('>I', data, offset + 4 + skip_v0)[0]
+
+
+def _moov_tracks(moov):
+    """{track_ID: (timescale, default sample duration)}, (timescale, dur)."""
+    tracks = {}
+    mvhd, _ = _child(moov, 0, len(moov), b'mvhd')
+    movie = None
+    if mvhd is not None:
+        v1 = moov[mvhd] == 1
+        timescale, = struct.unpack_from('>I', moov, mvhd + (20 if v1 else 12))
+        duration = _full_box_u32_or_u64(moov, mvhd, 12, 20)
+        movie = timescale, duration
+    defaults = {}
+    mvex, mvex_end = _child(moov, 0, len(moov), b'mvex')
+    if mvex is not None:
+        for t, payload, _ in _children(moov, mvex, mvex_end):
+            if t == b'trex':
+                track_id, _, default_duration = \
+                    struct.unpack_from('>III', moov, payload + 4)
+                defaults[track_id] = default_duration
+    for t, trak, trak_end in _children(moov, 0, len(moov)):
+        if t != b'trak':
+            continue
+        tkhd, _ = _child(moov, trak, trak_end, b'tkhd')
+        mdia, mdia_end = _child(moov, trak, trak_end, b'mdia')
+        if tkhd is None or mdia is None:
+            continue
+        track_id, = struct.unpack_from('>I', moov,
+                                       tkhd + (20 if moov[tkhd] == 1 else 12))
+        mdhd, _ = _child(moov, mdia, mdia_end, b'mdhd')
+        if mdhd is None:
+            continue
+        v1 = moov[mdhd] == 1
+        timescale, = struct.unpack_from('>I', moov, mdhd + (20 if v1 else 12))
+        tracks[track_id] = timescale, defaults.get(track_id, 0)
+    return tracks, movie
+
+
+def _moof_spans(moof, tracks):
+    """{track_ID: (start, end)} in track timescale units."""
+    spans = {}
+    for t, traf, traf_end in _children(moof, 0, len(moof)):
+        if t != b'traf':
+            continue
+        tfhd, _ = _child(moof, traf, traf_end, b'tfhd')
+        tfdt, _ = _child(moof, traf, traf_end, b'tfdt')
+        if tfhd is None or tfdt is None:
+            continue
+        flags = int.from_bytes(moof[tfhd + 1:tfhd + 4], 'big')
+        track_id, = struct.unpack_from('>I', moof, tfhd + 4)
+        offset = tfhd + 8 + (8 if flags & 0x01 else 0) + \
+            (4 if flags & 0x02 else 0)
+        default_duration = (struct.unpack_from('>I', moof, offset)[0]
+                            if flags & 0x08
+                            else tracks.get(track_id, (0, 0))[1])
+        start = _full_box_u32_or_u64(moof, tfdt, 0, 0)
+        total = 0
+        for t, trun, _ in _children(moof, traf, traf_end):
+            if t != b'trun':
+                continue
+            flags = int.from_bytes(moof[trun + 1:trun + 4], 'big')
+            count, = struct.unpack_from('>I', moof, trun + 4)
+            offset = trun + 8 + (4 if flags & 0x01 else 0) + \
+                (4 if flags & 0x04 else 0)
+            if not flags & 0x100:
+                total += count * default_duration
+                continue
+            stride = 4 * bin(flags & 0xf00).count('1')
+            total += sum(struct.unpack_from('>I', moof, offset + i * stride)[0]
+                         for i in range(count))
+        spans[track_id] = start, start + total
+    return spans
+
+
+def boxes(f, offset, size):
+    """(type, start, end) of the complete top-level boxes from `offset` on."""
+    while offset + 8 <= size:
+        f.seek(offset)
+        h = _box_header(f.read(16), 0, size - offset)
+        if h is None or offset + h[2] > size:
+            return  # still being written
+        yield h[0], offset, offset + h[2]
+        offset += h[2]
+
+
+def _payload(f, start, end):
+    f.seek(start)
+    box = f.read(end - start)
+    return box[_box_header(box, 0, len(box))[1]:]
+
+
+def _bmff_duration(f, size):
+    moov = first_moof = last_moof = None
+    pending_moof = None  # waiting for its mdat to be written completely
+    for box_type, start, end in boxes(f, 0, size):
+        if box_type == b'moov':
+            moov = _payload(f, start, end)
+        elif box_type == b'moof':
+            pending_moof = _payload(f, start, end)
+        elif box_type == b'mdat' and pending_moof is not None:
+            first_moof = first_moof or pending_moof
+            last_moof, pending_moof = pending_moof, None
+    if moov is None:
+        return  # a lone fragment
+    tracks, movie = _moov_tracks(moov)
+    if first_moof is None:
+        if movie and movie[0] and movie[1]:
+            return movie[1] / movie[0]
+        return
+    starts, ends = _moof_spans(first_moof, tracks), \
+        _moof_spans(last_moof, tracks)
+    spans = [(ends[t][1] - starts[t][0]) / tracks[t][0]
+             for t in starts if t in ends and t in tracks and tracks[t][0]]
+    return max(spans) if spans else None
+
+
+def fragments(f, size, offset=0, tracks=None):
+    """
+    Index the complete fragments of a (growing) fragmented MP4
+    from `offset` on, `tracks` coming from an earlier call if any.
+    Returns (tracks, the end of the moov box if seen,
+             [(moof start, mdat end, seconds)], where to continue from).
+    """
+    init_end, found, moof = None, [], None
+    resume = offset
+    for box_type, start, end in boxes(f, offset, size):
+        if box_type == b'moov' and tracks is None:
+            tracks, _ = _moov_tracks(_payload(f, start, end))
+            init_end = end
+        elif box_type == b'moof':
+            moof = start, _payload(f, start, end)
+            continue
+        elif box_type == b'mdat' and moof is not None:
+            spans = _moof_spans(moof[1], tracks or {})
+            seconds = max(((e - s) / tracks[t][0]
+                           for t, (s, e) in spans.items()
+                           if t in tracks and tracks[t][0]), default=0)
+            found.append((moof[0], end, seconds))
+            moof = None
+        if moof is None:
+            resume = end
+    return tracks, init_end, found, resume
+
+
+def fragment_starts(path):
+    """
+    (end of the init segment, [(moof start, seconds)]) of a fragmented MP4,
+    listing its complete fragments with the decode times they start at;
+    None if it's not a fragmented MP4 or its moov hasn't been written yet.
+    """
+    with open(path, 'rb') as f:
+        if f.read(12)[4:8] not in (b'ftyp', b'styp', b'moov', b'moof'):
+            return None
+        tracks, init_end, found, moof = None, None, [], None
+        for box_type, start, end in boxes(f, 0, os.fstat(f.fileno()).st_size):
+            if box_type == b'moov' and tracks is None:
+                tracks, _ = _moov_tracks(_payload(f, start, end))
+                init_end = end
+            elif box_type == b'moof':
+                moof = start, _payload(f, start, end)
+            elif box_type == b'mdat' and moof is not None and tracks:
+                starts = [s / tracks[t][0]
+                          for t, (s, _) in _moof_spans(moof[1], tracks).items()
+                          if t in tracks and tracks[t][0]]
+                if starts:
+                    found.append((moof[0], min(starts)))
+                moof = None
+            elif box_type == b'mdat':  # not fragmented after all
+                return None
+    if init_end is None:
+        return None
+    return init_end, found
+
+
+def gaps(path, tolerance=1):
+    """
+    [(where, seconds)] of the media missing between the fragments
+    of a fragmented MP4, counting from its start, for the track missing
+    the most; None if it's not a fragmented MP4.
+    """
+    with open(path, 'rb') as f:
+        if f.read(12)[4:8] not in (b'ftyp', b'styp', b'moov', b'moof'):
+            return None
+        tracks, first, found, ends, moof = None, {}, {}, {}, None
+        for box_type, start, end in boxes(f, 0, os.fstat(f.fileno()).st_size):
+            if box_type == b'moov' and tracks is None:
+                tracks, _ = _moov_tracks(_payload(f, start, end))
+            elif box_type == b'moof':
+                moof = _payload(f, start, end)
+            elif box_type == b'mdat' and moof is not None and tracks:
+                for t, (s, e) in _moof_spans(moof, tracks).items():
+                    timescale = tracks.get(t, (0,))[0]
+                    if not timescale:
+                        continue
+                    first.setdefault(t, s)
+                    if t in ends and s - ends[t] > tolerance * timescale:
+                        found.setdefault(t, []).append(
+                            ((ends[t] - first[t]) / timescale,
+                             (s - ends[t]) / timescale)
+                        )
+                    ends[t] = e
+                moof = None
+    if not tracks:
+        return None
+    return max(found.values(), default=[],
+               key=lambda g: sum(seconds for _, seconds in g))
+
+
+# the rest
+
+def _mutagen_duration(path):
+    try:
+        m = mutagen.File(path)
+    except mutagen.MutagenError:
+        return
+    if m is not None and m.info is not None and m.info.length:
+        return m.info.length
+
+
+def _ffprobe_duration(path):
+    return float(ffmpeg.probe(path)['format']['duration'])
+
+
+def _probe(path, size):
+    with open(path, 'rb') as f:
+        head = f.read(12)
+        f.seek(0)
+        if head[:1] == b'\x47' and _ts_sync(f.read(3 * TS_PACKET)) == 0:
+            f.seek(0)
+            stats['ts'] += 1
+            return _ts_duration(f, size)
+        if head[4:8] in (b'ftyp', b'styp', b'moov', b'moof'):
+            f.seek(0)
+            stats['bmff'] += 1
+            return _bmff_duration(f, size)
+    duration = _mutagen_duration(path)
+    if duration is not None:
+        stats['mutagen'] += 1
+        return duration
+    stats['ffprobe'] += 1
+    return _ffprobe_duration(path)
+
+
+def duration(path):
+    """
+    Duration of a media file in seconds, None if there's nothing to tell.
+    Raises ffmpeg.Error if ffprobe can't make sense of it either.
+    """
+    st = os.stat(path)
+    cached = _cache.get(path)
+    if cached is not None and cached[:2] == (st.st_size, st.st_mtime_ns):
+        _cache.move_to_end(path)
+        stats['cached'] += 1
+        return cached[2]
+    try:
+        d = _probe(path, st.st_size)
+    except (struct.error, IndexError) as ex:  # malformed, let ffprobe try
+        print(f'{path}: cannot parse ({ex}), asking ffprobe', file=sys.stderr)
+        stats['ffprobe'] += 1
+        d = _ffprobe_duration(path)
+    _cache[path] = st.st_size, st.st_mtime_ns, d
+    if len(_cache) > CACHE_SIZE:
+        _cache.popitem(last=False)
+    return d
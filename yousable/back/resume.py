@@ -0,0 +1,185 @@
+# SPDX-FileCopyrightText: 2024 Alexander Sosedkin <monk@unboiled.info>
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+# Keeping partial downloads around across errors and restarts.
+# yt-dlp resumes .part files and fragmented downloads on its own,
+# the manifest is here to tell whether what's in tmp is still resumable.
+
+import glob
+import json
+import os
+import sys
+import time
+
+import yt_dlp
+
+import yousable.utils
+import yousable.back.finalize as finalize
+import yousable.back.jobs as jobs
+
+
+MANIFEST = 'resume.json'
+PARTIAL_PATTERNS = ('*.part', '*.part-Frag*', '*.ytdl')
+WRITE_INTERVAL = 10  # seconds
+
+
+def _read(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def _write(path, manifest):
+    manifest['updated'] = time.time()
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f)
+    os.rename(path + '.tmp', path)
+
+
+def discard(media_dir):
+    for pattern in PARTIAL_PATTERNS:
+        for f in glob.glob(os.path.join(media_dir, pattern)):
+            os.unlink(f)
+
+
+def _discard_file(filename):
+    for f in ([filename + '.part', filename + '.ytdl'] +
+              glob.glob(glob.escape(filename) + '.part-Frag*')):
+        if os.path.exists(f):
+            os.unlink(f)
+
+
+def _fragment_index(filename):
+    """Fragment yt-dlp would resume `filename` from, None if it can't tell."""
+    try:
+        with open(filename + '.ytdl') as f:
+            return json.load(f)['downloader']['current_fragment']['index']
+    except (FileNotFoundError, json.JSONDecodeError, KeyError, TypeError):
+        return None
+
+
+def _disagreement(filename, progress):
+    """Tell how a .part disagrees with the progress recorded, if it does."""
+    part = filename + '.part'
+    if not os.path.exists(part):
+        return
+    size = os.path.getsize(part)
+    total = progress.get('total_bytes')
+    if total and size > total:
+        return f'is larger than expected ({size} > {total})'
+    recorded_index = progress.get('fragment_index')
+    if recorded_index is not None:
+        # the fragment being downloaded isn't in the .part yet,
+        # so the bytes can lag behind, but the index shouldn't
+        index = _fragment_index(filename)
+        if index is None or index < recorded_index - 1:
+            return (f'is at fragment {index}, '
+                    f'but {recorded_index} was being downloaded')
+        return
+    downloaded = progress.get('downloaded_bytes') or 0
+    if size < downloaded:  # larger is fine, it's not recorded every time
+        return f'is smaller than downloaded ({size} < {downloaded})'
+
+
+def _validate(media_dir, manifest, format_id, log_name):
+    if manifest.get('format_id') not in (None, format_id):
+        print(f'{log_name}: format changed {manifest["format_id"]} -> '
+              f'{format_id}, discarding partial download', file=sys.stderr)
+        discard(media_dir)
+        return {}
+    for filename, progress in list(manifest.get('progress', {}).items()):
+        reason = _disagreement(filename, progress)
+        if reason is not None:
+            print(f'{log_name}: {filename}.part {reason}, discarding',
+                  file=sys.stderr)
+            _discard_file(filename)
+            del manifest['progress'][filename]
+    return manifest
+
+
+class ResumePP(yt_dlp.postprocessor.PostProcessor):
+    """
+    Run before downloading: check that the partial download in media_dir
+    matches the selected format and start a new attempt in the manifest,
+    which is kept in tmp_dir.
+    """
+
+    def __init__(self, downloader=None, tmp_dir=None, media_dir=None,
+                 log_name=None):
+        super(ResumePP, self).__init__(downloader)
+        self.tmp_dir, self.media_dir = tmp_dir, media_dir or tmp_dir
+        self.log_name = log_name
+
+    def run(self, info):
+        path = os.path.join(self.tmp_dir, MANIFEST)
+        manifest = _validate(self.media_dir, _read(path),
+                             info.get('format_id'), self.log_name)
+        manifest.setdefault('started', time.time())
+        manifest.setdefault('progress', {})
+        manifest['format_id'] = info.get('format_id')
+        manifest['attempts'] = manifest.get('attempts', 0) + 1
+        if manifest['progress']:
+            print(f'{self.log_name}: resuming, '
+                  f'attempt {manifest["attempts"]}', file=sys.stderr)
+        _write(path, manifest)
+        return [], info
+
+
+def make_progress_hook(tmp_dir):
+    """Record how far the download of each file has progressed."""
+    path = os.path.join(tmp_dir, MANIFEST)
+    last_written = 0
+
+    def progress_hook(d):
+        nonlocal last_written
+        if d.get('status') not in ('downloading', 'finished'):
+            return
+        now = time.time()
+        if (d['status'] == 'downloading' and
+                now < last_written + WRITE_INTERVAL):
+            return
+        manifest = _read(path)
+        manifest.setdefault('progress', {})[d['filename']] = {
+            k: d.get(k) for k in ('downloaded_bytes', 'total_bytes',
+                                  'fragment_index', 'fragment_count')
+        }
+        manifest['progress'][d['filename']]['finished'] = \
+            d['status'] == 'finished'
+        _write(path, manifest)
+        last_written = now
+
+    return progress_hook
+
+
+def gc(config, db, listing=yousable.utils.listing):
+    """
+    Remove the partial downloads nobody has touched for a while.
+    `listing(dir)` can be a cached `yousable.utils.listing`.
+    """
+    max_age = config['limits']['tmp_max_age_seconds']
+    now = time.time()
+    for d in glob.glob(os.path.join(config['paths']['tmp'], '*', '*', '*')):
+        if not os.path.isdir(d):
+            continue
+        manifest = listing(d).get(MANIFEST)  # always replaced, never written
+        touched = max(os.stat(d).st_mtime, manifest[1] if manifest else 0)
+        if touched + max_age > now:
+            continue
+        feed_dir, profile = os.path.split(d)
+        feed, entry_id = os.path.split(feed_dir)
+        feed = os.path.basename(feed)
+        state = jobs.job_state(db, feed, entry_id, profile)
+        if state in ('running', 'fetched', 'processing'):
+            continue
+
+        def entry_pathogen(d, *r):
+            return os.path.join(config['paths'][d], feed, entry_id, *r)
+
+        print(f'removing stale partial download {d}', file=sys.stderr)
+        finalize.cleanup(config, entry_pathogen, profile)
+        try:
+            os.removedirs(os.path.dirname(d))  # prune emptied parents
+        except OSError:
+            pass
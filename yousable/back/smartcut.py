@@ -0,0 +1,258 @@
+# SPDX-FileCopyrightText: 2024 Alexander Sosedkin <monk@unboiled.info>
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+# Frame-accurate cutting that only re-encodes the GOPs around the cuts.
+# The whole GOPs are split off with the segment muxer at their keyframes,
+# the edges are re-encoded with the codec parameters of the source,
+# then all of them are concatenated, each lasting exactly its frames.
+# H.264/HEVC parts carry their own parameter sets in-band
+# (converted to Annex B and back, the muxers keep them),
+# so that they make it into the result.
+
+import bisect
+import json
+import os
+import subprocess
+
+from yt_dlp.postprocessor.modify_chapters import ModifyChaptersPP
+from yt_dlp.utils import prepend_extension
+
+
+ENCODERS = {
+    'h264': ['-c:v', 'libx264', '-crf', '18', '-preset', 'veryfast'],
+    'hevc': ['-c:v', 'libx265', '-crf', '20', '-preset', 'veryfast'],
+    'vp8': ['-c:v', 'libvpx', '-crf', '10', '-b:v', '0'],
+    'vp9': ['-c:v', 'libvpx-vp9', '-crf', '30', '-b:v', '0',
+            '-row-mt', '1', '-deadline', 'realtime', '-cpu-used', '8'],
+    'av1': ['-c:v', 'libaom-av1', '-crf', '30', '-b:v', '0',
+            '-cpu-used', '8', '-row-mt', '1'],
+}
+
+PROFILES = {  # ffprobe's profile names to the encoders' ones
+    'h264': {'Constrained Baseline': 'baseline', 'Baseline': 'baseline',
+             'Main': 'main', 'High': 'high', 'High 10': 'high10',
+             'High 4:2:2': 'high422', 'High 4:4:4 Predictive': 'high444'},
+    'hevc': {'Main': 'main', 'Main 10': 'main10'},
+    'vp9': {'Profile 0': '0', 'Profile 1': '1',
+            'Profile 2': '2', 'Profile 3': '3'},
+}
+IN_BAND = ('h264', 'hevc')  # codecs to keep the parameter sets in-band for
+COLOR_OPTS = (('color_range', '-color_range'), ('color_space', '-colorspace'),
+              ('color_transfer', '-color_trc'),
+              ('color_primaries', '-color_primaries'))
+
+MIN_PART = .001  # seconds, skip producing parts shorter than that
+AUDIO_SEEK_MARGIN = 10  # seconds to seek before an audio cut and read through
+
+
+def _ffprobe(executable, filename, *args, streams='v:0'):
+    r = subprocess.run([executable, '-v', 'error', '-select_streams', streams,
+                        *args, '-of', 'csv=p=0', filename],
+                       capture_output=True, text=True, check=True)
+    return [line.split(',') for line in r.stdout.split('\n') if line]
+
+
+def _video_stream(executable, filename):
+    r = subprocess.run([executable, '-v', 'error', '-select_streams', 'v:0',
+                        '-show_entries', 'stream', '-of', 'json', filename],
+                       capture_output=True, text=True, check=True)
+    streams = json.loads(r.stdout).get('streams')
+    return streams[0] if streams else None
+
+
+def encoder_opts(stream):
+    """Encoder options re-encoding a part to match the source `stream`."""
+    codec = stream['codec_name']
+    opts = list(ENCODERS[codec])
+    profile = PROFILES.get(codec, {}).get(stream.get('profile'))
+    if profile is not None:
+        opts += ['-profile:v', profile]
+    if codec == 'h264' and stream.get('level', 0) > 0:
+        opts += ['-level', f'{stream["level"] / 10:.1f}']
+    if stream.get('pix_fmt'):
+        opts += ['-pix_fmt', stream['pix_fmt']]
+    for key, opt in COLOR_OPTS:
+        if stream.get(key, 'unknown') != 'unknown':
+            opts += [opt, stream[key]]
+    return opts
+
+
+def check(executable, filename):
+    """
+    Tell what's wrong with the timestamps of a cut file, if anything:
+    repeated video frames or decoding timestamps not increasing.
+    """
+    for stream in 'v:0', 'a:0':
+        r = subprocess.run([executable, '-v', 'error',
+                            '-select_streams', stream,
+                            '-show_entries', 'packet=pts,dts',
+                            '-of', 'csv=p=0', filename],
+                           capture_output=True, text=True, check=True)
+        packets = [line.split(',')[:2] for line in r.stdout.split()]
+        dts = [int(d) for _, d in packets if d != 'N/A']
+        if any(b <= a for a, b in zip(dts, dts[1:])):
+            return f'{stream} decoding timestamps not increasing'
+        pts = [p for p, _ in packets if p != 'N/A']
+        if stream.startswith('v') and len(set(pts)) < len(pts):
+            return f'{stream} frames repeated'
+
+
+def plan(keep, keyframes):
+    """
+    Split a list of (inpoint, outpoint) segments to keep
+    into (inpoint, outpoint, copy) parts
+    so that stream-copied parts start at keyframes
+    and the rest, the ones to re-encode, are as short as possible.
+    """
+    parts = []
+    for a, b in keep:
+        i = bisect.bisect_left(keyframes, a)  # first keyframe >= a
+        j = bisect.bisect_right(keyframes, b) - 1  # last keyframe <= b
+        k1 = keyframes[i] if i < len(keyframes) else None
+        k2 = keyframes[j] if j >= 0 else None
+        if k1 is None or k2 is None or k1 >= k2:  # no whole GOPs inside
+            parts.append((a, b, False))
+            continue
+        if k1 - a > MIN_PART:
+            parts.append((a, k1, False))
+        parts.append((k1, k2, True))
+        if b - k2 > MIN_PART:
+            parts.append((k2, b, False))
+    return parts
+
+
+class SmartCutPP(ModifyChaptersPP):
+    """
+    ModifyChaptersPP that, with smart=True, stream-copies everything
+    but the GOPs containing the cut points, re-encoding only those.
+    Falls back to the stock behaviour for audio and unknown codecs,
+    and if the result doesn't pass the `check`.
+    """
+
+    def __init__(self, downloader=None, smart=False, **kwargs):
+        super(SmartCutPP, self).__init__(downloader, **kwargs)
+        self._smart = smart
+
+    def remove_chapters(self, filename, ranges_to_cut, concat_opts,
+                        force_keyframes=False):
+        stream = (_video_stream(self.probe_executable, filename)
+                  if self._smart else None)
+        if stream is None or stream.get('codec_name') not in ENCODERS:
+            return super(SmartCutPP, self).remove_chapters(
+                filename, ranges_to_cut, concat_opts, force_keyframes
+            )
+        self.to_screen(f'Smart-cutting chapters from {filename}')
+        out_file = self._smart_cut(filename, stream, concat_opts)
+        problem = check(self.probe_executable, out_file)
+        if problem is None:
+            return out_file
+        self.report_warning(f'Smart-cutting {filename} went wrong '
+                            f'({problem}), cutting it the usual way')
+        os.unlink(out_file)
+        return super(SmartCutPP, self).remove_chapters(
+            filename, ranges_to_cut, concat_opts, force_keyframes
+        )
+
+    def _smart_cut(self, filename, stream, concat_opts):
+        packets = [(float(t), 'K' in flags) for t, flags in
+                   _ffprobe(self.probe_executable, filename,
+                            '-show_entries', 'packet=pts_time,flags')
+                   if t != 'N/A']
+        frames = sorted(t for t, _ in packets)
+        keyframes = sorted(t for t, key in packets if key)
+        frame_duration = min((b - a for a, b in zip(frames, frames[1:])
+                              if b > a), default=.04)
+        end = frames[-1] + frame_duration
+
+        def frame_at(t):  # when the first frame at `t` or later starts
+            i = bisect.bisect_left(frames, t - MIN_PART / 2)
+            return frames[i] if i < len(frames) else end
+
+        duration = self._get_real_video_duration(filename)
+        keep = [(frame_at(float(o.get('inpoint', 0))),
+                 frame_at(float(o.get('outpoint', duration))))
+                for o in concat_opts]
+        keep = [(a, b) for a, b in keep if b > a]
+        parts = [(frame_at(a), frame_at(b), copy)
+                 for a, b, copy in plan(keep, keyframes + [end])]
+        parts = [(a, b, copy) for a, b, copy in parts if b > a]
+        has_audio = bool(_ffprobe(self.probe_executable, filename,
+                                  '-show_entries', 'stream=index',
+                                  streams='a:0'))
+        in_band = (['-bsf:v', f'{stream["codec_name"]}_mp4toannexb']
+                   if stream['codec_name'] in IN_BAND else [])
+
+        out_file = prepend_extension(filename, 'temp')
+        video_concat = f'{out_file}.video.concat'
+        audio_concat = f'{out_file}.audio.concat'
+        video_files, video_opts, audio_files, audio_opts = [], [], [], []
+        # the whole GOPs to copy, split right at their keyframes
+        times = sorted({t for a, b, copy in parts if copy
+                        for t in (a, b) if frames[0] < t < end})
+        segment_files = [prepend_extension(filename, f'segment{i:03d}')
+                         for i in range(len(times) + 1)]
+        part_files = []
+        try:
+            if any(copy for _, _, copy in parts):
+                self.real_run_ffmpeg(
+                    [(filename, [])],
+                    [(prepend_extension(filename, 'segment%03d'),
+                      ['-map', '0:v:0', '-c', 'copy', *in_band,
+                       '-f', 'segment', '-reset_timestamps', '1',
+                       '-segment_time_delta', f'{frame_duration / 2:.6f}',
+                       *(['-segment_times',
+                          ','.join(f'{t:.6f}' for t in times)]
+                         if times else [])])]
+                )
+            # the edges, re-encoded, each lasting exactly its frames
+            for a, b, copy in parts:
+                if copy:
+                    video_files.append(
+                        segment_files[bisect.bisect_right(times, a)]
+                    )
+                else:
+                    part = prepend_extension(filename,
+                                             f'part{len(part_files)}')
+                    part_files.append(part)
+                    count = (bisect.bisect_left(frames, b - MIN_PART / 2) -
+                             bisect.bisect_left(frames, a - MIN_PART / 2))
+                    self.real_run_ffmpeg(
+                        [(filename, ['-ss', f'{a - frame_duration / 2:.6f}'])],
+                        [(part, ['-map', '0:v:0', '-frames:v', str(count),
+                                 '-fps_mode', 'passthrough',
+                                 *encoder_opts(stream), *in_band])]
+                    )
+                    video_files.append(part)
+                video_opts.append({'duration': f'{b - a:.6f}'})
+            # audio packets are short, cutting them as is is precise enough,
+            # but only on the output side, the concat demuxer would let
+            # the packets before an inpoint through
+            for a, b in keep if has_audio else ():
+                part = prepend_extension(filename,
+                                         f'audio{len(audio_files)}')
+                audio_files.append(part)
+                seek = max(0, a - AUDIO_SEEK_MARGIN)
+                self.real_run_ffmpeg(
+                    [(filename, ['-ss', f'{seek:.6f}'])],
+                    [(part, ['-ss', f'{a - seek:.6f}', '-t', f'{b - a:.6f}',
+                             '-map', '0:a:0', '-c', 'copy'])]
+                )
+                audio_opts.append({'duration': f'{b - a:.6f}'})
+            with open(video_concat, 'w', encoding='utf-8') as f:
+                f.writelines(self._concat_spec(video_files, video_opts))
+            with open(audio_concat, 'w', encoding='utf-8') as f:
+                f.writelines(self._concat_spec(audio_files, audio_opts))
+            concat_input_opts = ['-f', 'concat', '-safe', '0']
+            self.real_run_ffmpeg(
+                [(video_concat, concat_input_opts),
+                 (audio_concat if has_audio else None, concat_input_opts)],
+                [(out_file, ['-map', '0:v:0',
+                             *(['-map', '1:a'] if has_audio else []),
+                             '-dn', '-c', 'copy'])]
+            )
+        finally:
+            for f in (*segment_files, *part_files, *audio_files,
+                      video_concat, audio_concat):
+                if os.path.exists(f):
+                    os.unlink(f)
+        return out_file
@@ -0,0 +1,101 @@
+# SPDX-FileCopyrightText: 2024 Alexander Sosedkin <monk@unboiled.info>
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+# Keeping uncut downloads around (in paths.sources, within a disk budget)
+# to re-apply SponsorBlock cuts locally instead of downloading again.
+
+import glob
+import os
+import shutil
+import sys
+
+import yt_dlp
+
+import yousable.utils
+import yousable.back.finalize as finalize
+
+
+def enabled(config, feed):
+    return bool(config['paths']['sources'] and
+                config['feeds'][feed]['sponsorblock_remove'])
+
+
+def _dir(config, feed, entry_id, profile):
+    return os.path.join(config['paths']['sources'], feed, entry_id, profile)
+
+
+def _link_or_copy(src, dst):
+    try:
+        os.link(src, dst)
+    except OSError:  # e.g., a different filesystem
+        finalize.clone(src, dst)
+
+
+def evict(config, listing=yousable.utils.listing):
+    """
+    Remove least recently used sources until they fit the budget.
+    `listing(dir)` can be a cached `yousable.utils.listing`.
+    """
+    budget = config['limits']['sources_max_bytes']
+    dirs = glob.glob(os.path.join(config['paths']['sources'], '*', '*', '*'))
+    sizes = {d: sum(size for size, _, _ in listing(d).values())
+             for d in dirs}
+    total = sum(sizes.values())
+    for d in sorted(dirs, key=lambda d: os.stat(d).st_mtime):
+        if total <= budget:
+            break
+        print(f'evicting source {d}', file=sys.stderr)
+        shutil.rmtree(d)
+        total -= sizes[d]
+        try:
+            os.removedirs(os.path.dirname(d))  # prune emptied parents
+        except OSError:
+            pass
+
+
+def restore(config, feed, entry_pathogen, entry_id, profile):
+    """Put a kept source into staging, return yt-dlp-like info or None."""
+    d = _dir(config, feed, entry_id, profile)
+    media = glob.glob(os.path.join(d, 'media.*'))
+    if not media:
+        return
+    os.utime(d)  # mark as recently used
+    os.makedirs(finalize.staging(config, entry_pathogen, profile),
+                exist_ok=True)
+    info = {'__real_download': True, 'thumbnails': []}  # no cut happened
+    for f in glob.glob(os.path.join(d, '*')):
+        tmp_f = finalize.staging(config, entry_pathogen, profile,
+                                 os.path.basename(f))
+        if os.path.exists(tmp_f):
+            os.unlink(tmp_f)
+        _link_or_copy(f, tmp_f)
+        if f in media:
+            info['filepath'] = tmp_f
+            info['ext'] = tmp_f.rsplit('.', 1)[-1]
+        else:
+            info['thumbnails'] = [{'id': 'kept', 'filepath': tmp_f}]
+    return info
+
+
+class KeepSourcePP(yt_dlp.postprocessor.PostProcessor):
+    """Hardlink (or copy) the uncut media and its thumbnail to sources."""
+
+    def __init__(self, downloader=None, config=None, feed=None, profile=None):
+        super(KeepSourcePP, self).__init__(downloader)
+        self.config, self.feed, self.profile = config, feed, profile
+
+    def run(self, info):
+        d = _dir(self.config, self.feed, info['id'], self.profile)
+        if os.path.exists(d):
+            shutil.rmtree(d)
+        os.makedirs(d)
+        ext = info['filepath'].rsplit('.', 1)[-1]
+        _link_or_copy(info['filepath'], os.path.join(d, f'media.{ext}'))
+        thumbnails = [t for t in info.get('thumbnails') or []
+                      if t.get('filepath') and os.path.exists(t['filepath'])]
+        if thumbnails:
+            thumbnail = thumbnails[-1]['filepath']
+            ext = thumbnail.rsplit('.', 1)[-1]
+            _link_or_copy(thumbnail, os.path.join(d, f'thumbnail.{ext}'))
+        evict(self.config)
+        return [], info
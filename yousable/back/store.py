@@ -0,0 +1,173 @@
+# SPDX-FileCopyrightText: 2024 Alexander Sosedkin <monk@unboiled.info>
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+# A content store shared between the feeds, so that a video showing up
+# in several of them is downloaded and processed only once.
+# Feed directories hold hardlinks to it, so the link count is the refcount;
+# paths.store has to be on the same filesystem as paths.out.
+# Once all the feeds have moved theirs to the cold tier,
+# the stored file moves there too and gets symlinked to instead.
+# The SponsorBlock data of a video is cached next to it for all the feeds.
+
+import hashlib
+import json
+import os
+import sys
+import time
+
+import yousable.tiers as tiers
+
+
+SPONSORBLOCK = 'sponsorblock.json'
+
+
+def enabled(config):
+    return bool(config['paths']['store'])
+
+
+def cut_key(config, feed, sb):
+    """Identify what gets cut out of a video for a feed."""
+    categories = config['feeds'][feed]['sponsorblock_remove']
+    if not categories:
+        return 'uncut'
+    segments = sorted(s['segment'] for s in (sb or {}).get('segments', [])
+                      if s['category'] in categories)
+    # how it's cut changes the result, too
+    blob = json.dumps([config['feeds'][feed]['sponsorblock_cut'], segments])
+    return hashlib.sha256(blob.encode()).hexdigest()[:16]
+
+
+def _path(config, entry_id, profile, key):
+    container = config['profiles'][profile]['container']
+    return os.path.join(config['paths']['store'], entry_id,
+                        f'{profile}.{key}.{container}')
+
+
+def sponsorblock_path(config, entry_pathogen, entry_id):
+    """Where to cache the SponsorBlock data of a video."""
+    if not enabled(config):
+        return entry_pathogen('meta', SPONSORBLOCK)
+    d = os.path.join(config['paths']['store'], entry_id)
+    os.makedirs(d, exist_ok=True)
+    return os.path.join(d, SPONSORBLOCK)
+
+
+def take(config, feed, entry_pathogen, entry_id, profile, key):
+    """Link the content stored by another feed in, tell if there was any."""
+    stored = _path(config, entry_id, profile, key)
+    if not os.path.exists(stored):
+        return False
+    container = config['profiles'][profile]['container']
+    name = f'{profile}.{container}'
+    if os.path.islink(stored):  # in the cold tier
+        tiers.adopt(config, feed, entry_id, name, os.readlink(stored))
+        return True
+    tiers.replaced(config, feed, entry_id, name)
+    out = entry_pathogen('out', name)
+    os.makedirs(os.path.dirname(out), exist_ok=True)
+    try:
+        os.link(stored, out + '.store')
+    except FileExistsError:
+        os.unlink(out + '.store')
+        os.link(stored, out + '.store')
+    os.replace(out + '.store', out)
+    return True
+
+
+def put(config, entry_pathogen, entry_id, profile, key):
+    """Share a freshly made file with the other feeds."""
+    container = config['profiles'][profile]['container']
+    out = entry_pathogen('out', f'{profile}.{container}')
+    stored = _path(config, entry_id, profile, key)
+    os.makedirs(os.path.dirname(stored), exist_ok=True)
+    try:
+        if os.path.exists(stored + '.tmp'):
+            os.unlink(stored + '.tmp')
+        os.link(out, stored + '.tmp')
+    except OSError as ex:  # e.g., a different filesystem
+        print(f'could not store {out}: {ex}', file=sys.stderr)
+        return
+    if os.path.islink(stored):  # the previous one went cold
+        _unlink(os.readlink(stored))
+    os.replace(stored + '.tmp', stored)
+
+
+def _unlink(path):
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+def _rmdir(path):
+    try:
+        os.rmdir(path)
+    except OSError:  # not empty or not there
+        pass
+
+
+def _cool_down(config, tiers_db, path, st):
+    """Move a stored file to the cold tier if the feeds have moved theirs."""
+    copy = tiers.cold_copy(config, tiers_db, st)
+    if copy is None:
+        return False
+    cold = os.path.join(config['paths']['cold'], tiers.STORE,
+                        os.path.relpath(path, config['paths']['store']))
+    os.makedirs(os.path.dirname(cold), exist_ok=True)
+    if os.path.exists(cold):
+        os.unlink(cold)
+    os.link(copy, cold)
+    os.symlink(cold, path + '.cold')
+    os.replace(path + '.cold', path)
+    print(f'moved {path} to the cold tier', file=sys.stderr)
+    return True
+
+
+def gc(config):
+    """
+    Remove the stored files no feed links to anymore,
+    move the ones only the cold tier links to there.
+    Cached SponsorBlock data goes once nothing is stored for the video
+    and it's older than any download still worth resuming.
+    """
+    store = config['paths']['store']
+    max_age = config['limits']['tmp_max_age_seconds']
+    tiers_db = tiers.connect(config) if tiers.enabled(config) else None
+    try:
+        for d in os.scandir(store) if os.path.isdir(store) else ():
+            if not d.is_dir(follow_symlinks=False):
+                continue
+            metadata, stored = [], 0
+            for f in os.scandir(d.path):
+                if f.name.startswith(SPONSORBLOCK):
+                    metadata.append(f)
+                    continue
+                stored += 1
+                if f.is_symlink():  # refcounted in the cold tier
+                    cold = os.readlink(f.path)
+                    if (os.path.exists(cold) and
+                            os.stat(cold).st_nlink > 1):
+                        continue
+                    print(f'removing unreferenced {f.path}', file=sys.stderr)
+                    _unlink(cold)
+                    _rmdir(os.path.dirname(cold))
+                    os.unlink(f.path)
+                    stored -= 1
+                    continue
+                st = f.stat(follow_symlinks=False)
+                if st.st_nlink > 1:
+                    continue
+                if tiers_db is not None and _cool_down(config, tiers_db,
+                                                       f.path, st):
+                    continue
+                print(f'removing unreferenced {f.path}', file=sys.stderr)
+                os.unlink(f.path)
+                stored -= 1
+            for f in metadata:
+                if (not stored and
+                        f.stat().st_mtime < time.time() - max_age):
+                    os.unlink(f.path)
+            _rmdir(d.path)
+    finally:
+        if tiers_db is not None:
+            tiers_db.close()
@@ -1,20 +1,41 @@
 # SPDX-FileCopyrightText: 2022 Alexander Sosedkin <monk@unboiled.info>
 # SPDX-License-Identifier: AGPL-3.0-or-later
 
+import csv
+import functools
 import glob
+import json
 import multiprocessing
+import multiprocessing.connection
 import os
-import shutil
+import queue
 import signal
 import sys
+import threading
 import time
 
 import yt_dlp
 import ffmpeg
 
+import yousable.back.bandwidth as bandwidth
+import yousable.back.fragments as fragments
+import yousable.back.leases as leases
+import yousable.back.probe as probe
 from yousable.utils import start_process, proctitle, dl_options
 
 
+PROBE_SECONDS = 20  # probe recordings that can't tell their progress as often
+SEGMENT_STALL_SECONDS = 60  # the segmenter stops once the recording does
+LEASE_LOST = 3  # exit code of a slicer that has lost its lease
+SEEK_TOLERANCE = .5  # seconds a fragment can start before where it's sought
+COPY_CODECS = {  # audio codecs fitting the containers, None is for any
+    'aac': ('aac',), 'm4a': ('aac', 'alac'), 'mp3': ('mp3',),
+    'ogg': ('opus', 'vorbis', 'flac'), 'opus': ('opus',),
+    'flac': ('flac',), 'webm': ('opus', 'vorbis'),
+    'mp4': ('aac', 'mp3', 'opus', 'flac', 'alac'), 'mka': None, 'mkv': None,
+}
+
+
 def shorten(s, to=30):
     return s[:to-1] + '…' if len(s) > 30 else s
 
@@ -23,7 +44,10 @@ def get_duration_file(infile):
     if infile.endswith('.ytdl'):
         return
     try:
-        return int(float(ffmpeg.probe(infile)['format']['duration']))
+        duration = probe.duration(infile)
+        return int(duration) if duration is not None else None
+    except FileNotFoundError:
+        return  # gone meanwhile
     except KeyError as ex:
         print(f'ERROR {infile}: {type(ex)} {ex}', file=sys.stderr)
     except ffmpeg._run.Error as ex:
@@ -89,10 +113,29 @@ def slice_and_merge_final(infiles, outbasename, outext,
                     audio_only=audio_only)
 
 
-def make_progress_hook(log_prefix, target_interval=60):
+def _media_time(d, i):
+    """
+    Seconds of media in the first `i` fragments, None if unknown.
+    Only real fragment durations count, target_duration is just a maximum;
+    for live_from_start the fragments aren't even listed,
+    so it's usually up to the slicer to look into the file.
+    """
+    info = d.get('info_dict') or {}
+    fragments = info.get('fragments')
+    if isinstance(fragments, list) and len(fragments) >= i and all(
+            f.get('duration') for f in fragments[:i]):
+        return sum(f['duration'] for f in fragments[:i])
+
+
+def make_progress_hook(log_prefix, target_interval=60, publish=None):
+    """
+    Report the progress of a recording to the log
+    and with `publish(filename, fragments written, media seconds or None)`.
+    """
     last_reported_seg, last_reported_time = -1, 0
+    last_published = None
     def progress_hook(d):
-        nonlocal last_reported_seg, last_reported_time
+        nonlocal last_reported_seg, last_reported_time, last_published
         now = time.time()
 
         if 'fragment_index' not in d or 'fragment_count' not in d:
@@ -103,6 +146,10 @@ def make_progress_hook(log_prefix, target_interval=60):
         i, l = d['fragment_index'], d['fragment_count']
         segments_pretty_progress = f'{i}/{l}'
 
+        if publish is not None and i != last_published:
+            publish(d['filename'], i, _media_time(d, i))
+            last_published = i
+
         if (i - last_reported_seg >= 10 and i % 10 == 0
                 or now > last_reported_time + target_interval):
             print(f'{log_prefix}: {segments_pretty_progress} segments',
@@ -113,44 +160,371 @@ def make_progress_hook(log_prefix, target_interval=60):
     return progress_hook
 
 
-def intermerger(log_prefix, pseudolockfile,
-                dirs, outbasename, outext, slice_duration,
-                its_over_event, audio_only=False):
-    observed_duration = written_duration = 0
+def _recorded(filename, count, media_time):
+    """
+    Seconds surely written, keeping one fragment as a safety margin
+    if told by the recorder, going by the timestamps in the file otherwise
+    (of its complete fragments, if it's fragmented).
+    """
+    if media_time is None:  # the recorder can't tell, have to look
+        return get_duration_file(filename + '.part'
+                                 if os.path.exists(filename + '.part')
+                                 else filename) or 0
+    return int(media_time - media_time / count) if count else 0
 
-    proctitle(f'initial sleep for {slice_duration // 10}s...')
-    time.sleep(slice_duration // 10)
+
+def intermerger(log_prefix, renew_lease,
+                dirs, outbasename, outext, slice_duration,
+                its_over_event, progress, audio_only=False):
+    """
+    Slice the recordings as soon as they cross a slice boundary,
+    learning how far they've got from `progress`,
+    a queue of (dir, filename, fragments written, media seconds or None).
+    Exits with LEASE_LOST once another host has taken the stream over.
+    """
+    written_duration = 0
+    recorded = {}  # dir -> (filename, seconds)
+    probed = {}  # dir -> when its recording was last probed
+    renewed = 0
 
     proctitle('waiting...')
-    while not its_over_event.wait(timeout=min(20, slice_duration//32+1)):
-        fds = [get_file_and_duration(dir_) for dir_ in dirs]
-        fds = [fd for fd in fds if fd is not None]
-        infiles = [f for f, d in fds]
-        durations = [d for f, d in fds]
-        observed_duration = min(durations) if durations else 0
-        if len(durations) < len(dirs):
-            msg = (f'{written_duration}s of '
-                   f'{"+".join(str(d) for d in durations)}+???s')
-            print(f'{log_prefix}: {msg}', file=sys.stderr)
-            proctitle(msg)
-            return
+    while not its_over_event.is_set():
+        if time.time() > renewed + 20:
+            if not renew_lease():
+                print(f'{log_prefix}: lease lost, stopping', file=sys.stderr)
+                sys.exit(LEASE_LOST)
+            renewed = time.time()
+        try:
+            message = progress.get(timeout=5)
+        except queue.Empty:
+            continue
+        if message is None:  # woken up to check its_over_event
+            continue
+        dir_, filename, count, media_time = message
+        if media_time is None:  # has to be probed, but not on every fragment
+            if (recorded.get(dir_, (None,))[0] == filename and
+                    time.time() < probed[dir_] + PROBE_SECONDS):
+                continue
+            probed[dir_] = time.time()
+        recorded[dir_] = filename, _recorded(filename, count, media_time)
+        durations = [recorded[d][1] if d in recorded else None for d in dirs]
+        msg = '+'.join(str(d) if d is not None else '???' for d in durations)
+        msg = f'{written_duration}s of {msg}s'
+        proctitle(msg)
+        if None in durations:
+            continue
 
-        if observed_duration > written_duration + slice_duration:
-            with open(pseudolockfile, 'w') as f:
-                f.write(str(time.time()))
+        observed_duration = min(durations)
+        if observed_duration >= written_duration + slice_duration:
+            print(f'{log_prefix}: {msg}', file=sys.stderr)
+            infiles = [recorded[d][0] for d in dirs]
             written_duration = \
                 slice_and_merge_intermediate(infiles, outbasename, outext,
                                              observed_duration, slice_duration,
                                              audio_only=audio_only)
-
-        msg = f'{written_duration}s of {"+".join(str(d) for d in durations)}s'
-        print(f'{log_prefix}: {msg}', file=sys.stderr)
-        proctitle(msg)
     print('intermerger done', file=sys.stderr)
     proctitle('done')
 
 
-def _stream(config, entry_info, feed, workdir, profile, video=False):
+def _audio_codec(path):
+    try:
+        streams = ffmpeg.probe(path)['streams']
+    except ffmpeg.Error:
+        return
+    return next((s['codec_name'] for s in streams
+                 if s.get('codec_type') == 'audio'), None)
+
+
+def _slices_done(outbasename, outext):
+    i = 0
+    while os.path.exists(f'{outbasename}.{i:02d}.{outext}'):
+        i += 1
+    return i
+
+
+def _seek_points(infiles, seconds):
+    """
+    Where to feed the (fragmented MP4) recordings from to pick up
+    at the first fragment starting at `seconds` or later, by its timestamp,
+    fragments starting with keyframes:
+    [(end of the init segment, fragment offset, fragment start seconds)],
+    None for the recordings that can't tell, None if not recorded that far.
+    """
+    points = []
+    for infile in infiles:
+        try:
+            starts = probe.fragment_starts(infile + '.part'
+                                           if os.path.exists(infile + '.part')
+                                           else infile)
+        except FileNotFoundError:  # renamed meanwhile
+            starts = probe.fragment_starts(infile)
+        if starts is None:
+            points.append(None)
+            continue
+        init_end, found = starts
+        point = next(((init_end, offset, start) for offset, start in found
+                      if start >= seconds - SEEK_TOLERANCE), None)
+        if point is None:
+            return None
+        points.append(point)
+    return points
+
+
+def _save_sliced_until(path, count, seconds):
+    with open(path + '.tmp', 'w') as f:
+        json.dump({'slices': count, 'until': seconds}, f)
+    os.rename(path + '.tmp', path)
+
+
+def _sliced_until(path, outbasename, outext, count, points):
+    """
+    Tell where the `count` slices published before end,
+    as saved by whoever has published them, if it's the same slices,
+    or guess by their durations from the start of the recordings.
+    """
+    try:
+        with open(path) as f:
+            saved = json.load(f)
+        if saved['slices'] == count:
+            return saved['until']
+    except (FileNotFoundError, json.JSONDecodeError, KeyError):
+        pass
+    return min(seconds for _, _, seconds in points) + sum(
+        probe.duration(f'{outbasename}.{i:02d}.{outext}') or 0
+        for i in range(count)
+    )
+
+
+def _feed(filename, fifo, proc, its_over_event, seek=None):
+    """
+    Copy a recording into a FIFO ffmpeg reads from, following it as it grows,
+    until the stream is over or nothing has been added for a while.
+    With `seek` (end of the init segment, offset), skip to `offset`
+    right after the init segment.
+    """
+    while True:  # without blocking forever on an ffmpeg that's gone
+        try:
+            fd = os.open(fifo, os.O_WRONLY | os.O_NONBLOCK)
+            break
+        except OSError:
+            if proc.poll() is not None:
+                return
+            time.sleep(.1)
+    os.set_blocking(fd, True)
+    try:
+        f = open(filename + '.part', 'rb')
+    except FileNotFoundError:  # finished and renamed
+        f = open(filename, 'rb')
+    try:
+        with f, open(fd, 'wb') as out:
+            if seek is not None:
+                init_end, offset = seek
+                out.write(f.read(init_end))
+                f.seek(offset)
+            grown = time.time()
+            while True:
+                chunk = f.read(1 << 20)
+                if chunk:
+                    out.write(chunk)
+                    grown = time.time()
+                elif (its_over_event.is_set() or
+                        time.time() > grown + SEGMENT_STALL_SECONDS):
+                    break
+                else:
+                    time.sleep(1)
+    except BrokenPipeError:  # ffmpeg has exited
+        pass
+
+
+def _segment(infiles, outbasename, outext, slice_duration, start, points,
+             listfile, its_over_event, audio_only=False):
+    """
+    Start an ffmpeg cutting the growing recordings into slices
+    from the `start`th one on, listing the finished ones in `listfile`.
+    The recordings are fed to it through FIFOs, see _feed,
+    from the `points` found by _seek_points, if any,
+    offset against each other to keep them in sync.
+    """
+    fifos = [f'{listfile}.{i}' for i in range(len(infiles))]
+    for fifo in fifos:
+        if os.path.exists(fifo):
+            os.unlink(fifo)
+        os.mkfifo(fifo)
+    if points is None:
+        inputs = [ffmpeg.input(fifo) for fifo in fifos]
+    else:
+        base = min(seconds for _, _, seconds in points)
+        inputs = [ffmpeg.input(fifo, itsoffset=seconds - base)
+                  for fifo, (_, _, seconds) in zip(fifos, points)]
+    if not audio_only:
+        codec_kwargs = {'vcodec': 'copy', 'acodec': 'copy'}
+    else:
+        codec = _audio_codec(infiles[0] + '.part'
+                             if os.path.exists(infiles[0] + '.part')
+                             else infiles[0])
+        fitting = COPY_CODECS.get(outext, ())
+        if codec is not None and (fitting is None or codec in fitting):
+            codec_kwargs = {'vn': None, 'acodec': 'copy'}
+        else:
+            codec_kwargs = {'vn': None, 'acodec': outext, 'strict': -2}
+        print(f'segmenting {codec} audio into {outext} with '
+              f'{codec_kwargs["acodec"]}', file=sys.stderr)
+    if os.path.exists(listfile):
+        os.unlink(listfile)
+    proc = ffmpeg.output(*inputs, f'{outbasename}.%02d.tmp.{outext}',
+                         f='segment', segment_time=slice_duration,
+                         segment_start_number=start, reset_timestamps=1,
+                         segment_list=listfile, segment_list_type='csv',
+                         **codec_kwargs)\
+                 .global_args('-hide_banner', '-loglevel', 'error')\
+                 .run_async()
+    for i, (infile, fifo) in enumerate(zip(infiles, fifos)):
+        seek = points[i][:2] if points is not None else None
+        threading.Thread(target=_feed, daemon=True,
+                         args=(infile, fifo, proc, its_over_event,
+                               seek)).start()
+    return proc
+
+
+def _publish_segments(listfile, published, outbasename, drop_last=False):
+    """
+    Move the slices ffmpeg has finished into place, return how many
+    and where the last of them ends, in seconds from where ffmpeg started.
+    With `drop_last`, discard the last one, cut short by ffmpeg exiting.
+    """
+    try:
+        with open(listfile, newline='') as f:
+            rows = [row for row in csv.reader(f) if row]
+    except FileNotFoundError:
+        return published, None
+    dir_ = os.path.dirname(outbasename)
+    if drop_last and len(rows) > published:
+        os.unlink(os.path.join(dir_, rows.pop()[0]))
+    for name, _, _ in rows[published:]:
+        out = os.path.join(dir_, '.'.join(name.rsplit('.tmp.', 1)))
+        os.rename(os.path.join(dir_, name), out)
+        print(f'{out} written', file=sys.stderr)
+    return len(rows), float(rows[-1][2]) if rows else None
+
+
+def _segmenting(renew_lease, dirs, outbasename, outext, slice_duration,
+                its_over_event, progress, listfile, audio_only):
+    """
+    Run the segmenter loop, tell whether it has made it to the end,
+    None if the lease has been lost and it's stopped publishing.
+    A restarted ffmpeg picks up at the first keyframe after the end
+    of the slices published before, as timestamped in the recordings,
+    which can be restarted into new files meanwhile.
+    """
+    files, proc, published, renewed, sought = {}, None, 0, 0, 0
+    base = None  # where ffmpeg has started, as timestamped in the recordings
+    sliced_until = None  # where the published slices end, likewise
+    sliced_until_path = os.path.join(os.path.dirname(listfile),
+                                     'sliced_until')
+
+    def publish(drop_last=False):
+        nonlocal published, sliced_until
+        newly_published, end = _publish_segments(listfile, published,
+                                                  outbasename, drop_last)
+        if newly_published > published and base is not None:
+            sliced_until = base + end
+            _save_sliced_until(sliced_until_path, start + newly_published,
+                               sliced_until)
+        published = newly_published
+
+    while True:
+        if time.time() > renewed + 20:
+            if not renew_lease():
+                if proc is not None:
+                    proc.terminate()
+                    proc.wait()
+                return None
+            renewed = time.time()
+        try:
+            message = progress.get(timeout=5)
+        except queue.Empty:
+            message = None
+        if message is not None:
+            dir_, filename, _, _ = message
+            files[dir_] = filename
+
+        if proc is None:
+            if its_over_event.is_set():
+                return False
+            if len(files) < len(dirs) or time.time() < sought + PROBE_SECONDS:
+                continue
+            sought = time.time()
+            infiles = [files[d] for d in dirs]
+            start = _slices_done(outbasename, outext)
+            points = _seek_points(infiles, sliced_until or 0)
+            if points is not None and start and sliced_until is None:
+                sliced_until = _sliced_until(sliced_until_path, outbasename,
+                                             outext, start, points)
+                points = _seek_points(infiles, sliced_until)
+            if points is None:
+                continue  # not recorded that far yet
+            if None in points:
+                if start:
+                    print(f'cannot seek in {infiles}', file=sys.stderr)
+                    return False
+                points = None  # can only segment from the very start
+            base = (min(seconds for _, _, seconds in points)
+                    if points is not None else None)
+            print(f'segmenting {outbasename} from slice {start}'
+                  + (f' at {base:.1f}s' if base is not None else ''),
+                  file=sys.stderr)
+            proc = _segment(infiles, outbasename, outext, slice_duration,
+                            start, points, listfile, its_over_event,
+                            audio_only)
+            published = 0
+            proctitle(f'segmenting from slice {start}')
+            continue
+
+        if proc.poll() is None:
+            publish()
+            continue
+        over = its_over_event.is_set()  # otherwise the recording stalled
+        publish(drop_last=not over)
+        print(f'segmenting {outbasename} exited with {proc.returncode}',
+              file=sys.stderr)
+        if over:
+            return proc.returncode == 0
+        proc = None
+        time.sleep(15)  # cooling down
+
+
+def segmenter(log_prefix, renew_lease,
+              dirs, outbasename, outext, slice_duration,
+              its_over_event, progress, audio_only=False):
+    """
+    Slice the recordings with a single ffmpeg following them as they grow,
+    (re)started once the recorders have told through `progress`
+    which files they write.
+    Exits with 1 if it hasn't made it to the end, the final slicing will,
+    and with LEASE_LOST once another host has taken the stream over.
+    """
+    listfile = os.path.join(os.path.dirname(dirs[0]), 'segments')
+    proctitle('waiting...')
+    try:
+        done = _segmenting(renew_lease, dirs, outbasename, outext,
+                           slice_duration, its_over_event, progress,
+                           listfile, audio_only)
+    finally:
+        for x in glob.glob(listfile + '*'):  # the list and the FIFOs
+            os.unlink(x)
+    if done is None:
+        print(f'{log_prefix}: lease lost, stopping', file=sys.stderr)
+        sys.exit(LEASE_LOST)
+    if not done:
+        print(f'{log_prefix}: leaving the rest to the final slicing',
+              file=sys.stderr)
+        sys.exit(1)
+    print('segmenter done', file=sys.stderr)
+    proctitle('done')
+
+
+def _stream(config, entry_info, feed, workdir, profile, progress,
+            video=False):
     video_or_audio = 'video' if video else 'audio'
     live_profile_cfg = config['profiles'][profile]['live']
     live_opts = live_profile_cfg.get('video' if video else 'audio', {})
@@ -168,7 +542,14 @@ def _stream(config, entry_info, feed, workdir, profile, video=False):
         'keepvideo': True,
         'skip_unavailable_fragments': False,
         'noprogress': True,
-        'progress_hooks': [make_progress_hook(pretty_log_name)],
+        'progress_hooks': [
+            make_progress_hook(
+                pretty_log_name,
+                publish=lambda filename, count, media_time:
+                    progress.put((workdir, filename, count, media_time)),
+            ),
+            bandwidth.make_progress_hook(config, 'live', feed),
+        ],
         'outtmpl': 'media',
         'paths': {
             'temp': workdir,
@@ -187,6 +568,9 @@ def _stream(config, entry_info, feed, workdir, profile, video=False):
         **dl_options(config, 'all'),
         **live_opts,
     }
+    dl_opts.setdefault('concurrent_fragment_downloads',
+                       fragments.concurrency(config, profile,
+                                             dl_opts.get('proxy')))
 
     os.makedirs(workdir, exist_ok=True)
 
@@ -207,17 +591,15 @@ def _stream(config, entry_info, feed, workdir, profile, video=False):
                           file=sys.stderr)
                     break
 
-            pretty_log_name = (f'{profile}/{"v" if video else "a"}'
-                               f'{entry_info["id"]} {entry_info["title"]}')
-            pretty_log_name = shorten(pretty_log_name)
+                pretty_log_name = (f'{profile}/{"v" if video else "a"}'
+                                   f'{entry_info["id"]} {entry_info["title"]}')
+                pretty_log_name = shorten(pretty_log_name)
 
-            # we need data with formats resorted according to profile
-            # and writing an info_file is too much hassle, FIXME
-            proctitle('downloading...')
-            with yt_dlp.YoutubeDL(dl_opts) as ydl:
-                r = ydl.download(url)
-                if r == 0:
-                    os._exit(0)
+                # formats are already sorted according to the profile,
+                # download what has just been extracted
+                proctitle('downloading...')
+                ydl.process_ie_result(info, download=True)
+                os._exit(0)
         except Exception as ex:
             print(pretty_log_name, 'ERROR', type(ex), ex, file=sys.stderr)
             print(pretty_log_name, 'cooling down...', file=sys.stderr)
@@ -235,24 +617,20 @@ def stream(config, feed, entry_info, entry_pathogen, profile, video=True):
     slice_seconds = config['feeds'][feed]['live_slice_seconds']
     dir_ = os.path.join(config['paths']['live'], profile, feed)
 
-    pseudolockfile = entry_pathogen('meta', f'pseudolock-{profile}')  # tmp?
-    print(f'{pretty_log_name}: {pseudolockfile}...', file=sys.stderr)
-    while True:
-        proctitle('waiting for pseudolock...')
-        if not os.path.exists(pseudolockfile):
-            break
-        t = os.stat(pseudolockfile).st_mtime
-        proctitle('waiting for pseudolock to free up...')
-        print(f'pseudolock age: {time.time() - t}s', file=sys.stderr)
-        if time.time() - t > slice_seconds * 2 + 5:
-            print('pseudolockfile got too old', file=sys.stderr)
-            break
+    # one host streams it, another one takes over if it goes down
+    lease = f'stream-{feed}-{entry_info["id"]}-{profile}'
+    lease_seconds = slice_seconds * 2 + 5
+    print(f'{pretty_log_name}: lease {lease}...', file=sys.stderr)
+    proctitle('waiting for lease...')
+    while not leases.acquire(config, lease, lease_seconds):
+        print(f'{pretty_log_name}: lease held by '
+              f'{leases.held(config, lease)}', file=sys.stderr)
+        proctitle('waiting for lease to free up...')
         time.sleep(slice_seconds // 10)
-    proctitle('pseudolocking...')
-    with open(pseudolockfile, 'w') as f:
-        f.write(str(time.time()))
-    proctitle('pseudolocked')
-    print(f'{pretty_log_name}: {pseudolockfile} acquired.', file=sys.stderr)
+    proctitle('leased')
+    print(f'{pretty_log_name}: lease {lease} acquired.', file=sys.stderr)
+    renew_lease = functools.partial(leases.renew, config, lease,
+                                    lease_seconds, leases.holder())
     start = time.time()
 
     fname = f'{entry_info["upload_date"][4:]}.{entry_info["id"][:4]}'
@@ -263,56 +641,71 @@ def stream(config, feed, entry_info, entry_pathogen, profile, video=True):
     merge_dirs = [dir_video, dir_audio] if video else [dir_audio]
 
     os.makedirs(dir_, exist_ok=True)
+    progress = multiprocessing.Queue()  # from the recorders to the slicer
     if video:
         stream_video_p =start_process(
                 f'stream/video {entry_info["id"]}', _stream,
-                config, entry_info, feed, dir_video, profile, True
+                config, entry_info, feed, dir_video, profile, progress, True
         )
     stream_audio_p = start_process(
             f'stream/audio {entry_info["id"]}', _stream,
-            config, entry_info, feed, dir_audio, profile, False
+            config, entry_info, feed, dir_audio, profile, progress, False
     )
     its_over_event = multiprocessing.Event()
     def debug_handler(s, f):
         print(f'signal {s} {f}', file=sys.stderr)
         its_over_event.set()
     signal.signal(signal.SIGUSR1, debug_handler)  # debug
+    slicing = config['feeds'][feed]['live_slicing']
     intermerger_p = start_process(
-            f'stream/slice {entry_info["id"]}', intermerger,
-            pretty_log_name, pseudolockfile,
+            f'stream/slice {entry_info["id"]}',
+            segmenter if slicing == 'segment' else intermerger,
+            pretty_log_name, renew_lease,
             merge_dirs, outbasename, outext,
-            slice_seconds, its_over_event, not video
+            slice_seconds, its_over_event, progress, not video
     )
 
     proctitle('waiting for streams...')
-    if video:
-        stream_video_p.join()
-    stream_audio_p.join()
+    recorders = [stream_video_p, stream_audio_p] if video else [stream_audio_p]
+    while (any(p.is_alive() for p in recorders) and
+           intermerger_p.exitcode != LEASE_LOST):
+        multiprocessing.connection.wait(
+            [p.sentinel for p in recorders + [intermerger_p]
+             if p.is_alive()]
+        )
+    for p in recorders:  # only still running if the lease has been lost
+        p.terminate()
+        p.join()
     print('>>>', 'it\'s over...', file=sys.stderr)
     its_over_event.set()
+    progress.put(None)
     proctitle('waiting for slicer...')
     intermerger_p.join()
     print('>>>', 'intermerger has finished...', file=sys.stderr)
+    if intermerger_p.exitcode == LEASE_LOST:  # another host streams it
+        print(f'{pretty_log_name}: lease lost, stopped livestreaming',
+              file=sys.stderr)
+        proctitle('lease lost')
+        return
 
-    proctitle('waiting for final slicing...')
-    fds = [get_file_and_duration(dir_) for dir_ in merge_dirs]
-    fds = [fd for fd in fds if fd is not None]
-    if not fds:
-        for dir_ in merge_dirs:
-            print(f'ls -l {dir_}:')
-            os.system(f'ls -l {dir_}')
-    assert fds
-    infiles = [f for f, d in fds]
-    durations = [d for f, d in fds]
-    observed_duration = min(durations) if durations else 0
-    slice_and_merge_final(infiles, outbasename, outext, observed_duration,
-                          slice_seconds, audio_only=(not video))
-
-    os.unlink(pseudolockfile)
+    if slicing != 'segment' or intermerger_p.exitcode != 0:
+        proctitle('waiting for final slicing...')
+        fds = [get_file_and_duration(dir_) for dir_ in merge_dirs]
+        fds = [fd for fd in fds if fd is not None]
+        if not fds:
+            for dir_ in merge_dirs:
+                print(f'ls -l {dir_}:')
+                os.system(f'ls -l {dir_}')
+        assert fds
+        infiles = [f for f, d in fds]
+        durations = [d for f, d in fds]
+        observed_duration = min(durations) if durations else 0
+        slice_and_merge_final(infiles, outbasename, outext,
+                              observed_duration, slice_seconds,
+                              audio_only=(not video))
+
+    leases.release(config, lease)
     print(f'{pretty_log_name} has finished livestreaming '
           f'in {time.time() - start:.1f}s')
     proctitle('done')
-
-    if video:
-        shutil.rmtree(dir_video)
-    shutil.rmtree(dir_audio)
+    # the recordings are left behind for the VOD to be made of
@@ -15,6 +15,7 @@ import feedgen.feed
 
 import yousable.front.best_thumbnail
 import yousable.front.chapters_extensions
+import yousable.front.live
 
 
 def generate_entry(config, profile, feed_name, url_maker, fg, entry_id,
@@ -69,6 +70,11 @@ def generate_entry(config, profile, feed_name, url_maker, fg, entry_id,
                        ', '.join(f'<a href="vlc://{_u}">{_p}</a>'
                                  for _p, _u in alts.items()) +
                        '\n\n' + description)
+    if (e.get('live_status') == 'is_live' and
+            yousable.front.live.recording(config, feed_name, entry_id,
+                                          profile, 'audio')):
+        u = url_maker(f'live/{feed_name}/{entry_id}/{profile}.m3u8')
+        description = f'Follow live: <a href="{u}">HLS</a>\n\n' + description
     fe.description(description)
 
     if 'duration' in e:
@@ -104,6 +110,9 @@ def generate_entry(config, profile, feed_name, url_maker, fg, entry_id,
     if os.path.exists(media_file):
         u = url_maker(f'download/{feed_name}/{entry_id}.{profile}.{container}')
         fe.enclosure(u, str(os.path.getsize(media_file)), mime)
+    elif config['profiles'][profile]['lazy']:  # made on the first request
+        u = url_maker(f'download/{feed_name}/{entry_id}.{profile}.{container}')
+        fe.enclosure(u, '0', mime)
 
 
 def feed(config, profile, feed_name, extra_opts, url_maker):
@@ -0,0 +1,258 @@
+# SPDX-FileCopyrightText: 2024 Alexander Sosedkin <monk@unboiled.info>
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+# Restreaming the livestreams being recorded over (low-latency) HLS.
+# The fragmented MP4 files the recorders write to paths.tmp
+# are indexed as they grow and served as segments made of their fragments,
+# each fragment also being an LL-HLS part, without remuxing anything.
+# Blocking playlist reloads hold a worker while waiting,
+# so the front-end has to run with threaded workers (up to BLOCKING_MAX
+# of them wait at once, other reloads are answered right away).
+
+import bisect
+import collections
+import glob
+import math
+import os
+import threading
+import time
+
+import yousable.back.probe as probe
+
+
+TRACKS = ('video', 'audio')
+CACHE_SIZE = 64
+RELOAD_POLL_SECONDS = .2
+BLOCKING_MAX = 16  # blocking reloads waiting at once
+PART_SAMPLE = 3  # the first fragments fixing the target durations
+
+_indices = collections.OrderedDict()  # path -> index
+_lock = threading.Lock()
+_blocking = threading.BoundedSemaphore(BLOCKING_MAX)
+
+
+def recording(config, feed, entry_id, profile, track):
+    """(path, finished) of the recording of a track, None if there's none."""
+    dir_ = os.path.join(config['paths']['tmp'], feed, entry_id, profile,
+                        track)
+    files = [f for f in glob.glob(os.path.join(dir_, '*'))
+             if not f.endswith('.ytdl') and '-Frag' not in f]
+    parts = [f for f in files if f.endswith('.part')]
+    try:
+        path = max(parts or files, key=os.path.getsize, default=None)
+    except FileNotFoundError:  # renamed meanwhile
+        return recording(config, feed, entry_id, profile, track)
+    return (path, not parts) if path is not None else None
+
+
+def index(path):
+    """
+    Index a recording, continuing from where the last call has left off:
+    {'tracks', 'init_end', 'fragments': [(start, end, seconds)],
+     'part_target': the longest of the first fragments, once known, ...}.
+    """
+    with _lock:
+        st = os.stat(path)
+        idx = _indices.pop(path, None)
+        if idx is None or idx['ino'] != st.st_ino or \
+                st.st_size < idx['offset']:  # a different file now
+            idx = {'ino': st.st_ino, 'offset': 0, 'tracks': None,
+                   'init_end': None, 'fragments': [], 'part_target': None}
+        if st.st_size > idx['offset']:
+            with open(path, 'rb') as f:
+                tracks, init_end, found, idx['offset'] = probe.fragments(
+                    f, st.st_size, idx['offset'], idx['tracks']
+                )
+            idx['tracks'] = tracks
+            idx['init_end'] = idx['init_end'] or init_end
+            idx['fragments'].extend(found)
+            if (idx['part_target'] is None and
+                    len(idx['fragments']) >= PART_SAMPLE):
+                idx['part_target'] = max(seconds for _, _, seconds
+                                         in idx['fragments'][:PART_SAMPLE])
+        _indices[path] = idx
+        if len(_indices) > CACHE_SIZE:
+            _indices.popitem(last=False)
+        return idx
+
+
+def targets(idx, target_seconds, finished):
+    """
+    (target duration, part target) of the playlists of a recording,
+    fixed once its first fragments are in, None until then.
+    """
+    part_target = idx['part_target']
+    if part_target is None and finished and idx['fragments']:
+        part_target = max(seconds for _, _, seconds in idx['fragments'])
+    if not part_target:
+        return None
+    return math.ceil(target_seconds + part_target), part_target
+
+
+def segments(fragments, target_seconds, target_duration, finished):
+    """
+    Group fragments into segments at least `target_seconds` long
+    but no longer than `target_duration`,
+    return them and the fragments of the segment still growing.
+    """
+    closed, growing, seconds = [], [], 0
+    for fragment in fragments:
+        if growing and seconds + fragment[2] > target_duration:
+            closed.append(growing)
+            growing, seconds = [], 0
+        growing.append(fragment)
+        seconds += fragment[2]
+        if seconds >= target_seconds:
+            closed.append(growing)
+            growing, seconds = [], 0
+    if finished and growing:
+        closed.append(growing)
+        growing = []
+    return closed, growing
+
+
+def _seconds(fragments):
+    return sum(seconds for _, _, seconds in fragments)
+
+
+def _uri(track, fragments):
+    return f'{track}/{fragments[0][0]}-{fragments[-1][1]}.m4s'
+
+
+def ready(closed, growing, msn, part=None):
+    """Tell whether a playlist has the segment (or part) asked for."""
+    if part is None:
+        return len(closed) > msn
+    return len(closed) > msn or len(closed) == msn and len(growing) > part
+
+
+def wait(path, finished, target_seconds, msn, part=None):
+    """
+    Serve a blocking playlist reload,
+    waiting for the segment (or part) asked for to be recorded.
+    Returns the HTTP status to respond with: 200 once it's there,
+    the recording is over or too many reloads are waiting already,
+    400 if it's too far ahead to wait for, 503 if it hasn't come in time.
+    """
+    if finished or not _blocking.acquire(blocking=False):
+        return 200
+    try:
+        idx = index(path)
+        t = targets(idx, target_seconds, finished)
+        if t is None:
+            return 503
+        closed, growing = segments(idx['fragments'], target_seconds, t[0],
+                                   finished)
+        if msn > len(closed) + 1:  # past the last one plus two
+            return 400
+        deadline = time.time() + 3 * t[0]
+        while not ready(closed, growing, msn, part):
+            if time.time() > deadline:
+                return 503
+            time.sleep(RELOAD_POLL_SECONDS)
+            closed, growing = segments(index(path)['fragments'],
+                                       target_seconds, t[0], finished)
+        return 200
+    finally:
+        _blocking.release()
+
+
+def media_playlist(config, feed, track, path, finished):
+    """The media playlist of a recording, None if it's too early for one."""
+    feed_cfg = config['feeds'][feed]
+    target_seconds = feed_cfg['live_hls_segment_seconds']
+    window = feed_cfg['live_hls_window_seconds']
+    idx = index(path)
+    t = targets(idx, target_seconds, finished)
+    if t is None:
+        return None
+    target_duration, part_target = t
+    closed, growing = segments(idx['fragments'], target_seconds,
+                               target_duration, finished)
+
+    first = 0
+    if window is not None:  # slide, keeping `window`
+        first, kept = len(closed), 0
+        while first > 0 and kept < window:
+            first -= 1
+            kept += _seconds(closed[first])
+
+    lines = ['#EXTM3U', '#EXT-X-VERSION:6',
+             f'#EXT-X-TARGETDURATION:{target_duration}']
+    if not finished:
+        lines += ['#EXT-X-SERVER-CONTROL:CAN-BLOCK-RELOAD=YES,'
+                  f'PART-HOLD-BACK={3 * part_target:.3f}',
+                  f'#EXT-X-PART-INF:PART-TARGET={part_target:.3f}']
+    if window is None:
+        lines.append('#EXT-X-PLAYLIST-TYPE:EVENT')
+    lines += [f'#EXT-X-MEDIA-SEQUENCE:{first}',
+              f'#EXT-X-MAP:URI="{track}/init.mp4"']
+    for n, segment in enumerate(closed[first:], first):
+        if not finished and n >= len(closed) - 3:  # near the live edge
+            lines += [f'#EXT-X-PART:DURATION={seconds:.3f},'
+                      f'URI="{_uri(track, [(start, end, seconds)])}"'
+                      for start, end, seconds in segment]
+        lines += [f'#EXTINF:{_seconds(segment):.3f},', _uri(track, segment)]
+    lines += [f'#EXT-X-PART:DURATION={seconds:.3f},'
+              f'URI="{_uri(track, [(start, end, seconds)])}"'
+              for start, end, seconds in growing]
+    if finished:
+        lines.append('#EXT-X-ENDLIST')
+    return '\n'.join(lines) + '\n'
+
+
+def _bandwidth(path):
+    """Peak bits per second of the fragments of a recording."""
+    return max([int((end - start) * 8 / seconds)
+                for start, end, seconds in index(path)['fragments']
+                if seconds] or [0])
+
+
+def master_playlist(profile, recordings):
+    """Point to the media playlists of the tracks recorded."""
+    bandwidth = max(1, sum(_bandwidth(path)
+                           for path, _ in recordings.values()))
+    lines = ['#EXTM3U', '#EXT-X-VERSION:6']
+    if 'video' in recordings:
+        lines += ['#EXT-X-MEDIA:TYPE=AUDIO,GROUP-ID="audio",NAME="audio",'
+                  f'DEFAULT=YES,AUTOSELECT=YES,URI="{profile}/audio.m3u8"',
+                  f'#EXT-X-STREAM-INF:BANDWIDTH={bandwidth},AUDIO="audio"',
+                  f'{profile}/video.m3u8']
+    else:
+        lines += [f'#EXT-X-STREAM-INF:BANDWIDTH={bandwidth}',
+                  f'{profile}/audio.m3u8']
+    return '\n'.join(lines) + '\n'
+
+
+def init(path):
+    """The ftyp and moov boxes of a recording, None if not written yet."""
+    init_end = index(path)['init_end']
+    if init_end is None:
+        return
+    with open(path, 'rb') as f:
+        return b''.join(_read(f, start, end)
+                        for box_type, start, end in probe.boxes(f, 0,
+                                                                init_end)
+                        if box_type in (b'ftyp', b'moov'))
+
+
+def fragment_range(path, start, end):
+    """
+    The moof and mdat boxes of a segment or a part of a recording,
+    None if it doesn't start and end at the fragment boundaries.
+    """
+    fragments = index(path)['fragments']
+    i = bisect.bisect_left(fragments, (start,))
+    j = bisect.bisect_left(fragments, (end,))
+    if (i >= len(fragments) or fragments[i][0] != start or
+            not any(e == end for _, e, _ in fragments[i:j + 1])):
+        return
+    with open(path, 'rb') as f:
+        return b''.join(_read(f, s, e)
+                        for box_type, s, e in probe.boxes(f, start, end)
+                        if box_type in (b'moof', b'mdat'))
+
+
+def _read(f, start, end):
+    f.seek(start)
+    return f.read(end - start)
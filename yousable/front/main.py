@@ -13,6 +13,12 @@ from flask_httpauth import HTTPBasicAuth
 import werkzeug.security
 
 import yousable
+import yousable.back.demand
+import yousable.front.live
+import yousable.tiers
+
+RETRY_AFTER_SECONDS = 120  # for the files being prepared on request
+PLAYLIST_MIME = 'application/vnd.apple.mpegurl'
 
 
 def create_app(config=None):
@@ -22,6 +28,11 @@ def create_app(config=None):
     config = config or yousable.main.load_config()
     app.config.update(config)
 
+    # create the schemas once, the requests reuse a connection per thread
+    yousable.access.connect(config).close()
+    if yousable.tiers.enabled(config):
+        yousable.tiers.connect(config).close()
+
 
     @app.route('/')
     def root():
@@ -80,6 +91,7 @@ def create_app(config=None):
                    else 'default')
         if profile not in app.config['profiles']:
             return f'`profile `{profile}` not specified in configuration', 500
+        yousable.access.record_demand(app.config, feed_name, profile, 'poll')
         return yousable.front.feed.feed(app.config, profile, feed_name,
                                         extra_opts, url_maker)
 
@@ -98,19 +110,28 @@ def create_app(config=None):
         if profile not in app.config['profiles']:
             return f'`profile `{profile}` not specified in configuration', 500
 
-        out_path = os.path.join(feed_name, entry_id, f'{profile}.{container}')
-        server_path = os.path.join(app.config['paths']['x_accel'], out_path)
-        file_path = os.path.join(app.config['paths']['out'], out_path)
+        yousable.access.record_demand(app.config, feed_name, profile,
+                                      'download')
+        file_path, server_path = yousable.tiers.locate(
+            app.config, feed_name, entry_id, f'{profile}.{container}'
+        )
         if not os.path.exists(file_path):
+            if (container == app.config['profiles'][profile]['container'] and
+                    yousable.back.demand.request(app.config, feed_name,
+                                                 entry_id, profile)):
+                return (f'`{feed_name}/{entry_id}.{profile}.{container}` '
+                        'is being prepared', 503,
+                        {'Retry-After': str(RETRY_AFTER_SECONDS)})
             return (f'`{feed_name}/{entry_id}.{profile}.{container}` '
                     'not present', 404)
+        yousable.access.record(app.config, feed_name, entry_id, profile)
 
         profile_config = app.config['profiles'][profile]
         audio_video = 'video' if profile_config['video'] else 'audio'
         mime = f'{audio_video}/{container}'
         name = f'{entry_id}.{profile}.{container}'
 
-        if app.config['paths']['x_accel'] is not None:
+        if server_path is not None:
             response = flask.make_response()
             response.headers['Content-Description'] = 'File Transfer'
             response.headers['Cache-Control'] = 'no-cache'
@@ -125,6 +146,91 @@ def create_app(config=None):
             return flask.send_file(file_path, mimetype=mime,
                                    as_attachment=True, download_name=name)
 
+
+    def live_recording(feed_name, entry_id, profile, track):
+        if feed_name not in app.config['feeds']:
+            flask.abort(400, f'`{feed_name}` not in config.feeds')
+        if profile not in app.config['profiles']:
+            flask.abort(500,
+                        f'`profile `{profile}` not specified in configuration')
+        if (track not in yousable.front.live.TRACKS or track == 'video' and
+                not app.config['profiles'][profile]['video']):
+            flask.abort(404, f'no `{track}` track in `{profile}`')
+        r = yousable.front.live.recording(app.config, feed_name, entry_id,
+                                          profile, track)
+        if r is None:
+            flask.abort(404, f'`{feed_name}/{entry_id}` is not being '
+                             f'recorded with `{profile}`')
+        return r
+
+
+    @app.route('/live/<feed_name>/<entry_id>/<profile>.m3u8')
+    @login_required
+    def live(feed_name, entry_id, profile):
+        recordings = {'audio': live_recording(feed_name, entry_id, profile,
+                                              'audio')}
+        if app.config['profiles'][profile]['video']:
+            recordings['video'] = live_recording(feed_name, entry_id,
+                                                 profile, 'video')
+        try:
+            playlist = yousable.front.live.master_playlist(profile,
+                                                           recordings)
+        except FileNotFoundError:
+            return f'`{feed_name}/{entry_id}` recording is gone', 404
+        return playlist, {'Content-Type': PLAYLIST_MIME,
+                          'Cache-Control': 'no-cache'}
+
+
+    @app.route('/live/<feed_name>/<entry_id>/<profile>/<track>.m3u8')
+    @login_required
+    def live_track(feed_name, entry_id, profile, track):
+        path, finished = live_recording(feed_name, entry_id, profile, track)
+        target_seconds = \
+                app.config['feeds'][feed_name]['live_hls_segment_seconds']
+        try:
+            if '_HLS_msn' in flask.request.args:  # blocking reload
+                part = flask.request.args.get('_HLS_part')
+                status = yousable.front.live.wait(
+                    path, finished, target_seconds,
+                    int(flask.request.args['_HLS_msn']),
+                    int(part) if part is not None else None
+                )
+                if status == 400:
+                    return '`_HLS_msn` is too far ahead', 400
+                if status == 503:
+                    return ('not recorded in time', 503,
+                            {'Retry-After': str(target_seconds)})
+            playlist = yousable.front.live.media_playlist(
+                app.config, feed_name, track, path, finished
+            )
+        except ValueError:
+            return '`_HLS_msn` and `_HLS_part` must be integers', 400
+        except FileNotFoundError:
+            return f'`{feed_name}/{entry_id}` recording is gone', 404
+        if playlist is None:
+            return ('not enough recorded yet', 503,
+                    {'Retry-After': str(target_seconds)})
+        return playlist, {'Content-Type': PLAYLIST_MIME,
+                          'Cache-Control': 'no-cache'}
+
+
+    @app.route('/live/<feed_name>/<entry_id>/<profile>/<track>/init.mp4')
+    @app.route('/live/<feed_name>/<entry_id>/<profile>/<track>/'
+               '<int:start>-<int:end>.m4s')
+    @login_required
+    def live_media(feed_name, entry_id, profile, track, start=None,
+                   end=None):
+        path, _ = live_recording(feed_name, entry_id, profile, track)
+        try:
+            data = (yousable.front.live.init(path) if start is None else
+                    yousable.front.live.fragment_range(path, start, end))
+        except FileNotFoundError:
+            return f'`{feed_name}/{entry_id}` recording is gone', 404
+        if data is None:
+            return f'no such part of `{feed_name}/{entry_id}` recording', 404
+        return data, {'Content-Type': f'{track}/mp4',
+                      'Cache-Control': 'no-cache'}
+
     return app
 
 
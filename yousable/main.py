@@ -15,18 +15,40 @@ def load_config():
     SPONSORBLOCKS = confuse.Sequence(confuse.Choice(
         list(yousable.sponsorblock.CATEGORIES)
     ))
+    SPONSORBLOCK_CUTS = ('fast', 'smart', 'exact')
+    LIVE_SLICINGS = ('cut', 'segment')
     CONTAINER_CHOICES = (
         'avi', 'flv', 'mkv', 'mov', 'mp4', 'webm', 'aac', 'aiff', 'alac',
         'flac', 'm4a', 'mka', 'mp3', 'ogg', 'opus', 'vorbis', 'wav'
     )
+    CONFIG_FILTERS = {
+        'id_prefix_reject': confuse.Sequence(str),
+        'min_duration': confuse.Optional(int),
+        'max_duration': confuse.Optional(int),
+        'max_age_seconds': confuse.Optional(int),
+        'title_match': confuse.Optional(str),
+        'title_reject': confuse.Optional(str),
+        'live_status_reject': confuse.Sequence(str),
+        'availability_reject': confuse.Sequence(str),
+        'reject_shorts': bool,
+        'match_filter': confuse.Optional(str),
+    }
     CONFIG_FEED_DEFAULTS = {
         'load_entries': int,
         'keep_entries': int,
         'keep_entries_seconds': int,
         'poll_seconds': int,
+        'revisit_seconds': int,
         'profiles': confuse.Sequence(str),
         'sponsorblock_remove': confuse.Sequence(confuse.Choice(SPONSORBLOCKS)),
+        'sponsorblock_cut': confuse.Choice(SPONSORBLOCK_CUTS),
         'live_slice_seconds': int,
+        'live_slicing': confuse.Choice(LIVE_SLICINGS),
+        'live_hls_segment_seconds': int,
+        'live_hls_window_seconds': confuse.Optional(int),
+        'live_wakeup_seconds': int,
+        'bandwidth_daily_bytes': confuse.Optional(int),
+        'filters': CONFIG_FILTERS,
     }
 
     config = confuse.Configuration('yousable', __name__)
@@ -36,6 +58,10 @@ def load_config():
     feed_defaults = config.get({'feed_defaults': CONFIG_FEED_DEFAULTS})
     feed_defaults = feed_defaults['feed_defaults']
     profile_names = confuse.Choice(list(config.get()['profiles'].keys()))
+    config_template_filters = confuse.MappingTemplate({
+        k: confuse.Optional(v, default=feed_defaults['filters'][k])
+        for k, v in CONFIG_FILTERS.items()
+    })
 
     config_template_feed = {
         'url': str,
@@ -46,15 +72,36 @@ def load_config():
         'keep_entries_seconds': \
                 confuse.Optional(feed_defaults['keep_entries_seconds']),
         'poll_seconds': confuse.Optional(feed_defaults['poll_seconds']),
+        'revisit_seconds': confuse.Optional(feed_defaults['revisit_seconds']),
         'profiles': \
                 confuse.Optional(confuse.Sequence(profile_names),
                                  default=feed_defaults['profiles']),
         'sponsorblock_remove': \
                 confuse.Optional(SPONSORBLOCKS,
                                  default=feed_defaults['sponsorblock_remove']),
+        'sponsorblock_cut': \
+                confuse.Optional(confuse.Choice(SPONSORBLOCK_CUTS),
+                                 default=feed_defaults['sponsorblock_cut']),
         'overrides': confuse.Optional(dict),
         'live_slice_seconds': \
                 confuse.Optional(feed_defaults['live_slice_seconds']),
+        'live_slicing': \
+                confuse.Optional(confuse.Choice(LIVE_SLICINGS),
+                                 default=feed_defaults['live_slicing']),
+        'live_hls_segment_seconds': \
+                confuse.Optional(feed_defaults['live_hls_segment_seconds']),
+        'live_hls_window_seconds': \
+                confuse.Optional(
+                    int, default=feed_defaults['live_hls_window_seconds']
+                ),
+        'live_wakeup_seconds': \
+                confuse.Optional(feed_defaults['live_wakeup_seconds']),
+        'bandwidth_daily_bytes': \
+                confuse.Optional(
+                    int, default=feed_defaults['bandwidth_daily_bytes']
+                ),
+        'filters': confuse.Optional(config_template_filters,
+                                    default=feed_defaults['filters']),
     }
 
     config_template = {
@@ -63,19 +110,66 @@ def load_config():
             'tmp': confuse.Filename(),
             'out': confuse.Filename(),
             'live': confuse.Optional(confuse.Filename()),
+            'sources': confuse.Optional(confuse.Filename()),
+            'store': confuse.Optional(confuse.Filename()),
             'meta': confuse.Filename(),
             'x_accel': confuse.Optional(confuse.Filename()),
+            'cold': confuse.Optional(confuse.Filename()),
+            'x_accel_cold': confuse.Optional(confuse.Filename()),
         },
         'limits': {
             'throttle_seconds': int,
             'throttle_variance_seconds': int,
             'throttle_extra_seconds': int,
             'throttle_rss_seconds': int,
+            'throttle_live_recheck_seconds': int,
+            'downloads': int,
+            'downloads_per_feed': int,
+            'downloads_per_origin': int,
+            'download_timeout_seconds': int,
+            'live_vod_tolerance_seconds': confuse.Optional(int),
+            'lease_seconds': int,
+            'multi_node': confuse.Choice([True, False], default=False),
+            'eager_idle_seconds': confuse.Optional(int),
+            'bandwidth_bytes_per_second': confuse.Optional(int),
+            'bandwidth_burst_seconds': int,
+            'bandwidth_schedule': confuse.Sequence({
+                'from': str,
+                'to': str,
+                'bytes_per_second': confuse.Optional(int),
+            }),
+            'tmp_max_age_seconds': int,
+            'extraction_ttl_seconds': int,
+            'fragment_error_ratio': float,
+            'postprocesses': confuse.Optional(int),
+            'postprocess_queue': int,
+            'postprocess_nice': int,
+            'postprocess_ionice_class': confuse.Optional(
+                confuse.Choice([1, 2, 3])
+            ),
+            'retry_seconds': int,
+            'retry_max_seconds': int,
+            'retry_attempts': int,
+            'sources_max_bytes': int,
+            'clean_seconds': int,
+            'out_max_bytes': confuse.Optional(int),
+            'clean_high_watermark': float,
+            'clean_low_watermark': float,
+            'cold_after_seconds': confuse.Optional(int),
+            'cold_idle_seconds': confuse.Optional(int),
         },
         'profiles': confuse.MappingValues({
             'container': confuse.Choice(CONTAINER_CHOICES),
             'video': confuse.Choice([True, False], default=True),
+            'lazy': confuse.Choice([True, False], default=False),
+            'concurrent_fragments': confuse.Optional(int, default=1),
+            'concurrent_fragments_max': confuse.Optional(int),
             'download': dict,
+            'derive_from': confuse.Optional(  # False to always download
+                confuse.Choice([*config.get()['profiles'].keys(), False])
+            ),
+            'derive': confuse.Optional(dict, default={}),
+            'max_bytes': confuse.Optional(int),
             'live': confuse.Optional({
                 'audio': confuse.Optional(dict, default={}),
                 'video': confuse.Optional(dict, default={}),
@@ -0,0 +1,272 @@
+# SPDX-FileCopyrightText: 2024 Alexander Sosedkin <monk@unboiled.info>
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+# An optional cold tier for finished media, paths.cold,
+# where the cleaner moves the files that are old or haven't been served lately.
+# A moved file leaves a symlink behind in paths.out for the back-end,
+# the front-end looks the tier up in an index to serve it directly.
+# The index also remembers which inode each file has been moved from,
+# so that the feeds sharing one through the store share the cold copy too;
+# the store entry itself moves to paths.cold/.store once it's the last
+# one left in paths.out (see `yousable.back.store.gc`).
+
+import glob
+import hashlib
+import os
+import sqlite3
+import sys
+import time
+
+import yousable.back.finalize as finalize
+from yousable.utils import thread_cached, thread_uncache
+
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS cold (
+    feed TEXT NOT NULL,
+    entry_id TEXT NOT NULL,
+    name TEXT NOT NULL,
+    moved REAL NOT NULL,
+    PRIMARY KEY (feed, entry_id, name)
+);
+CREATE TABLE IF NOT EXISTS inodes (
+    feed TEXT NOT NULL,
+    entry_id TEXT NOT NULL,
+    name TEXT NOT NULL,
+    dev INTEGER NOT NULL,  -- of the file in paths.out it's been moved from
+    ino INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    PRIMARY KEY (feed, entry_id, name)
+);
+CREATE INDEX IF NOT EXISTS inodes_hot ON inodes (dev, ino);
+'''
+STORE = '.store'  # where the store entries go, glob's `*` skips it
+
+
+def enabled(config):
+    return bool(config['paths']['cold'])
+
+
+def _path(config):
+    return os.path.join(config['paths']['meta'], 'tiers.sqlite')
+
+
+def _open(config):
+    db = sqlite3.connect(_path(config), timeout=10, isolation_level=None)
+    db.execute('PRAGMA journal_mode=' +
+               ('DELETE' if config['limits']['multi_node'] else 'WAL'))
+    db.execute('PRAGMA synchronous=NORMAL')
+    return db
+
+
+def connect(config):
+    """Open the index, creating the schema if needed."""
+    os.makedirs(config['paths']['meta'], exist_ok=True)
+    db = _open(config)
+    db.executescript(SCHEMA)
+    return db
+
+
+def _is_cold(db, feed, entry_id, name):
+    return db.execute('''
+        SELECT 1 FROM cold WHERE feed = ? AND entry_id = ? AND name = ?
+    ''', (feed, entry_id, name)).fetchone() is not None
+
+
+def locate(config, feed, entry_id, name):
+    """(file path, X-Accel-Redirect path or None) of a finished file."""
+    paths = config['paths']
+    tier, x_accel = 'out', paths['x_accel']
+    if enabled(config):  # through a connection per thread, see `connect`
+        key = 'tiers', _path(config)
+        try:
+            if _is_cold(thread_cached(key, lambda: _open(config)),
+                        feed, entry_id, name):
+                tier, x_accel = 'cold', paths['x_accel_cold'] or x_accel
+        except sqlite3.Error:
+            db = thread_uncache(key)  # reconnect next time
+            if db is not None:
+                db.close()
+            raise
+    rel = os.path.join(feed, entry_id, name)
+    return (os.path.join(paths[tier], rel),
+            os.path.join(x_accel, rel) if x_accel is not None else None)
+
+
+def _digest(path):
+    h = hashlib.blake2b()
+    with open(path, 'rb') as f:
+        while chunk := f.read(1 << 20):
+            h.update(chunk)
+    return h.digest()
+
+
+def cold_copy(config, db, st):
+    """A copy in paths.cold of a file in paths.out, None if there's none."""
+    for key in db.execute('''
+        SELECT feed, entry_id, name FROM inodes
+        WHERE dev = ? AND ino = ? AND size = ? AND mtime_ns = ?
+    ''', (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)):
+        path = os.path.join(config['paths']['cold'], *key)
+        if os.path.exists(path):
+            return path
+
+
+def _link(src, dst):
+    if os.path.exists(dst):
+        os.unlink(dst)
+    os.link(src, dst)
+
+
+def _index(db, feed, entry_id, name):
+    db.execute('''
+        INSERT INTO cold (feed, entry_id, name, moved) VALUES (?, ?, ?, ?)
+        ON CONFLICT (feed, entry_id, name) DO UPDATE SET moved = excluded.moved
+    ''', (feed, entry_id, name, time.time()))
+
+
+def migrate(config, db, feed, entry_id, name, reason):
+    """
+    Move a file from paths.out to paths.cold, leaving a symlink behind.
+    A file hardlinked to one moved before gets linked to its cold copy.
+    Gives up if the file gets replaced meanwhile.
+    """
+    rel = os.path.join(feed, entry_id, name)
+    src = os.path.join(config['paths']['out'], rel)
+    dst = os.path.join(config['paths']['cold'], rel)
+    start = time.time()
+    st = os.stat(src, follow_symlinks=False)
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    sibling = cold_copy(config, db, st)
+    try:
+        if sibling is not None:
+            _link(sibling, dst)
+            strategy = 'link to the copy of another feed'
+        else:
+            _link(src, dst)
+            strategy = 'link'
+    except OSError:  # a different filesystem
+        strategy = finalize.clone(src, dst)
+        if (os.path.getsize(dst) != st.st_size or
+                _digest(dst) != _digest(src)):
+            os.unlink(dst)
+            print(f'{rel}: copy to the cold tier differs, keeping it hot',
+                  file=sys.stderr)
+            return False
+    now = os.stat(src, follow_symlinks=False)
+    if (now.st_ino, now.st_mtime) != (st.st_ino, st.st_mtime):
+        os.unlink(dst)
+        print(f'{rel}: replaced while moving, keeping it hot',
+              file=sys.stderr)
+        return False
+    os.symlink(dst, src + '.cold')
+    os.replace(src + '.cold', src)
+    _index(db, feed, entry_id, name)
+    db.execute('''
+        INSERT INTO inodes (feed, entry_id, name, dev, ino, size, mtime_ns)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (feed, entry_id, name) DO UPDATE SET
+            dev = excluded.dev, ino = excluded.ino,
+            size = excluded.size, mtime_ns = excluded.mtime_ns
+    ''', (feed, entry_id, name,
+          st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns))
+    print(f'{rel}: moved {st.st_size} bytes to the cold tier ({reason}) '
+          f'with {strategy} in {time.time() - start:.1f}s', file=sys.stderr)
+    return True
+
+
+def adopt(config, feed, entry_id, name, src):
+    """
+    Make a file in paths.cold/.store the cold copy of a file of a feed,
+    linking it in and leaving a symlink in paths.out.
+    """
+    rel = os.path.join(feed, entry_id, name)
+    hot = os.path.join(config['paths']['out'], rel)
+    cold = os.path.join(config['paths']['cold'], rel)
+    os.makedirs(os.path.dirname(cold), exist_ok=True)
+    os.makedirs(os.path.dirname(hot), exist_ok=True)
+    _link(src, cold)
+    os.symlink(cold, hot + '.cold')
+    os.replace(hot + '.cold', hot)
+    db = connect(config)
+    try:
+        forget(db, feed, entry_id, name)
+        _index(db, feed, entry_id, name)
+    finally:
+        db.close()
+
+
+def replaced(config, feed, entry_id, name):
+    """Forget the cold copy of a file that has just been made anew."""
+    if not enabled(config):
+        return
+    cold = os.path.join(config['paths']['cold'], feed, entry_id, name)
+    db = connect(config)
+    try:
+        forget(db, feed, entry_id, name)
+    finally:
+        db.close()
+    if os.path.exists(cold):
+        os.unlink(cold)
+
+
+def cold_files(db):
+    """{(feed, entry_id, name)} of everything in the cold tier."""
+    return set(db.execute('SELECT feed, entry_id, name FROM cold'))
+
+
+def forget(db, feed, entry_id=None, name=None):
+    for table in 'cold', 'inodes':
+        if entry_id is None:
+            db.execute(f'DELETE FROM {table} WHERE feed = ?', (feed,))
+        elif name is None:
+            db.execute(f'''
+                DELETE FROM {table} WHERE feed = ? AND entry_id = ?
+            ''', (feed, entry_id))
+        else:
+            db.execute(f'''
+                DELETE FROM {table}
+                WHERE feed = ? AND entry_id = ? AND name = ?
+            ''', (feed, entry_id, name))
+
+
+def _linked(config, feed, entry_id, name):
+    rel = os.path.join(feed, entry_id, name)
+    hot = os.path.join(config['paths']['out'], rel)
+    cold = os.path.join(config['paths']['cold'], rel)
+    return os.path.islink(hot) and os.readlink(hot) == cold
+
+
+def gc(config, db, entries=None):
+    """
+    Reconcile the index with the cold tier:
+    forget the files that are gone or have been made anew,
+    finish the interrupted moves and remove the leftovers of the failed ones.
+    Only looks at `entries` ({(feed, entry_id)}) if given.
+    """
+    known = {key for key in cold_files(db)
+             if entries is None or key[:2] in entries}
+    for key in known:
+        if not _linked(config, *key):
+            forget(db, *key)
+    known = cold_files(db)
+    cold = config['paths']['cold']
+    if entries is None:
+        paths = glob.glob(os.path.join(cold, '*', '*', '*'))
+    else:
+        paths = [p for feed, entry_id in entries
+                 for p in glob.glob(os.path.join(cold, glob.escape(feed),
+                                                 glob.escape(entry_id), '*'))]
+    for path in paths:
+        key = tuple(os.path.relpath(path, cold).split(os.sep))
+        if key in known:
+            continue
+        if _linked(config, *key):
+            db.execute('''
+                INSERT INTO cold (feed, entry_id, name, moved)
+                VALUES (?, ?, ?, ?)
+            ''', (*key, os.stat(path).st_mtime))
+        else:
+            print(f'removing {path}: leftover', file=sys.stderr)
+            os.unlink(path)
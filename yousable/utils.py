@@ -1,11 +1,17 @@
 # SPDX-FileCopyrightText: 2022 Alexander Sosedkin <monk@unboiled.info>
 # SPDX-License-Identifier: AGPL-3.0-or-later
 
+import contextlib
+import fcntl
+import json
 import math
 import multiprocessing
+import os
 import random
 import sys
+import threading
 import time
+import urllib.parse
 
 import setproctitle
 
@@ -63,6 +69,51 @@ def sleep(sleepreason, config=None, base_sec=None, variance_sec=None):
     _sleep(base_sec, variance_sec, sleepreason)
 
 
+def throttle(sleepreason, config, key):
+    """
+    Like `sleep`, but for processes running concurrently:
+    each caller takes its turn throttle_seconds (+ variance)
+    after the turn of the previous caller with the same key.
+    """
+    os.makedirs(config['paths']['tmp'], exist_ok=True)
+    turnfile = os.path.join(config['paths']['tmp'], f'.throttle-{key}')
+    with open(turnfile, 'a+') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        f.seek(0)
+        try:
+            prev_turn = float(f.read())
+        except ValueError:
+            prev_turn = 0
+        now = time.time()
+        limits = config['limits']
+        turn = (max(now, prev_turn) + limits['throttle_seconds'] +
+                random.random() * limits['throttle_variance_seconds'])
+        f.seek(0)
+        f.truncate()
+        f.write(str(turn))
+        fcntl.flock(f, fcntl.LOCK_UN)
+    _sleep(turn - now, 0, sleepreason)
+
+
+@contextlib.contextmanager
+def locked_state(config, name):
+    """A JSON dict in paths.tmp shared between processes, saved on exit."""
+    os.makedirs(config['paths']['tmp'], exist_ok=True)
+    with open(os.path.join(config['paths']['tmp'], f'.{name}'), 'a+') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        f.seek(0)
+        try:
+            state = json.load(f)
+        except ValueError:
+            state = {}
+        yield state
+        f.seek(0)
+        f.truncate()
+        json.dump(state, f)
+        f.flush()
+        fcntl.flock(f, fcntl.LOCK_UN)
+
+
 def _sleep(base, variance, sleepreason):
     global _sleeptimer, _sleepreason
     _sleepreason = sleepreason
@@ -110,3 +161,42 @@ def dl_options(config, kind='all'):
                 proxy_pretty = proxy.split('@', 1)[-1]
         print(f'proxy roll: {proxy_pretty}', file=sys.stderr)
     return opts
+
+
+def entry_url(entry_info):
+    return (entry_info.get('original_url') or
+            entry_info.get('webpage_url') or
+            entry_info.get('url'))
+
+
+def entry_origin(entry_info):
+    return urllib.parse.urlparse(entry_url(entry_info)).hostname or 'unknown'
+
+
+def listing(d):
+    """{name: (size, mtime, inode)} of the files in a directory."""
+    files = {}
+    try:
+        for e in os.scandir(d):
+            if e.is_file(follow_symlinks=False):
+                st = e.stat(follow_symlinks=False)
+                files[e.name] = st.st_size, st.st_mtime, st.st_ino
+    except FileNotFoundError:
+        pass
+    return files
+
+
+_thread_cache = threading.local()
+
+
+def thread_cached(key, make):
+    """Reuse what `make()` returns within a thread of a process."""
+    cached = vars(_thread_cache).setdefault(os.getpid(), {})  # not forked
+    if key not in cached:
+        cached[key] = make()
+    return cached[key]
+
+
+def thread_uncache(key):
+    """Forget something cached with `thread_cached`, return it if there was."""
+    return vars(_thread_cache).get(os.getpid(), {}).pop(key, None)